@@ -18,9 +18,92 @@
 Helper functions for building geometries for various OSM types.
 """
 
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy
 import sqlalchemy as sa
-from shapely.geometry import LineString, MultiLineString
-from geoalchemy2.shape import to_shape
+from sqlalchemy.dialects.postgresql import ARRAY
+import shapely.wkb
+
+_WKB_LINESTRING = 2
+_WKB_MULTILINESTRING = 5
+_WKB_FLAG_Z = 0x80000000
+_WKB_FLAG_M = 0x40000000
+_WKB_FLAG_SRID = 0x20000000
+
+def _wkb_header(data, offset):
+    """ Read the header of the (E)WKB geometry starting at `offset`.
+        Returns the endianness, the base geometry type, the number of
+        dimensions and the offset of the geometry data.
+    """
+    endian = '<' if data[offset] == 1 else '>'
+    gtype = struct.unpack_from(endian + 'I', data, offset + 1)[0]
+    # ISO WKB encodes Z and M as multiples of 1000
+    iso_dims, base_type = divmod(gtype & 0x0fffffff, 1000)
+
+    has_z = bool(gtype & _WKB_FLAG_Z) or iso_dims in (1, 3)
+    has_m = bool(gtype & _WKB_FLAG_M) or iso_dims in (2, 3)
+    offset += 9 if gtype & _WKB_FLAG_SRID else 5
+
+    return endian, base_type, 2 + has_z + has_m, offset
+
+def _wkb_linestring(data, offset):
+    """ Read the linestring starting at `offset`. Returns the coordinates
+        and the offset after the linestring.
+    """
+    endian, base_type, ndims, offset = _wkb_header(data, offset)
+    if base_type != _WKB_LINESTRING:
+        raise RuntimeError("Geometry is not a linestring.")
+
+    npoints = struct.unpack_from(endian + 'I', data, offset)[0]
+    coords = numpy.frombuffer(data, dtype=endian + 'f8', count=npoints * ndims,
+                              offset=offset + 4).reshape((npoints, ndims))
+
+    return coords[:, :2].astype(numpy.float64), offset + 4 + 8 * npoints * ndims
+
+def wkb_coords(wkb):
+    """ Return the coordinates of a linestring given in (E)WKB as an
+        array of shape (N, 2). `wkb` may also be a WKBElement.
+        Z and M values are dropped.
+    """
+    return _wkb_linestring(bytes(getattr(wkb, 'data', wkb)), 0)[0]
+
+def wkb_lines(wkb):
+    """ Return the coordinates of a linestring or multilinestring given
+        in (E)WKB as a list of arrays of shape (N, 2), one for each line.
+        `wkb` may also be a WKBElement.
+    """
+    data = bytes(getattr(wkb, 'data', wkb))
+    endian, base_type, _, offset = _wkb_header(data, 0)
+    if base_type == _WKB_LINESTRING:
+        return [_wkb_linestring(data, 0)[0]]
+    if base_type != _WKB_MULTILINESTRING:
+        raise RuntimeError("Geometry is not a linestring or multilinestring.")
+
+    nlines = struct.unpack_from(endian + 'I', data, offset)[0]
+    offset += 4
+    lines = []
+    for _ in range(nlines):
+        line, offset = _wkb_linestring(data, offset)
+        lines.append(line)
+
+    return lines
+
+def linestring_wkb(coords):
+    """ Return the WKB of a linestring with the given coordinates.
+        `coords` must be an array of shape (N, 2).
+    """
+    coords = numpy.ascontiguousarray(coords, dtype='<f8')
+    return struct.pack('<BII', 1, _WKB_LINESTRING, len(coords)) + coords.tobytes()
+
+def multilinestring_wkb(lines):
+    """ Return the WKB of a multilinestring with the given lines.
+        `lines` must be a list of arrays of shape (N, 2).
+    """
+    return struct.pack('<BII', 1, _WKB_MULTILINESTRING, len(lines)) \
+           + b''.join([linestring_wkb(l) for l in lines])
 
 def _sqr_dist(p1, p2):
     """ Returns the squared simple distance of two points.
@@ -31,92 +114,231 @@ def _sqr_dist(p1, p2):
     yd = p1[1] - p2[1]
     return xd * xd + yd * yd
 
+class RouteGeometryBuilder(object):
+    """ Creates route geometries from the geometries of their member ways
+        and relations.
+
+        `way_table` and `rel_table` are the sources for the member
+        geometries. They need to have an `id` and a `geom` column. The
+        decoded geometries of the members are kept in a cache of at most
+        `cache_size` entries, so that members which are shared between
+        many routes, in particular sub-relations in route hierarchies, are
+        only fetched once.
+
+        The cache lives as long as the builder. When the builder is kept
+        between updates, outdated members must be removed: call
+        invalidate() at the beginning of the update of the table that
+        uses the builder, that is after the sources have been updated
+        and before the first geometry is built. A source that is written
+        while the builder is in use, for example a route table that is
+        its own relation source, is not covered by invalidate() because
+        its change table is only complete at the end of the update. Call
+        discard() with the ids of all geometries written to such a
+        source.
+    """
+
+    def __init__(self, way_table, rel_table, cache_size=10000):
+        self.sources = (('W', way_table), ('R', rel_table))
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def build(self, conn, members):
+        """ Create a route geometry from the given member list.
+            Returns None if there are no usable members.
+        """
+        return self.build_many(conn, [members])[0]
+
+    def build_many(self, conn, memberlists):
+        """ Create route geometries for a list of member lists. The
+            geometries of all members that are not yet cached are fetched
+            with a single query.
+        """
+        geoms = {}
+        missing = {'W' : set(), 'R' : set()}
+        with self.lock:
+            for members in memberlists:
+                for m in members:
+                    key = (m['type'], m['id'])
+                    if m['type'] in missing and key not in geoms:
+                        if key in self.cache:
+                            self.cache.move_to_end(key)
+                            geoms[key] = self.cache[key]
+                        else:
+                            missing[m['type']].add(m['id'])
+
+        fetched = self._fetch(conn, missing)
+        geoms.update(fetched)
+
+        if self.cache_size > 0:
+            with self.lock:
+                for key, geom in fetched.items():
+                    self.cache[key] = geom
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        return [_assemble_route(members, geoms) for members in memberlists]
+
+    def invalidate(self, conn):
+        """ Remove all members from the cache that appear in the change
+            tables of the sources. If a source has no change table, all
+            its members are removed. The change tables must be complete,
+            see the class description.
+        """
+        keys = []
+        for kind, src in self.sources:
+            change = getattr(src, 'change', None)
+            if change is None:
+                keys.extend([k for k in self.cache if k[0] == kind])
+            else:
+                keys.extend([(kind, r[0]) for r in
+                               conn.execute(sa.select([change.c.id]))])
+
+        with self.lock:
+            for k in keys:
+                self.cache.pop(k, None)
+
+    def discard(self, kind, ids):
+        """ Remove the members of type `kind` ('W' or 'R') with the
+            given ids from the cache.
+        """
+        with self.lock:
+            for oid in ids:
+                self.cache.pop((kind, oid), None)
+
+    def clear(self):
+        """ Remove all members from the cache.
+        """
+        with self.lock:
+            self.cache.clear()
+
+    def _fetch(self, conn, missing):
+        """ Get the decoded geometries for the given ids of ways and
+            relations. Ids that are not found are returned with a
+            geometry of None.
+        """
+        sqls = []
+        for kind, src in self.sources:
+            if missing[kind]:
+                t = getattr(src, 'data', src)
+                ids = sa.literal(list(missing[kind]), ARRAY(sa.BigInteger))
+                sqls.append(sa.select([sa.literal(kind).label('kind'),
+                                       t.c.id, t.c.geom])
+                              .where(t.c.id == sa.any_(ids)))
+
+        geoms = {}
+        for kind, ids in missing.items():
+            for oid in ids:
+                geoms[(kind, oid)] = None
+
+        if sqls:
+            sql = sqls[0] if len(sqls) == 1 else sa.union_all(*sqls)
+            for r in conn.execute(sql):
+                if r['geom'] is not None:
+                    geoms[(r['kind'], r['id'])] = \
+                        _decode_member(r['geom'], r['kind'], r['id'])
+
+        return geoms
+
+
+def _decode_member(geom, kind, oid):
+    try:
+        return wkb_lines(geom)
+    except RuntimeError:
+        raise RuntimeError("Bad geometry type (member type: %s member id: %d)"
+                           % (kind, oid))
+
+
 def build_route_geometry(conn, members, way_table, rel_table):
     """ Create a route geometry from a relation and way table given
         a member list.
+
+        Use a RouteGeometryBuilder when geometries for many routes
+        are needed.
     """
-    geoms = { 'W' : {}, 'R' : {} }
-    for m in members:
-        if m['type'] != 'N':
-            geoms[m['type']][m['id']] = None
-    # first get all involved geoemetries
-    for kind, t in (('W', way_table), ('R', rel_table)):
-        if geoms[kind]:
-            sql = sa.select([t.c.id, t.c.geom]).where(t.c.id.in_(geoms[kind].keys()))
-            for r in conn.execute(sql):
-                geoms[kind][r['id']] = to_shape(r['geom'])
+    return RouteGeometryBuilder(way_table, rel_table, cache_size=0)\
+             .build(conn, members)
+
+
+def _assemble_route(members, geoms):
+    """ Put together the route geometry for the given members. `geoms`
+        maps (type, id) of the members to the list of coordinate arrays
+        of their geometry.
+
+        The lines of the route are collected as lists of array views,
+        so that reversing a line does not copy any coordinates. They are
+        copied only once, when the final geometry is created.
+    """
+    parts = [geoms.get((m['type'], m['id'])) for m in members]
+    # ignore nodes and missing ways and relations
+    parts = [g for g in parts if g is not None]
+    if not parts:
+        return None
+
+    # start and end point of all members as lists of floats
+    ends = numpy.array([(g[0][0], g[-1][-1]) for g in parts]).tolist()
 
-    # now put them together
     is_turnable = False
     outgeom = []
-    for m in members:
-        t = m['type']
-        # ignore nodes and missing ways and relations
-        if t == 'N' or m['id'] not in geoms[t]:
-            continue
-
-        # convert this to a tuple of coordinates
-        geom = geoms[t][m['id']]
-        if geom is None:
-            continue 
-        if geom.geom_type == 'MultiLineString':
-            geom = [list(g.coords) for g in list(geom.geoms)]
-        elif geom.geom_type == 'LineString':
-            geom = [list(geom.coords)]
-        else:
-            raise RuntimeError("Bad geometry type '%s' (member type: %s member id: %d" % (geom.geom_type, t, m['id']))
-
-        oldgeom = outgeom
+    for geom, (start, end) in zip(parts, ends):
         if outgeom:
+            line = outgeom[-1]
+            first = line[0][0].tolist()
+            last = line[-1][-1].tolist()
             # try connect with previous geometry at end point
-            if geom[0][0] == outgeom[-1][-1]:
-                outgeom[-1].extend(geom[0][1:])
-                outgeom.extend(geom[1:])
+            if start == last:
+                _extend_route(outgeom, geom[0][1:], geom[1:])
                 is_turnable = False
                 continue
-            if geom[-1][-1] == outgeom[-1][-1]:
-                outgeom[-1].extend(geom[-1][-2::-1])
-                outgeom.extend(geom[-2::-1])
+            if end == last:
+                _extend_route(outgeom, geom[-1][-2::-1], geom[-2::-1])
+                is_turnable = False
+                continue
+            # try to connect with previous geometry at start point
+            if is_turnable and start == first:
+                outgeom[-1] = _reverse_line(line)
+                _extend_route(outgeom, geom[0][1:], geom[1:])
                 is_turnable = False
                 continue
-            if is_turnable:
-                # try to connect with previous geometry at start point
-                if geom[0][0] == outgeom[-1][0]:
-                    outgeom[-1].reverse()
-                    outgeom[-1].extend(geom[0][1:])
-                    outgeom.extend(geom[1:])
-                    is_turnable = False
-                    continue
-                if geom[-1] == outgeom[-1][0]:
-                    outgeom[-1].reverse()
-                    outgeom[-1].extend(geom[-1][-2::-1])
-                    outgeom.extend(geom[-2::-1])
-                    is_turnable = False
-                    continue
             # nothing found, then turn the geometry such that the
             # end points are as close together as possible
-            mdist = _sqr_dist(outgeom[-1][-1], geom[0][0])
-            d = _sqr_dist(outgeom[-1][-1], geom[-1][-1])
+            mdist = _sqr_dist(last, start)
+            d = _sqr_dist(last, end)
             if d < mdist:
-                geom = [list(reversed(g)) for g in reversed(geom)]
+                geom = _reverse_line(geom)
+                start, end = end, start
                 mdist = d
             # For the second way in the relation, we also allow the first
             # to be turned, if the two ways aren't connected.
             if is_turnable and len(outgeom) == 1:
-                d1 = _sqr_dist(outgeom[-1][0], geom[0][0])
-                d2 = _sqr_dist(outgeom[-1][0], geom[-1][-1])
+                d1 = _sqr_dist(first, start)
+                d2 = _sqr_dist(first, end)
                 if d1 < mdist or d2 < mdist:
-                    outgeom[-1].reverse()
+                    outgeom[-1] = _reverse_line(line)
                 if d2 < d1:
-                    geom = [list(reversed(g)) for g in reversed(geom)]
+                    geom = _reverse_line(geom)
 
-        outgeom.extend(geom)
+        outgeom.extend([[g] for g in geom])
         is_turnable = True
 
-    if not outgeom:
-        return None
+    lines = [l[0] if len(l) == 1 else numpy.concatenate(l) for l in outgeom]
+    if len(lines) == 1:
+        return shapely.wkb.loads(linestring_wkb(lines[0]))
 
-    ret = LineString(outgeom[0]) if len(outgeom) == 1 else MultiLineString(outgeom)
+    return shapely.wkb.loads(multilinestring_wkb(lines))
 
-    return ret
 
+def _extend_route(outgeom, coords, lines):
+    """ Append `coords` to the last line of the route and add `lines`
+        as new lines.
+    """
+    if len(coords):
+        outgeom[-1].append(coords)
+    outgeom.extend([[g] for g in lines])
+
+
+def _reverse_line(line):
+    """ Reverse a list of coordinate arrays. Only views of the arrays
+        are created.
+    """
+    return [c[::-1] for c in reversed(line)]
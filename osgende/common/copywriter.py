@@ -0,0 +1,341 @@
+# This file is part of Osgende
+# Copyright (C) 2018 Sarah Hoffmann
+#
+# This is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""
+Bulk writing of table rows using Postgresql's COPY.
+"""
+
+import datetime
+import decimal
+import io
+import json
+import numbers
+import struct
+import time
+import uuid
+from itertools import chain
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSON, JSONB
+from geoalchemy2 import Geometry
+from geoalchemy2.elements import WKBElement, WKTElement
+
+from osgende.common.stats import get_stats
+
+_copy_escape = str.maketrans({'\\' : '\\\\', '\t' : '\\t',
+                              '\n' : '\\n', '\r' : '\\r'})
+
+def _unsupported(value):
+    return TypeError("Cannot write value of type %s with COPY."
+                     % type(value).__name__)
+
+def _encode_scalar(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (numbers.Real, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise _unsupported(value)
+
+def _array_element(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (list, tuple)):
+        return _encode_array(value)
+    if isinstance(value, str):
+        return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+    return _encode_scalar(value)
+
+def _encode_array(value):
+    if hasattr(value, 'tolist'):
+        # numpy array
+        value = value.tolist()
+    if not isinstance(value, (list, tuple)):
+        raise _unsupported(value)
+    return '{%s}' % ','.join(map(_array_element, value))
+
+def _encode_json(value):
+    return json.dumps(value)
+
+def _encode_geometry(value, srid):
+    if isinstance(value, WKBElement):
+        if value.extended or value.srid < 0:
+            return value.desc
+        return 'SRID=%d;%s' % (value.srid, value.desc)
+    if isinstance(value, WKTElement):
+        if value.extended or value.srid < 0:
+            return value.data
+        return 'SRID=%d;%s' % (value.srid, value.data)
+    if hasattr(value, 'wkb_hex'):
+        # shapely geometry
+        return 'SRID=%d;%s' % (srid, value.wkb_hex)
+    if isinstance(value, str):
+        # EWKT or hex-encoded EWKB
+        return value
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # EWKB
+        return bytes(value).hex()
+    raise _unsupported(value)
+
+def _encode_bool(value):
+    if not isinstance(value, (bool, numbers.Integral)):
+        raise _unsupported(value)
+    return 't' if value else 'f'
+
+def text_encoder(column):
+    """ Return a function that converts a Python value into the
+        COPY text representation for the given column. The returned
+        string is not yet escaped. The function raises a TypeError
+        for values that have no well-defined representation.
+    """
+    ctype = column.type
+    if isinstance(ctype, Geometry):
+        return lambda v: _encode_geometry(v, ctype.srid)
+    if isinstance(ctype, (JSON, JSONB)):
+        return _encode_json
+    if isinstance(ctype, sa.ARRAY):
+        return _encode_array
+    if isinstance(ctype, sa.Boolean):
+        return _encode_bool
+    return _encode_scalar
+
+
+# Header of a file in binary COPY format: signature, flags and
+# length of the header extension.
+COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+# Trailer of a file in binary COPY format.
+COPY_BINARY_TRAILER = struct.pack('>h', -1)
+
+# OIDs of element types supported in binary arrays.
+_ARRAY_OIDS = { 'int8' : 20, 'int4' : 23 }
+
+def _binary_int8(value):
+    if not isinstance(value, numbers.Integral):
+        raise _unsupported(value)
+    return struct.pack('>q', value)
+
+def _binary_int4(value):
+    if not isinstance(value, numbers.Integral):
+        raise _unsupported(value)
+    return struct.pack('>i', value)
+
+def _binary_text(value):
+    return _encode_scalar(value).encode('utf-8')
+
+def _binary_bool(value):
+    if not isinstance(value, (bool, numbers.Integral)):
+        raise _unsupported(value)
+    return b'\x01' if value else b'\x00'
+
+def _binary_jsonb(value):
+    # jsonb is prefixed with a version number, currently always 1
+    return b'\x01' + json.dumps(value).encode('utf-8')
+
+def _binary_json(value):
+    return json.dumps(value).encode('utf-8')
+
+def _binary_int_array(elemtype):
+    oid = _ARRAY_OIDS[elemtype]
+    elemfmt = 'iq' if elemtype == 'int8' else 'ii'
+    elemsize = 8 if elemtype == 'int8' else 4
+
+    def encode(value):
+        num = len(value)
+        if num == 0:
+            return struct.pack('>iii', 0, 0, oid)
+        # ndims, has nulls, element type, size and lower bound of dimension
+        # followed by the length and value of each element
+        return struct.pack('>iiiii' + elemfmt * num, 1, 0, oid, num, 1,
+                           *chain.from_iterable((elemsize, v) for v in value))
+
+    return encode
+
+def _ewkb(wkb, srid):
+    """ Add the SRID to a geometry in plain WKB format.
+    """
+    fmt = '<I' if wkb[0] == 1 else '>I'
+    gtype = struct.unpack_from(fmt, wkb, 1)[0]
+    if gtype & 0x20000000:
+        return wkb
+    return wkb[:1] + struct.pack(fmt, gtype | 0x20000000) \
+            + struct.pack(fmt, srid) + wkb[5:]
+
+def _binary_geometry(value, srid):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # already EWKB
+        return bytes(value)
+    if isinstance(value, str):
+        # hex-encoded EWKB
+        return bytes.fromhex(value)
+    if isinstance(value, WKBElement):
+        data = bytes(value.data)
+        if value.extended or value.srid < 0:
+            return data
+        return _ewkb(data, value.srid)
+    if hasattr(value, 'wkb'):
+        # shapely geometry
+        return _ewkb(value.wkb, srid)
+    raise _unsupported(value)
+
+def binary_encoder(column):
+    """ Return a function that converts a Python value into the binary
+        COPY representation for the given column. Raw geometries must be
+        given as EWKB, either as bytes or hex-encoded.
+
+        The binary format requires the exact type of the column. Only
+        the types used for OSM data are supported, for other columns a
+        RuntimeError is raised. Like the text encoders, the function
+        raises a TypeError for values it cannot encode.
+    """
+    ctype = column.type
+    if isinstance(ctype, Geometry):
+        return lambda v: _binary_geometry(v, ctype.srid)
+    if isinstance(ctype, JSONB):
+        return _binary_jsonb
+    if isinstance(ctype, JSON):
+        return _binary_json
+    if isinstance(ctype, sa.ARRAY):
+        if isinstance(ctype.item_type, sa.BigInteger):
+            return _binary_int_array('int8')
+        if isinstance(ctype.item_type, sa.Integer):
+            return _binary_int_array('int4')
+    elif isinstance(ctype, sa.BigInteger):
+        return _binary_int8
+    elif isinstance(ctype, sa.Integer):
+        return _binary_int4
+    elif isinstance(ctype, sa.Boolean):
+        return _binary_bool
+    elif isinstance(ctype, sa.String):
+        return _binary_text
+
+    raise RuntimeError("Column '%s' has a type not supported by binary COPY."
+                       % column.name)
+
+
+class BinaryRowEncoder(object):
+    """ Converts rows of a table into the binary COPY format.
+
+        Rows are given as dicts with column names as keys. Missing columns
+        are written as NULL. Output of the encoder must start with
+        COPY_BINARY_HEADER and end with COPY_BINARY_TRAILER.
+    """
+
+    def __init__(self, table, columns=None):
+        if columns is None:
+            columns = [c.name for c in table.c]
+        self.columns = columns
+        self.encoders = [binary_encoder(table.c[c]) for c in columns]
+        self.row_header = struct.pack('>h', len(columns))
+
+    def encode(self, row):
+        """ Return the binary representation of the row as bytes.
+        """
+        parts = [self.row_header]
+        for col, enc in zip(self.columns, self.encoders):
+            value = row.get(col)
+            if value is None:
+                parts.append(b'\xff\xff\xff\xff')
+            else:
+                data = enc(value)
+                parts.append(struct.pack('>i', len(data)))
+                parts.append(data)
+
+        return b''.join(parts)
+
+
+class CopyWriter(object):
+    """ Collects rows for a table and writes them out in bulk using
+        COPY FROM STDIN in text format.
+
+        Rows are added as dicts with column names as keys. A row may
+        omit columns, these are written as NULL. The collected rows are
+        sent to the database as soon as `batch_size` rows or `max_bytes`
+        of data have been collected and when the writer is closed.
+
+        The writer uses the DBAPI connection of the SQLAlchemy connection
+        `conn`, so that the data is written within the current transaction
+        of the connection.
+    """
+
+    def __init__(self, conn, table, batch_size=10000, max_bytes=8*1024*1024,
+                 columns=None):
+        self.conn = conn
+        self.table = table
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+
+        if columns is None:
+            columns = [c.name for c in table.c]
+        self.columns = columns
+        self.encoders = [text_encoder(table.c[c]) for c in columns]
+
+        preparer = conn.dialect.identifier_preparer
+        self.sql = "COPY %s (%s) FROM STDIN" % (
+                       preparer.format_table(table),
+                       ','.join([preparer.quote(c) for c in columns]))
+
+        self.buffer = io.StringIO()
+        self.numrows = 0
+
+    def add(self, row):
+        """ Add a new row. The rows may be sent to the database immediately.
+        """
+        line = []
+        for col, enc in zip(self.columns, self.encoders):
+            value = row.get(col)
+            if value is None:
+                line.append('\\N')
+            else:
+                line.append(enc(value).translate(_copy_escape))
+
+        self.buffer.write('\t'.join(line))
+        self.buffer.write('\n')
+        self.numrows += 1
+
+        if self.numrows >= self.batch_size or self.buffer.tell() >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        """ Send all collected rows to the database.
+        """
+        if self.numrows == 0:
+            return
+
+        self.buffer.seek(0)
+        t0 = time.monotonic()
+        cur = self.conn.connection.cursor()
+        try:
+            cur.copy_expert(self.sql, self.buffer)
+        finally:
+            cur.close()
+
+        # COPY bypasses SQLAlchemy's execution events
+        stats = get_stats(self.conn)
+        if stats is not None:
+            stats.add_query(time.monotonic() - t0, rows_written=self.numrows)
+
+        self.buffer = io.StringIO()
+        self.numrows = 0
+
+    def close(self):
+        """ Write out any remaining rows.
+        """
+        self.flush()
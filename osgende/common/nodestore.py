@@ -19,7 +19,9 @@ File-backed storage for node geometries.
 """
 
 import logging
+import os
 
+import numpy
 from osmium import index, osm
 from binascii import hexlify
 from struct import pack
@@ -28,6 +30,26 @@ from osmium.geom import lonlat_to_mercator, Coordinates
 
 log = logging.getLogger(__name__)
 
+# Layout of the osmium dense_file_array: one osmium::Location per node id,
+# consisting of x and y as 32bit integers in 1/10^7 degrees. Empty slots
+# contain an undefined location.
+_LOCATION_DTYPE = numpy.dtype([('x', numpy.int32), ('y', numpy.int32)])
+_UNDEFINED_COORDINATE = 2147483647
+_COORDINATE_PRECISION = 10000000
+
+_EARTH_RADIUS = 6378137.0
+
+def to_mercator_array(coords):
+    """ Convert an array of shape (N, 2) with lon/lat coordinates to
+        web mercator.
+    """
+    ret = numpy.empty_like(coords)
+    ret[:, 0] = numpy.radians(coords[:, 0]) * _EARTH_RADIUS
+    ret[:, 1] = numpy.log(numpy.tan(numpy.pi/4 + numpy.radians(coords[:, 1])/2)) \
+                * _EARTH_RADIUS
+    return ret
+
+
 class NodeStorePoint(namedtuple('NodeStorePoint', ['x', 'y'])):
 
     def wkb(self):
@@ -46,7 +68,9 @@ class NodeStore(object):
     """
 
     def __init__(self, filename):
+        self.filename = filename
         self.mapfile = index.create_map("dense_file_array," + filename)
+        self.locations = None
 
     def __del__(self):
         self.close()
@@ -64,10 +88,102 @@ class NodeStore(object):
     def set_from_node(self, node):
         self.mapfile.set(node.id, node.location)
 
+    def get_many(self, ids):
+        """ Return the locations for a list of node ids as an array of
+            shape (N, 2) with lon/lat coordinates. Nodes without a location
+            get NaN coordinates.
+
+            The location file is read directly through a read-only memory
+            map and the ids are looked up in ascending order.
+        """
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        ret = numpy.full((len(ids), 2), numpy.nan)
+        if len(ids) == 0:
+            return ret
+
+        uids, inverse = numpy.unique(ids, return_inverse=True)
+        locs = self._get_locations(uids[-1])
+
+        coords = numpy.full((len(uids), 2), numpy.nan)
+        valid = numpy.flatnonzero((uids >= 0) & (uids < len(locs)))
+        if len(valid):
+            found = locs[uids[valid]]
+            defined = found['x'] != _UNDEFINED_COORDINATE
+            valid = valid[defined]
+            found = found[defined]
+            coords[valid, 0] = found['x'] / _COORDINATE_PRECISION
+            coords[valid, 1] = found['y'] / _COORDINATE_PRECISION
+
+        ret[:] = coords[inverse]
+
+        return ret
+
+    def _get_locations(self, maxid):
+        """ Return a memory-mapped view of the location file. The view is
+            renewed when `maxid` is outside the view and the file has grown
+            in the meantime.
+        """
+        if self.locations is None or maxid >= len(self.locations):
+            size = os.path.getsize(self.filename) // _LOCATION_DTYPE.itemsize
+            if self.locations is None or size > len(self.locations):
+                if size == 0:
+                    return numpy.empty(0, dtype=_LOCATION_DTYPE)
+                self.locations = numpy.memmap(self.filename, mode='r',
+                                              dtype=_LOCATION_DTYPE,
+                                              shape=(size,))
+
+        return self.locations
+
     def close(self):
         if hasattr(self, 'mapfile'):
             log.info("Used memory by index: %d" % self.mapfile.used_memory())
             del self.mapfile
+        self.locations = None
+
+
+class ReadOnlyNodeStore(NodeStore):
+    """Read-only access to a node location file created by NodeStore.
+
+       The file is accessed through a read-only memory map only, so that
+       any number of processes may open the same file at the same time.
+       They then share the data through the page cache of the OS.
+
+       The store may be pickled. The unpickled object simply opens the
+       file again.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.locations = None
+        # Fail early if the file does not exist.
+        self._get_locations(0)
+
+    def __getstate__(self):
+        return {'filename' : self.filename}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'])
+
+    def __getitem__(self, nodeid):
+        locs = self._get_locations(nodeid)
+        if nodeid < 0 or nodeid >= len(locs):
+            raise KeyError(nodeid)
+
+        loc = locs[nodeid]
+        if loc['x'] == _UNDEFINED_COORDINATE:
+            raise KeyError(nodeid)
+
+        return NodeStorePoint(int(loc['x']) / _COORDINATE_PRECISION,
+                              int(loc['y']) / _COORDINATE_PRECISION)
+
+    def __setitem__(self, nodeid, value):
+        raise RuntimeError("Node store is read-only.")
+
+    def __delitem__(self, nodeid):
+        raise RuntimeError("Node store is read-only.")
+
+    def set_from_node(self, node):
+        raise RuntimeError("Node store is read-only.")
 
 
 if __name__ == '__main__':
@@ -122,6 +238,22 @@ if __name__ == '__main__':
     for i in range(25500,26000):
         assert store[i].y == i/1000.0
 
+    print("Checking bulk read...")
+    coords = store.get_many([25500, 1000, 100055500])
+    assert coords[0][1] == 25.5
+    assert numpy.isnan(coords[1][0])
+    assert coords[2][0] == 10.00555
+
+    print("Checking read-only store...")
+    rostore = ReadOnlyNodeStore('test.store')
+    for i in range(25500,26000):
+        assert rostore[i].y == i/1000.0
+    assert rostore.get_many([100055500])[0][0] == 10.00555
+    try:
+        x = rostore[1000]
+    except KeyError:
+        print("Yeah!")
+
 
     store.close()
 
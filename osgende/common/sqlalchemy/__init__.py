@@ -17,4 +17,4 @@
 
 from .tables import CreateTableAs, Analyse, CreateView, DropIndexIfExists, Truncate
 from .geometry import ST_MakeLine
-from .jsonb import jsonb_array_elements
+from .jsonb import jsonb_array_elements, jsonb_array_elements_with_ordinality
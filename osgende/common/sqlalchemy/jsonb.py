@@ -18,10 +18,21 @@
 # With minor modifications borrowed from
 # https://bitbucket.org/zzzeek/sqlalchemy/issues/3566/figure-out-how-to-support-all-of-pgs
 
+from sqlalchemy import BigInteger
 from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
 from .column_function import ColumnFunction
 
 class jsonb_array_elements(ColumnFunction):
         name = 'jsonb_array_elements'
         column_names = [('value', JSONB)]
 
+
+
+class jsonb_array_elements_with_ordinality(ColumnFunction):
+        name = 'jsonb_array_elements'
+        column_names = [('value', JSONB), ('ordinality', BigInteger)]
+
+@compiles(jsonb_array_elements_with_ordinality)
+def _compile_with_ordinality(element, compiler, **kw):
+    return compiler.visit_function(element, **kw) + ' WITH ORDINALITY'
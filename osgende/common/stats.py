@@ -0,0 +1,304 @@
+# This file is part of Osgende
+# Copyright (C) 2018 Sarah Hoffmann
+#
+# This is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""
+Collection of timing and row count statistics for table processing.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+# Name of the execution option that carries the statistics of the
+# table that is currently processed.
+_STATS_OPTION = 'osgende_stats'
+
+class TableStats(object):
+    """ Statistics for one processing phase ('construct' or 'update')
+        of a single table.
+
+        SQL time and row counts are collected over all connections that
+        are derived from the engine handed to the table, including those of
+        worker threads and worker processes. Rows read are only counted for
+        queries where the database driver reports the number of rows, which
+        excludes server-side cursors used for streaming results.
+
+        `failed` is set when the processing of the table raised an
+        exception. `concurrent` is set when other tables were processed
+        at the same time.
+    """
+
+    def __init__(self, table, phase):
+        self.table = table
+        self.phase = phase
+        self.start_time = time.time()
+        self.wall_time = 0.0
+        self.sql_time = 0.0
+        self.rows_read = 0
+        self.rows_written = 0
+        self.change_size = None
+        self.failed = False
+        self.concurrent = False
+        self.lock = threading.Lock()
+
+    @property
+    def python_time(self):
+        """ Time not spent waiting for SQL statements. As statements may
+            run in parallel in multiple connections, this is only an
+            estimate. When other tables were processed at the same time,
+            the wall time includes their work and the value is None.
+        """
+        if self.concurrent:
+            return None
+        return max(0.0, self.wall_time - self.sql_time)
+
+    def add_query(self, duration, rows_read=0, rows_written=0):
+        with self.lock:
+            self.sql_time += duration
+            self.rows_read += rows_read
+            self.rows_written += rows_written
+
+    def reset_counters(self):
+        """ Set SQL time and row counts back to zero. Used by forked
+            worker processes, which only send back their own share.
+        """
+        self.lock = threading.Lock()
+        self.sql_time = 0.0
+        self.rows_read = 0
+        self.rows_written = 0
+
+    def counters(self):
+        """ Return SQL time and row counts in the order expected
+            by add_query().
+        """
+        with self.lock:
+            return self.sql_time, self.rows_read, self.rows_written
+
+    def as_dict(self):
+        return {'table' : self.table, 'phase' : self.phase,
+                'start' : self.start_time,
+                'wall_time' : self.wall_time, 'sql_time' : self.sql_time,
+                'python_time' : self.python_time,
+                'rows_read' : self.rows_read,
+                'rows_written' : self.rows_written,
+                'change_size' : self.change_size,
+                'failed' : self.failed, 'concurrent' : self.concurrent}
+
+
+def get_stats(conn):
+    """ Return the TableStats object that is attached to the given
+        connection or None if statistics are not collected.
+    """
+    return conn._execution_options.get(_STATS_OPTION)
+
+
+class StatsCollector(object):
+    """ Measures the processing of tables and hands the results to
+        a list of sinks. A sink is an object with a function write(stats),
+        that receives a TableStats object, and a function close().
+
+        If no sinks are given, nothing is measured.
+    """
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+        self.engines = []
+        self.active = set()
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return len(self.sinks) > 0
+
+    def attach(self, engine):
+        """ Install the listeners that measure SQL statements in `engine`.
+        """
+        with self.lock:
+            if not self.enabled or any((e is engine for e in self.engines)):
+                return
+
+            event.listen(engine, 'before_cursor_execute', _before_execute)
+            event.listen(engine, 'after_cursor_execute', _after_execute)
+            self.engines.append(engine)
+
+    def detach(self):
+        """ Remove the listeners from all engines.
+        """
+        with self.lock:
+            for engine in self.engines:
+                event.remove(engine, 'before_cursor_execute', _before_execute)
+                event.remove(engine, 'after_cursor_execute', _after_execute)
+            self.engines = []
+
+    @contextmanager
+    def measure(self, table, phase, engine):
+        """ Context manager that measures the processing of `table`.
+            It yields the engine that the table must use for processing.
+            The statistics are also handed to the sinks when processing
+            fails.
+        """
+        if not self.enabled:
+            yield engine
+            return
+
+        self.attach(engine)
+        stats = TableStats(str(table.data.name), phase)
+        with self.lock:
+            if self.active:
+                stats.concurrent = True
+                for other in self.active:
+                    other.concurrent = True
+            self.active.add(stats)
+
+        t0 = time.monotonic()
+        try:
+            yield engine.execution_options(**{_STATS_OPTION : stats})
+        except BaseException:
+            stats.failed = True
+            raise
+        finally:
+            stats.wall_time = time.monotonic() - t0
+            with self.lock:
+                self.active.discard(stats)
+
+            change = getattr(table, 'change', None)
+            if not stats.failed and change is not None \
+               and not getattr(table, 'view_only', False):
+                # Must not hide the outcome of the table processing.
+                try:
+                    stats.change_size = engine.scalar(
+                        sa.select([sa.func.count()]).select_from(change))
+                except Exception as e:
+                    log.warning("Cannot count the changes of table %s: %s",
+                                stats.table, e)
+
+            for sink in self.sinks:
+                sink.write(stats)
+
+    def close(self):
+        self.detach()
+        for sink in self.sinks:
+            sink.close()
+
+
+# The start time is kept with the execution context of the statement,
+# so that statements which fail do not disturb the bookkeeping.
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if _STATS_OPTION in conn._execution_options and context is not None:
+        context._osgende_query_start = time.monotonic()
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = conn._execution_options.get(_STATS_OPTION)
+    start = getattr(context, '_osgende_query_start', None)
+    if stats is None or start is None:
+        return
+
+    duration = time.monotonic() - start
+    rows = max(0, cursor.rowcount)
+    if statement.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+        stats.add_query(duration, rows_written=rows)
+    else:
+        stats.add_query(duration, rows_read=rows)
+
+
+class LoggingSink(object):
+    """ Writes the statistics to the log.
+    """
+
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def write(self, stats):
+        log.log(self.level,
+                "%s %s%s: %.2fs (python %s, sql %.2fs), %d rows read, "
+                "%d rows written, %s changes",
+                stats.phase, stats.table, ' (failed)' if stats.failed else '',
+                stats.wall_time,
+                '-' if stats.python_time is None else '%.2fs' % stats.python_time,
+                stats.sql_time, stats.rows_read, stats.rows_written,
+                '-' if stats.change_size is None else stats.change_size)
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink(object):
+    """ Appends the statistics as one JSON object per line to a file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def write(self, stats):
+        with self.lock:
+            with open(self.filename, 'a') as fd:
+                fd.write(json.dumps(stats.as_dict()))
+                fd.write('\n')
+
+    def close(self):
+        pass
+
+
+class PrometheusSink(object):
+    """ Writes the statistics of the last run in the text format of the
+        Prometheus node exporter's textfile collector. The file is
+        replaced atomically when the sink is closed.
+    """
+
+    metrics = (('wall_time', 'wall_seconds', 'Total processing time'),
+               ('python_time', 'python_seconds', 'Processing time outside of SQL statements'),
+               ('sql_time', 'sql_seconds', 'Time spent waiting for SQL statements'),
+               ('rows_read', 'rows_read', 'Number of rows read'),
+               ('rows_written', 'rows_written', 'Number of rows written'),
+               ('change_size', 'changes', 'Number of entries in the change table'))
+
+    def __init__(self, filename, prefix='osgende_table'):
+        self.filename = filename
+        self.prefix = prefix
+        self.results = []
+        self.lock = threading.Lock()
+
+    def write(self, stats):
+        with self.lock:
+            self.results.append(stats)
+
+    def close(self):
+        lines = []
+        for attr, suffix, desc in self.metrics:
+            name = '%s_%s' % (self.prefix, suffix)
+            lines.append('# HELP %s %s.' % (name, desc))
+            lines.append('# TYPE %s gauge' % name)
+            for stats in self.results:
+                value = getattr(stats, attr)
+                if value is not None:
+                    lines.append('%s{table="%s",phase="%s"} %s'
+                                 % (name, stats.table, stats.phase, value))
+
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as fd:
+            fd.write('\n'.join(lines))
+            fd.write('\n')
+        os.rename(tmpname, self.filename)
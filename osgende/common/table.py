@@ -64,6 +64,19 @@ class TableSource:
         """
         return self.data.c
 
+    @property
+    def sources(self):
+        """ Return the list of tables this table is derived from. MapDB
+            uses the list to decide which tables may be processed in
+            parallel. Tables may be given as table sources or as
+            SQLAlchemy tables.
+
+            The default is None, meaning that the sources are unknown.
+            MapDB then processes the table strictly in order. Derived
+            classes must list all tables they read from.
+        """
+        return None
+
     @property
     def cc(self):
         """ Return the columns of the change table.
@@ -19,14 +19,31 @@ Helper classes for multi-threaded execution.
 """
 
 import logging
+import functools
 import threading
+import multiprocessing
+from multiprocessing.reduction import ForkingPickler
 try:
     import queue
 except ImportError:
     import Queue as queue
 
+from osgende.common.stats import get_stats
+
 log = logging.getLogger(__name__)
 
+def _reduce_memoryview(m):
+    return (memoryview, (m.tobytes(),))
+
+def _register_memoryview_pickling():
+    """ Binary data from the database (e.g. geometries) comes as
+        memoryviews, which cannot be pickled. Send them to worker
+        processes as bytes. The registration changes pickling for all
+        multiprocessing users of the process, so it is only done once
+        a process backend is actually set up.
+    """
+    ForkingPickler.register(memoryview, _reduce_memoryview)
+
 class WorkerError(Exception):
     """Raised when a worker thread unexpectedly dies."""
     pass
@@ -45,29 +62,58 @@ class WorkerQueue:
         worker thread, once it is set up and 'shutdownfunc' when the thread is
         ended properly (not when an exception occurs). If the queue is run in
         single-threaded mode, 'initfunc' is called immediately and 'shutdownfunc'
-        within finish().
-
+        within finish(). The return values of 'shutdownfunc' are returned
+        by finish().
+
+        If 'chunksize' is larger than 1, items are collected and handed to
+        the workers in lists of 'chunksize' items. This considerably reduces
+        the overhead of the queue when processing of a single item is cheap.
+        'batch_func' may then be given as a function that takes a list of
+        items and processes them all at once. Without it, 'process_func' is
+        called for each item of the chunk.
     """
 
     numthreads = 0
 
-    def __init__(self, process_func, numthreads=None, initfunc=None, shutdownfunc=None):
+    def __init__(self, process_func, numthreads=None, initfunc=None, shutdownfunc=None,
+                 chunksize=1, batch_func=None):
         if numthreads is not None:
             self.numthreads = numthreads
+
+        if chunksize > 1 or batch_func is not None:
+            self.chunksize = chunksize
+            self.chunk = []
+            if batch_func is None:
+                batch_func = functools.partial(_process_each, process_func)
+            task_func = batch_func
+        else:
+            self.chunk = None
+            task_func = process_func
+
         if self.numthreads == 0:
             # If we are in monothreading mode, simply execute
             # the processing function, when a new task is added
-            self.add_task = process_func
+            self._submit = task_func
             if initfunc is not None:
                 initfunc()
             self.shutdownfunc = shutdownfunc
         else:
-            self._setup_threads(process_func, initfunc, shutdownfunc)
+            self._submit = self._put_task
+            self._setup_threads(task_func, initfunc, shutdownfunc)
 
+        # add_task(data) adds an item to be processed to the queue.
+        self.add_task = self._submit if self.chunk is None else self._add_to_chunk
 
-    def add_task(self, data):
-        """Add an item to be processed to the queue.
-        """
+
+    def _add_to_chunk(self, data):
+        self.chunk.append(data)
+        if len(self.chunk) >= self.chunksize:
+            chunk = self.chunk
+            self.chunk = []
+            self._submit(chunk)
+
+
+    def _put_task(self, data):
         while True:
             try:
                 self.queue.put(data, True, 2)
@@ -91,24 +137,39 @@ class WorkerQueue:
            will be deleted before the threads are killed. You should set
            this to true in case of a fatal error where your threads may
            not consume any data anymore.
+
+           Returns a list with the results of the shutdown function
+           of each worker.
         """
+        if self.chunk:
+            chunk = self.chunk
+            self.chunk = []
+            if not flush:
+                self._submit(chunk)
+
         if self.numthreads == 0:
-            if self.shutdownfunc is not None:
-                self.shutdownfunc()
-        else:
-            if flush:
-                while not self.queue.empty():
-                    try:
-                        self.queue.get(False)
-                    except queue.Empty:
-                        pass # don't care
-
-            for i in range(self.numthreads):
-                self.queue.put(None)
-            log.debug("Waiting for threads to finish")
-            for w in self.workers:
-                w.join()
+            if self.shutdownfunc is None:
+                return [None]
+            return [self.shutdownfunc()]
+
+        return self._stop_workers(flush)
+
 
+    def _stop_workers(self, flush):
+        if flush:
+            while not self.queue.empty():
+                try:
+                    self.queue.get(False)
+                except queue.Empty:
+                    pass # don't care
+
+        for i in range(self.numthreads):
+            self.queue.put(None)
+        log.debug("Waiting for threads to finish")
+        for w in self.workers:
+            w.join()
+
+        return [w.result for w in self.worker_objects]
 
 
     def _setup_threads(self, process_func, initfunc, shutdownfunc):
@@ -116,23 +177,130 @@ class WorkerQueue:
         self.queue = queue.Queue(10*self.numthreads)
 
         self.workers = []
+        self.worker_objects = []
         for i in range(self.numthreads):
             worker = _WorkerThread(self.queue, process_func, initfunc, shutdownfunc)
             worker_thread = threading.Thread(target=worker.loop)
             worker_thread.daemon = True
             worker_thread.start()
             self.workers.append(worker_thread)
+            self.worker_objects.append(worker)
+
+
+class ProcessWorkerQueue(WorkerQueue):
+    """ A WorkerQueue that uses a pool of processes instead of threads.
+
+        Use this queue for CPU-intensive tasks which do not scale with
+        threads because of the GIL. The processes are forked when the queue
+        is created, so that they see the state of the program at that
+        point. Any items that are added to the queue must be picklable.
+        Results can be communicated back through the database or
+        the return value of the shutdown function, which must be
+        picklable as well. Use chunking to keep the cost of sending
+        the items low.
+
+        When 'numthreads' is 0, the tasks are executed directly as with the
+        thread-based WorkerQueue.
+
+        'stats' may be the TableStats object of the engine used by the
+        workers. The SQL time and row counts collected in the worker
+        processes are then added to it when the queue is finished.
+    """
+
+    def __init__(self, *args, stats=None, **kwargs):
+        self.stats = stats
+        super().__init__(*args, **kwargs)
+
+    def _put_task(self, data):
+        while True:
+            try:
+                self.queue.put(data, True, 2)
+                break
+            except queue.Full:
+                # check that all our processes are still alive
+                for w in self.workers:
+                    if not w.is_alive():
+                        log.critical("Internal error. Process died. Killing other processes.")
+                        self.finish(True)
+                        raise WorkerError("Internal error. Process died.")
+
+    def _stop_workers(self, flush):
+        if flush:
+            while True:
+                try:
+                    self.queue.get(False)
+                except queue.Empty:
+                    break
+
+        for w in self.workers:
+            if w.is_alive():
+                self.queue.put(None)
+
+        # Results must be read before joining, otherwise the processes
+        # may block on sending them.
+        log.debug("Waiting for processes to finish")
+        results = []
+        while len(results) < len(self.workers):
+            try:
+                result, counters = self.results.get(True, 2)
+            except queue.Empty:
+                if not any((w.is_alive() for w in self.workers)):
+                    break
+            else:
+                results.append(result)
+                if counters is not None:
+                    self.stats.add_query(*counters)
+
+        for w in self.workers:
+            w.join()
+
+        if not flush:
+            for w in self.workers:
+                if w.exitcode != 0:
+                    raise WorkerError("Worker process exited with code %d."
+                                      % w.exitcode)
+
+        return results
+
+    def _setup_threads(self, process_func, initfunc, shutdownfunc):
+        log.info("Using %d parallel processes.", self.numthreads)
+        _register_memoryview_pickling()
+        ctx = multiprocessing.get_context('fork')
+        self.queue = ctx.Queue(10*self.numthreads)
+        self.results = ctx.Queue()
+
+        self.workers = []
+        for i in range(self.numthreads):
+            worker = _WorkerThread(self.queue, process_func, initfunc, shutdownfunc,
+                                   self.results, self.stats)
+            worker_proc = ctx.Process(target=worker.loop)
+            worker_proc.daemon = True
+            worker_proc.start()
+            self.workers.append(worker_proc)
+
+
+def _process_each(process_func, items):
+    for item in items:
+        process_func(item)
 
 
 class _WorkerThread:
 
-    def __init__(self, queue, process_func, initfunc, shutdownfunc):
+    def __init__(self, queue, process_func, initfunc, shutdownfunc,
+                 result_queue=None, stats=None):
         self.queue = queue
         self.process_func = process_func
         self.initfunc = initfunc
         self.shutdownfunc = shutdownfunc
+        self.result_queue = result_queue
+        self.stats = stats
+        self.result = None
 
     def loop(self):
+        if self.stats is not None:
+            # Forked copy of the parent's statistics. Count only the
+            # work of this process and send it back when done.
+            self.stats.reset_counters()
         self.initfunc()
 
         while True:
@@ -141,16 +309,30 @@ class _WorkerThread:
                 break
 
             self.process_func(req)
-            self.queue.task_done()
+            if hasattr(self.queue, 'task_done'):
+                self.queue.task_done()
 
-        self.shutdownfunc()
+        self.result = self.shutdownfunc()
+        if self.result_queue is not None:
+            counters = None if self.stats is None else self.stats.counters()
+            self.result_queue.put((self.result, counters))
 
 
 class ThreadableDBObject(object):
-    """
+    """ Mixin for objects that process data in parallel with a pool of
+        workers. Each worker has its own connection to the database.
+
+        The workers may either be threads (backend 'thread', the default)
+        or processes (backend 'process'). Processes should be used when
+        processing is mostly CPU-bound in Python. Processes are forked,
+        so the process backend must not be used while other threads
+        are running, in particular not together with the parallel_tables
+        option of MapDB.
     """
 
     numthreads = None
+    worker_backend = 'thread'
+    chunksize = 1
 
     def set_num_threads(self, num):
         """Set the number of worker threads to use when processing the
@@ -163,12 +345,52 @@ class ThreadableDBObject(object):
         self.numthreads = num
 
 
-    def create_worker_queue(self, engine, processfunc):
+    def set_chunk_size(self, num):
+        """Set the number of items that are handed to a worker at once.
+           The default of 1 disables chunking.
+        """
+        self.chunksize = num
+
+
+    def set_worker_backend(self, backend):
+        """Choose the kind of workers to use for parallel processing.
+           Must be either 'thread' or 'process'.
+        """
+        if backend not in ('thread', 'process'):
+            raise RuntimeError("Unknown worker backend '%s'." % backend)
+        self.worker_backend = backend
+
+
+    def create_worker_queue(self, engine, processfunc, batchfunc=None):
+        """Create a new queue of workers. 'processfunc' processes a single
+           item. If 'batchfunc' is given, then it is used instead to
+           process a whole chunk of items at once.
+        """
         self.thread = threading.local()
         self.worker_engine = engine
+        if self.worker_backend == 'process' and self.numthreads:
+            return ProcessWorkerQueue(processfunc, self.numthreads,
+                                      self._init_worker_process,
+                                      self._shutdown_worker_thread,
+                                      chunksize=self.chunksize,
+                                      batch_func=batchfunc,
+                                      stats=get_stats(engine))
+
         return WorkerQueue(processfunc, self.numthreads,
                              self._init_worker_thread,
-                             self._shutdown_worker_thread)
+                             self._shutdown_worker_thread,
+                             chunksize=self.chunksize, batch_func=batchfunc)
+
+    def _init_worker_process(self):
+        # Connections of the parent process must not be used in the
+        # forked worker. Give the engine a new pool but keep its
+        # configuration, execution options and event listeners.
+        # The old pool is kept alive, so that its connections are
+        # not closed from within the worker.
+        engine = self.worker_engine
+        self._parent_pool = engine.pool
+        engine.pool = engine.pool.recreate()
+        self._init_worker_thread()
 
     def _init_worker_thread(self):
         log.debug("Initialising worker...")
@@ -0,0 +1,62 @@
+# This file is part of Osgende
+# Copyright (C) 2018 Sarah Hoffmann
+#
+# This is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""
+Disjoint set data structure.
+"""
+
+class UnionFind(object):
+    """ Disjoint set of consecutively numbered elements.
+    """
+
+    def __init__(self):
+        self.parents = []
+
+    def add(self):
+        """ Add a new element and return its number.
+        """
+        self.parents.append(len(self.parents))
+        return len(self.parents) - 1
+
+    def find(self, i):
+        parents = self.parents
+        root = i
+        while parents[root] != root:
+            root = parents[root]
+        # path compression
+        while parents[i] != root:
+            parents[i], i = root, parents[i]
+        return root
+
+    def union(self, i, j):
+        ri = self.find(i)
+        rj = self.find(j)
+        if ri != rj:
+            # the smaller number wins, so that the root of a set
+            # is always its first element
+            if ri < rj:
+                self.parents[rj] = ri
+            else:
+                self.parents[ri] = rj
+
+    def sets(self):
+        """ Return the sets as lists of element numbers. The sets are
+            ordered by their first element.
+        """
+        ret = {}
+        for i in range(len(self.parents)):
+            ret.setdefault(self.find(i), []).append(i)
+        return [ret[k] for k in sorted(ret)]
@@ -17,6 +17,7 @@
 
 from osgende.common.table import TableSource
 import sqlalchemy as sa
+from sqlalchemy.sql.util import find_tables
 from osgende.common.sqlalchemy import DropIndexIfExists, CreateView
 
 class FilteredTable(TableSource):
@@ -45,6 +46,12 @@ class FilteredTable(TableSource):
         self.subset = subset
         self.src = source
 
+    @property
+    def sources(self):
+        """ The source table and all tables referenced in the subset.
+        """
+        return [self.src] + find_tables(self.subset)
+
     def create_view(self, engine):
         sql = self.src.data.select().where(self.subset)
         engine.execute(CreateView(self.data, sql))
@@ -28,6 +28,11 @@ class TransformedTable(ThreadableDBObject, TableSource):
 
         This is an incomplete table that needs to be subclassed. Define
         two functions: add_columns() and transform()
+
+        During construction, rows are handed to the workers in chunks and
+        each chunk is written with a single multi-row insert. The size of
+        the chunks is taken from the 'chunk_size' key in the info dict
+        of the MetaData object.
     """
 
     def __init__(self, meta, name, source):
@@ -41,11 +46,17 @@ class TransformedTable(ThreadableDBObject, TableSource):
         super().__init__(table, name + "_changeset")
 
         self.src = source
+        self.set_chunk_size(meta.info.get('chunk_size', 100))
+
+    @property
+    def sources(self):
+        return [self.src]
 
     def construct(self, engine):
         sql = self.src.data.select()
         res = engine.execution_options(stream_results=True).execute(sql)
-        workers = self.create_worker_queue(engine, self._process_construct_next)
+        workers = self.create_worker_queue(engine, self._process_construct_next,
+                                           self._process_construct_batch)
 
         for obj in res:
             workers.add_task(obj)
@@ -117,3 +128,17 @@ class TransformedTable(ThreadableDBObject, TableSource):
             cols['id'] = obj['id']
             self.thread.conn.execute(self.data.insert().values(cols))
 
+    def _process_construct_batch(self, objs):
+        rows = []
+        for obj in objs:
+            cols = self.transform(obj)
+            if cols is not None:
+                cols['id'] = obj['id']
+                rows.append(cols)
+
+        if rows:
+            # A multi-row insert needs the same columns in all rows.
+            cols = set().union(*rows)
+            rows = [{c: r.get(c) for c in cols} for r in rows]
+            self.thread.conn.execute(self.data.insert().values(rows))
+
@@ -17,9 +17,55 @@
 
 from osgende.common.table import TableSource
 from osgende.common.sqlalchemy import DropIndexIfExists
+from osgende.common.copywriter import CopyWriter
+from osgende.common.unionfind import UnionFind
 from sqlalchemy.dialects.postgresql import ARRAY, insert
 
 import sqlalchemy as sa
+import numpy
+
+def _hashable(value):
+    """ Convert a column value into a hashable object.
+    """
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted([(k, _hashable(v)) for k, v in value.items()])))
+    if isinstance(value, list):
+        return ('list', tuple([_hashable(v) for v in value]))
+    return value
+
+
+def _connected_ways(ways):
+    """ Group a list of (id, nodes) tuples into lists of ways that are
+        connected via common nodes. Ways that have no neighbours are
+        omitted. The first way in the result lists is always the
+        one that came first in the input.
+
+        The node ids of all ways are collected in a single array and
+        sorted, so that ways sharing a node end up next to each other.
+        This needs far less memory than a dictionary of nodes.
+    """
+    groups = UnionFind()
+    nodes = []
+    owners = []
+    for w in ways:
+        i = groups.add()
+        if w[1]:
+            nodes.extend(w[1])
+            owners.extend([i] * len(w[1]))
+
+    if nodes:
+        nodes = numpy.asarray(nodes, dtype=numpy.int64)
+        owners = numpy.asarray(owners, dtype=numpy.int64)
+        order = numpy.argsort(nodes, kind='stable')
+        nodes = nodes[order]
+        owners = owners[order]
+        shared = numpy.flatnonzero((nodes[1:] == nodes[:-1])
+                                   & (owners[1:] != owners[:-1]))
+        for k in shared:
+            groups.union(int(owners[k]), int(owners[k + 1]))
+
+    return [[ways[i][0] for i in s] for s in groups.sets() if len(s) > 1]
+
 
 class GroupedWayTable(TableSource):
     """ Table that groups ways of the source table and assigns them
@@ -40,6 +86,10 @@ class GroupedWayTable(TableSource):
         self.rows = rows
         self.src = source
 
+    @property
+    def sources(self):
+        return [self.src]
+
     def _select_src(self):
         rows = [self.src.c[r] for r in self.rows]
         rows.extend((self.src.c.id, self.src.c.nodes))
@@ -48,28 +98,47 @@ class GroupedWayTable(TableSource):
 
     def construct(self, engine):
         """ Create full table content from the source table.
+
+            The source is read once ordered by the grouping properties.
+            Each set of ways with the same properties is then split into
+            connected groups in memory.
         """
         self.truncate(engine)
 
-        done = set()
         with engine.begin() as conn:
-            cur = conn.execution_options(stream_results=True).execute(self._select_src())
-
+            sql = self._select_src()\
+                    .order_by(*[self.src.c[r] for r in self.rows])\
+                    .order_by(self.src.c.id)
+            cur = conn.execution_options(stream_results=True).execute(sql)
+
+            writer = CopyWriter(conn, self.data)
+            properties = None
+            ways = []
             for obj in cur:
-                oid = obj['id']
-                if oid in done:
-                    # already has an id
-                    continue
-
-                done.update(self._insert_adjacent_ways((oid, obj['nodes']), obj,
-                                                       conn))
+                objprops = [obj[name] for name in self.rows]
+                if objprops != properties:
+                    self._write_groups(writer, ways)
+                    properties = objprops
+                    ways = []
+                ways.append((obj['id'], obj['nodes']))
+
+            self._write_groups(writer, ways)
+            writer.close()
+
+    def _write_groups(self, writer, ways):
+        """ Find the groups of connected ways in the given list of
+            (id, nodes) tuples and hand them to the writer. The id of
+            the first way is used as the id of the group.
+        """
+        for group in _connected_ways(ways):
+            for child in group:
+                writer.add({'id' : group[0], 'child' : child})
 
 
     def update(self, engine):
         with engine.begin() as conn:
             changes = {}
             todo = set()
-            done = set()
             # Remove all virtual IDs that are directly affected by the change.
             modsql = sa.select([self.c.id], distinct=True)\
                          .where(self.c.child.in_(self.src.select_modify_delete())).alias()
@@ -80,89 +149,110 @@ class GroupedWayTable(TableSource):
                 changes[row[0]] = 'D'
                 todo.add(row[1])
 
-            # Insert added ways
+            # Ways that need to be regrouped: first added and modified ways,
+            # then the remaining ways from the removed groups. The order
+            # determines the ids of newly created groups.
+            ways = {}
+            seeds = []
             addsql = self._select_src()\
                        .where(self.src.c.id.in_(self.src.select_add_modify()))
-            cur = engine.execution_options(stream_results=True).execute(addsql)
-
-            for obj in cur:
-                oid = obj['id']
-                if oid in done:
-                    # already has an id
+            for obj in conn.execute(addsql):
+                ways[obj['id']] = (self._property_key(obj), obj['nodes'])
+                seeds.append(obj['id'])
+
+            missing = [oid for oid in todo if oid not in ways]
+            if missing:
+                sql = self._select_src().where(self.src.c.id.in_(missing))
+                for obj in conn.execute(sql):
+                    ways[obj['id']] = (self._property_key(obj), obj['nodes'])
+                seeds.extend([oid for oid in missing if oid in ways])
+
+            self._load_adjacent_ways(conn, ways)
+
+            # Compute the groups separately for each set of properties.
+            by_key = {}
+            for oid, (key, nodes) in ways.items():
+                by_key.setdefault(key, []).append((oid, nodes))
+            groups = {}
+            for keyways in by_key.values():
+                for group in _connected_ways(keyways):
+                    for oid in group:
+                        groups[oid] = group
+
+            # Find out which of the groups contain ways of existing groups.
+            existing = {}
+            if groups:
+                sql = sa.select([self.c.id, self.c.child])\
+                        .where(self.c.child.in_(list(groups.keys())))
+                for row in conn.execute(sql):
+                    existing[row['child']] = row['id']
+
+            rows = []
+            done = set()
+            for seed in seeds:
+                if seed in done or seed not in groups:
                     continue
 
-                done.update(self._insert_adjacent_ways((oid, obj['nodes']), obj,
-                                                       conn, changes))
-
-            # Insert modified ways
-            for oid in todo:
-                if oid in done:
-                    continue
+                group = groups[seed]
+                done.update(group)
+                old_ids = set([existing[c] for c in group if c in existing])
+                if old_ids:
+                    # Extend the existing group. If multiple groups have
+                    # been connected, the one with the smallest id survives.
+                    base_id = min(old_ids)
+                    changes[base_id] = 'M'
+                    for i in old_ids:
+                        if i != base_id:
+                            changes[i] = 'D'
+                else:
+                    base_id = seed
+                    changes[base_id] = 'M' if base_id in changes else 'A'
 
-                cur = conn.execute(self._select_src().where(self.src.c.id == oid))
+                rows.extend([{'id': base_id, 'child': x} for x in group])
 
-                for obj in cur:
-                    done.update(self._insert_adjacent_ways((oid, obj['nodes']), obj,
-                                                           conn, changes))
+            if rows:
+                sql = insert(self.data)\
+                        .on_conflict_do_update(index_elements=[self.c.child],
+                                               set_={'id' : sa.text('EXCLUDED.id')})
+                conn.execute(sql.values(rows))
 
             # finally fill the changeset table
             self.write_change_table(conn, changes)
 
-
-    def _insert_adjacent_ways(self, base, obj, conn, changes=None):
-        """ Find all ways adjacent to the one given in baseid iteratively
-            (sharing at least one node and all properties)
-            It checks for directly adjacent ways and repeats this procedure
-            for all found ways until all indirectly adjacent ways are found
+    def _property_key(self, obj):
+        """ Return a hashable representation of the grouping properties
+            of the given source row.
         """
-        properties = [obj[name] for name in self.rows]
-        unchecked_ways = [base]
-        all_adjacent_ways = [base[0]]
-        done_ways = set((base[0],))
-
-        while unchecked_ways:
-            wid, wnodes = unchecked_ways.pop()
-
-            s = self.src.data
-            intersecting_ways = self._select_src()\
-                                 .where(s.c.nodes.overlap(sa.cast(wnodes, ARRAY(sa.BigInteger))))\
-                                 .where(s.c.id.notin_(done_ways))
-
-            for candidate in conn.execute(intersecting_ways):
-                done_ways.add(candidate['id'])
-                for k, v in zip(self.rows, properties):
-                    if candidate[k] != v:
-                        break
-                else:
-                    all_adjacent_ways.append(candidate['id'])
-                    unchecked_ways.append((candidate['id'], candidate['nodes']))
-
-        # only insert ways that have neighbours
-        if len(all_adjacent_ways) <= 1:
-            return []
-
-        if changes is not None:
-            # Figure out if there is an existing group or we have even
-            # combined two groups.
-            res = conn.execute(sa.select([self.c.id], distinct=True)
-                                 .where(self.c.child.in_(all_adjacent_ways)))
-            if res.rowcount > 0:
-                base_id = res.fetchone()[0]
-                changes[base_id] = 'M'
-                for i in res:
-                    changes[i[0]] = 'D'
-
-                sql = insert(self.data)\
-                        .on_conflict_do_update(index_elements=[self.c.child],
-                                               set_={'id' : sa.text('EXCLUDED.id')})\
-                        .values([{'id': base_id, 'child': x} for x in all_adjacent_ways])
-
-                conn.execute(sql)
-                return [base_id] + all_adjacent_ways
-
-            changes[base[0]] = 'M' if base[0] in changes else 'A'
+        return tuple([_hashable(obj[name]) for name in self.rows])
 
+    def _load_adjacent_ways(self, conn, ways):
+        """ Add to `ways` all ways that are directly or indirectly adjacent
+            to ways in it and have the same properties. `ways` must be a
+            dict of way ids to a tuple of property key and node list.
 
-        conn.execute(self.data.insert(),
-                     [{'id': base[0], 'child': x} for x in all_adjacent_ways])
-        return all_adjacent_ways
+            The neighbourhood is searched level by level, so that only
+            one query per level is necessary.
+        """
+        key_nodes = {}
+        frontier = set()
+        for key, nodes in ways.values():
+            key_nodes.setdefault(key, set()).update(nodes)
+            frontier.update(nodes)
+
+        s = self.src.data
+        while frontier:
+            sql = self._select_src()\
+                    .where(s.c.nodes.overlap(sa.cast(list(frontier), ARRAY(sa.BigInteger))))
+            frontier = set()
+            for obj in conn.execute(sql):
+                if obj['id'] in ways:
+                    continue
+                key = self._property_key(obj)
+                nodes = key_nodes.get(key)
+                # A way that only touches a way found in the same round is
+                # rejected for now but will be found again in the next one.
+                if nodes is None or nodes.isdisjoint(obj['nodes']):
+                    continue
+                ways[obj['id']] = (key, obj['nodes'])
+                nodes.update(obj['nodes'])
+                frontier.update(obj['nodes'])
@@ -15,15 +15,20 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
+import numpy
 from osgende.common.table import TableSource
 from sqlalchemy.dialects.postgresql import ARRAY, array
 import sqlalchemy as sa
 from geoalchemy2 import Geometry
-from geoalchemy2.shape import from_shape, to_shape
+from geoalchemy2.elements import WKBElement
+from geoalchemy2.shape import from_shape
 from shapely.geometry import LineString
 
 from osgende.common.sqlalchemy import DropIndexIfExists
 from osgende.common.threads import ThreadableDBObject
+from osgende.common.copywriter import CopyWriter
+from osgende.common.nodestore import to_mercator_array
+from osgende.common.build_geometry import wkb_coords, linestring_wkb
 
 class PlainWayTable(ThreadableDBObject, TableSource):
     """Table that transforms columns and adds a LineString geometry column
@@ -40,6 +45,11 @@ class PlainWayTable(ThreadableDBObject, TableSource):
 
        This table creates its own changeset table which also takes into
        account changes to the geometry.
+
+       When constructing the table from scratch, rows are collected by
+       each worker and written out in batches using COPY. The size of
+       the batches can be set with the 'copy_batch_size' key in the
+       info dict of the MetaData object.
     """
 
     def __init__(self, meta, name, source, osmdata):
@@ -59,6 +69,19 @@ class PlainWayTable(ThreadableDBObject, TableSource):
         self.src = source
 
         self.set_num_threads(meta.info.get('num_threads', 1))
+        self.set_worker_backend(meta.info.get('worker_backend', 'thread'))
+        self.set_chunk_size(meta.info.get('chunk_size', 500))
+        self.set_batch_size(meta.info.get('copy_batch_size', 10000))
+
+    def set_batch_size(self, num):
+        """Set the number of rows that are collected by a worker before
+           they are written to the database during construction.
+        """
+        self.batch_size = num
+
+    @property
+    def sources(self):
+        return [self.src, self.osmdata.node]
 
     @property
     def srid(self):
@@ -84,7 +107,8 @@ class PlainWayTable(ThreadableDBObject, TableSource):
         # insert
         sql = self.src.data.select()
         res = engine.execution_options(stream_results=True).execute(sql)
-        workers = self.create_worker_queue(engine, self._process_construct_next)
+        workers = self.create_worker_queue(engine, self._process_construct_next,
+                                           self._process_construct_batch)
         for obj in res:
             workers.add_task(obj)
 
@@ -95,30 +119,59 @@ class PlainWayTable(ThreadableDBObject, TableSource):
 
 
     def _process_construct_next(self, obj):
-        cols = self._construct_row(obj, self.thread.conn)
+        self._process_construct_batch([obj])
+
+    def _process_construct_batch(self, objs):
+        for cols in self._construct_rows(objs, self.thread.conn):
+            self.thread.writer.add(cols)
+
+    def _init_worker_thread(self):
+        super()._init_worker_thread()
+        self.thread.writer = CopyWriter(self.thread.conn, self.data,
+                                        batch_size=self.batch_size)
 
-        if cols is not None:
-            self.thread.conn.execute(self.data.insert().values(cols))
+    def _shutdown_worker_thread(self):
+        self.thread.writer.close()
+        super()._shutdown_worker_thread()
 
 
     def _construct_row(self, obj, conn):
-        cols = self.transform_tags(obj)
-        if cols is None:
-            return None
+        rows = self._construct_rows([obj], conn)
+        return rows[0] if rows else None
+
+
+    def _construct_rows(self, objs, conn):
+        """ Create the table rows for a list of source objects. Objects
+            that are filtered out or have no valid geometry are skipped.
+        """
+        todo = []
+        for obj in objs:
+            cols = self.transform_tags(obj)
+            if cols is not None:
+                todo.append((obj, cols))
+
+        if not todo:
+            return []
+
+        pointlists = self.osmdata.get_points_bulk([o['nodes'] for o, _ in todo],
+                                                  conn)
+
+        rows = []
+        for (obj, cols), points in zip(todo, pointlists):
+            if len(points) <= 1:
+                continue
 
-        points = self.osmdata.get_points(obj['nodes'], conn)
-        if len(points) <= 1:
-            return None
+            if self.srid == 3857:
+                points = to_mercator_array(points)
 
-        if self.srid == 3857:
-            points = [p.to_mercator() for p in points]
+            cols['geom'] = from_shape(LineString(points), srid=self.srid)
 
-        cols['geom'] = from_shape(LineString(points), srid=self.srid)
+            cols['id'] = obj['id']
+            cols['nodes'] = obj['nodes']
 
-        cols['id'] = obj['id']
-        cols['nodes'] = obj['nodes']
+            rows.append(cols)
 
-        return cols
+        return rows
 
 
     def transform_tags(self, obj):
@@ -153,7 +206,7 @@ class PlainWayTable(ThreadableDBObject, TableSource):
 
         cols = [s]
         for c in d.columns:
-            if c.name not in ('id', 'nodes'):
+            if c.name != 'id':
                 cols.append(c.label('old_' + c.name))
 
         # modified ways
@@ -174,45 +227,58 @@ class PlainWayTable(ThreadableDBObject, TableSource):
         deleted = []
         inserts = []
         changeset = {}
-        for obj in conn.execute(sql):
-            oid = obj['id']
-            is_added = obj['old_geom'] is None
-            changed = False
-
-            cols = self.transform_tags(obj)
-            if cols is None:
-                # if there is no old obejct info, then the object wasn't
-                # there before and is not now
-                if not is_added:
-                    deleted.append({'oid' : oid})
-                    changeset[oid] = 'D'
-                continue
-
-            changed = False
-            for k, v in cols.items():
-                if str(obj['old_' + k]) != str(v):
-                    changed = True
-                    break
-
-            points = self.osmdata.get_points(obj['nodes'], conn)
-            if len(points) <= 1:
-                if not is_added:
-                    deleted.append({'oid': oid})
-                    changeset[oid] = 'D'
-                continue
-
-            if self.srid == 3857:
-                points = [p.to_mercator() for p in points]
-
-            new_geom = LineString(points)
-            cols['geom'] = from_shape(new_geom, srid=self.srid)
-            changed = changed or is_added or (new_geom != to_shape(obj['old_geom']))
-
-            if changed:
-                cols['nodes'] = obj['nodes']
-                cols['id'] = oid
-                inserts.append(cols)
-                changeset[oid] = 'A' if is_added else 'M'
+        res = conn.execute(sql)
+        while True:
+            objs = res.fetchmany(self.chunksize)
+            if not objs:
+                break
+
+            todo = []
+            for obj in objs:
+                cols = self.transform_tags(obj)
+                if cols is None:
+                    # if there is no old obejct info, then the object wasn't
+                    # there before and is not now
+                    if obj['old_geom'] is not None:
+                        deleted.append({'oid' : obj['id']})
+                        changeset[obj['id']] = 'D'
+                    continue
+                todo.append((obj, cols))
+
+            transform = to_mercator_array if self.srid == 3857 else None
+            old_coords = [None if o['old_geom'] is None
+                          else wkb_coords(o['old_geom']) for o, _ in todo]
+            pointlists = self.osmdata.patch_points_bulk(
+                            [(o['old_nodes'], c, o['nodes'])
+                             for (o, _), c in zip(todo, old_coords)],
+                            conn, transform)
+
+            for (obj, cols), points, old_points \
+                    in zip(todo, pointlists, old_coords):
+                oid = obj['id']
+                is_added = old_points is None
+
+                changed = False
+                for k, v in cols.items():
+                    if str(obj['old_' + k]) != str(v):
+                        changed = True
+                        break
+
+                if len(points) <= 1:
+                    if not is_added:
+                        deleted.append({'oid': oid})
+                        changeset[oid] = 'D'
+                    continue
+
+                changed = changed or is_added \
+                           or not numpy.array_equal(points, old_points)
+                if changed:
+                    cols['geom'] = WKBElement(linestring_wkb(points),
+                                              srid=self.srid)
+                    cols['nodes'] = obj['nodes']
+                    cols['id'] = oid
+                    inserts.append(cols)
+                    changeset[oid] = 'A' if is_added else 'M'
 
         if len(inserts):
             conn.execute(self.upsert_data().values(inserts))
@@ -15,16 +15,21 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
+import numpy
 import sqlalchemy as sa
-from sqlalchemy.dialects.postgresql import ARRAY, array_agg, array
+from sqlalchemy.dialects.postgresql import ARRAY, array_agg, array, aggregate_order_by
 from geoalchemy2 import Geometry
-from geoalchemy2.shape import from_shape, to_shape
+from geoalchemy2.elements import WKBElement
+from geoalchemy2.shape import from_shape
 import shapely.geometry as sgeom
 
 from osgende.common.table import TableSource
-from osgende.common.sqlalchemy import CreateView, jsonb_array_elements, DropIndexIfExists, Truncate
+from osgende.common.sqlalchemy import CreateView, CreateTableAs, DropIndexIfExists, Truncate, Analyse
 from osgende.common.tags import TagStore
 from osgende.common.threads import ThreadableDBObject
+from osgende.common.nodestore import to_mercator_array
+from osgende.common.build_geometry import wkb_coords, linestring_wkb
+from osgende.osmdata import select_relation_members
 
 
 class RelationWayTable(ThreadableDBObject, TableSource):
@@ -48,10 +53,15 @@ class RelationWayTable(ThreadableDBObject, TableSource):
         ways that have been directly or indirectly modified.
 
         The table creates an additional view on the relation table
-        of the relation-way relationship."
+        of the relation-way relationship. With `materialize_view` set,
+        a real table with indexes on both columns is created instead.
+        It is filled during construction and updated from the
+        relation change table, so that lookups of memberships do not
+        need to expand the members of all relations.
     """
 
-    def __init__(self, meta, name, way_src, relation_src, osmdata=None):
+    def __init__(self, meta, name, way_src, relation_src, osmdata=None,
+                 materialize_view=False):
         table = sa.Table(name, meta,
                            sa.Column('id', sa.BigInteger,
                                      primary_key=True, autoincrement=False),
@@ -78,8 +88,20 @@ class RelationWayTable(ThreadableDBObject, TableSource):
         self.relway_view = sa.Table(name + '_relation_way_view', meta,
                                       sa.Column('relation_id', sa.BigInteger),
                                       sa.Column('way_id', sa.BigInteger))
+        self.materialize_view = materialize_view
+        if materialize_view:
+            sa.Index(name + '_relation_way_view_relation_idx',
+                     self.relway_view.c.relation_id)
+            sa.Index(name + '_relation_way_view_way_idx',
+                     self.relway_view.c.way_id)
 
         self.set_num_threads(meta.info.get('num_threads', 1))
+        self.set_worker_backend(meta.info.get('worker_backend', 'thread'))
+        self.set_chunk_size(meta.info.get('chunk_size', 500))
+
+    @property
+    def sources(self):
+        return [self.way_src, self.relation_src]
 
     @property
     def srid(self):
@@ -89,18 +111,47 @@ class RelationWayTable(ThreadableDBObject, TableSource):
         self.data.create(bind=engine, checkfirst=True)
         self.change.create(bind=engine, checkfirst=True)
 
-        rels = self.relation_src.data.alias('r')
-        members = jsonb_array_elements(rels.c.members).lateral()
+        if self.materialize_view:
+            self.relway_view.create(bind=engine, checkfirst=True)
+        else:
+            engine.execute(CreateView(self.relway_view.key,
+                                      self._select_relation_ways()))
 
-        sql = sa.select([rels.c.id.label('relation_id'),
-                         members.c.value['id'].astext.cast(sa.BigInteger).label('way_id')]
-                       ).select_from(rels.join(members, onclause=sa.text("True")))\
-                    .where(members.c.value['type'].astext == 'W')
+    def _select_relation_ways(self, relations=None):
+        """ Return a query for the relation-way relationship. If
+            `relations` is given, only the members of these relations
+            are returned.
+        """
+        members = select_relation_members(self.relation_src, 'W', relations)\
+                    .alias('members')
+
+        return sa.select([members.c.relation_id,
+                          members.c.member_id.label('way_id')])
+
+    def _construct_relation_ways(self, engine):
+        r = self.relway_view
+        engine.execute(Truncate(r))
+        for idx in r.indexes:
+            engine.execute(DropIndexIfExists(idx))
 
-        engine.execute(CreateView(self.relway_view.key, sql))
+        engine.execute(r.insert().from_select(r.c, self._select_relation_ways()))
+
+        for idx in r.indexes:
+            idx.create(engine)
+        engine.execute(Analyse(r))
+
+    def _update_relation_ways(self, engine):
+        r = self.relway_view
+        with engine.begin() as conn:
+            conn.execute(r.delete().where(r.c.relation_id.in_(
+                                   sa.select([self.relation_src.cc.id]))))
+            sql = self._select_relation_ways(self.relation_src.select_add_modify())
+            conn.execute(r.insert().from_select(r.c, sql))
 
     def construct(self, engine):
         self.truncate(engine)
+        if self.materialize_view:
+            self._construct_relation_ways(engine)
 
         # manual indexes
         relidx = sa.Index(self.data.name + "_rels_idx",
@@ -124,7 +175,8 @@ class RelationWayTable(ThreadableDBObject, TableSource):
         sql = sa.select(cols).where(w.c.id == sub.c.way_id)
 
         res = engine.execution_options(stream_results=True).execute(sql)
-        workers = self.create_worker_queue(engine, self._process_construct_next)
+        workers = self.create_worker_queue(engine, self._process_construct_next,
+                                           self._process_construct_batch)
         for obj in res:
             workers.add_task(obj)
 
@@ -135,6 +187,8 @@ class RelationWayTable(ThreadableDBObject, TableSource):
         ndsidx.create(engine)
 
     def update(self, engine):
+        if self.materialize_view:
+            self._update_relation_ways(engine)
         # first pass: handle changed ways and nodes
         changeset = self._update_handle_changed_ways(engine)
         # second pass: handle changed relations
@@ -180,50 +234,69 @@ class RelationWayTable(ThreadableDBObject, TableSource):
         inserts = []
         deletes = []
         changeset = {}
-        for obj in engine.execute(sql):
-            oid = obj['id']
-            if obj['new_nodes'] is None:
-                deletes.append({'oid' : oid})
-                changeset[oid] = 'D'
-                continue
-            changed = False
-            if with_tags:
-                cols = self.transform_tags(oid, TagStore(obj['new_tags']))
-                if cols is None:
+        res = engine.execute(sql)
+        while True:
+            objs = res.fetchmany(self.chunksize)
+            if not objs:
+                break
+
+            todo = []
+            for obj in objs:
+                oid = obj['id']
+                if obj['new_nodes'] is None:
                     deletes.append({'oid' : oid})
                     changeset[oid] = 'D'
                     continue
-                # check if there are actual tag changes
-                for k, v in cols.items():
-                    if str(obj[k]) != str(v):
-                        changed = True
-                        break
-            else:
-                cols = {}
+                changed = False
+                if with_tags:
+                    cols = self.transform_tags(oid, TagStore(obj['new_tags']))
+                    if cols is None:
+                        deletes.append({'oid' : oid})
+                        changeset[oid] = 'D'
+                        continue
+                    # check if there are actual tag changes
+                    for k, v in cols.items():
+                        if str(obj[k]) != str(v):
+                            changed = True
+                            break
+                else:
+                    cols = {}
+                todo.append((obj, cols, changed))
 
             # Always rebuild the geometry when with_geom as nodes might have
             # moved.
             if with_geom:
-                # TODO only look up new/changed nodes
-                points = self.osmdata.get_points(obj['new_nodes'], engine)
-                if len(points) <= 1:
-                    deletes.append({'oid' : oid})
-                    changeset[oid] = 'D'
-                    continue
-                if self.srid == 3857:
-                    points = [p.to_mercator() for p in points]
-                new_geom = sgeom.LineString(points)
-                cols['geom'] = from_shape(new_geom, srid=self.srid)
-                changed = changed or (new_geom != to_shape(obj['geom']))
-            elif obj['nodes'] != obj['new_nodes']:
-                changed = True
-
-            if changed:
-                cols['nodes'] = obj['new_nodes']
-                cols['id'] = oid
-                cols['rels'] = obj['rels']
-                inserts.append(cols)
-                changeset[oid] = 'M'
+                transform = to_mercator_array if self.srid == 3857 else None
+                old_coords = [wkb_coords(o['geom']) for o, _, _ in todo]
+                pointlists = self.osmdata.patch_points_bulk(
+                                [(o['nodes'], c, o['new_nodes'])
+                                 for (o, _, _), c in zip(todo, old_coords)],
+                                engine, transform)
+            else:
+                old_coords = pointlists = [None] * len(todo)
+
+            for (obj, cols, changed), points, old_points \
+                    in zip(todo, pointlists, old_coords):
+                oid = obj['id']
+                if with_geom:
+                    if len(points) <= 1:
+                        deletes.append({'oid' : oid})
+                        changeset[oid] = 'D'
+                        continue
+                    changed = changed or \
+                               not numpy.array_equal(points, old_points)
+                    if changed:
+                        cols['geom'] = WKBElement(linestring_wkb(points),
+                                                  srid=self.srid)
+                elif obj['nodes'] != obj['new_nodes']:
+                    changed = True
+
+                if changed:
+                    cols['nodes'] = obj['new_nodes']
+                    cols['id'] = oid
+                    cols['rels'] = obj['rels']
+                    inserts.append(cols)
+                    changeset[oid] = 'M'
 
         if len(inserts):
             engine.execute(self.upsert_data().values(inserts))
@@ -236,51 +309,74 @@ class RelationWayTable(ThreadableDBObject, TableSource):
 
 
     def _update_handle_changed_rels(self, engine):
+        """ Recompute the relation set of all ways that were or are members
+            of changed relations.
+
+            Memberships in unchanged relations are kept from the old
+            relation set, so that only the members of changed relations
+            need to be looked up.
+        """
         w = self.data
-        r = self.relation_src.data
-        rs = self.relway_view.alias('relsrc')
-
-        # Recreate the relation set for all ways in changed relations.
-        sub = sa.select([array_agg(r.c.id)])\
-                .where(r.c.members.contains(
-                         sa.func.jsonb_build_array(
-                           sa.func.jsonb_build_object('type', 'W', 'id', w.c.id))))
-        sql = sa.select([w.c.id, w.c.rels, sub.label('new_rels')])\
-                .where(sa.or_(
-                    w.c.id.in_(
-                         sa.select([rs.c.way_id]).
-                           where(rs.c.relation_id.in_(
-                               self.relation_src.select_add_modify()))),
-                    w.c.rels.op('&& ARRAY')(sa.select([self.relation_src.cc.id]))
-                           ))
+        rs = self.relway_view
+        changed = sa.select([self.relation_src.cc.id])
+
+        # way memberships of new and modified relations
+        newmembers = sa.select([rs.c.way_id, rs.c.relation_id])\
+                       .where(rs.c.relation_id.in_(
+                                self.relation_src.select_add_modify()))\
+                       .cte('newmembers')
+
+        # all ways whose relation set might change
+        ways = sa.select([w.c.id, w.c.rels])\
+                 .where(sa.or_(w.c.id.in_(sa.select([newmembers.c.way_id])),
+                               w.c.rels.op('&& ARRAY')(changed)))\
+                 .cte('ways')
+
+        oldrels = sa.select([ways.c.id.label('way_id'),
+                             sa.func.unnest(ways.c.rels).label('relation_id')])\
+                    .alias('oldrels')
+        memberships = sa.union(
+                        sa.select([oldrels.c.way_id, oldrels.c.relation_id])
+                          .where(oldrels.c.relation_id.notin_(changed)),
+                        sa.select([newmembers.c.way_id, newmembers.c.relation_id])
+                          .where(newmembers.c.way_id.in_(sa.select([ways.c.id])))
+                      ).alias('memberships')
+        newrels = sa.select([memberships.c.way_id,
+                             array_agg(aggregate_order_by(memberships.c.relation_id,
+                                                          memberships.c.relation_id))
+                               .label('rels')])\
+                    .group_by(memberships.c.way_id).alias('newrels')
+
+        # Ways that are no longer in any relation get a NULL set.
+        sql = sa.select([ways.c.id, newrels.c.rels])\
+                .select_from(ways.outerjoin(newrels, newrels.c.way_id == ways.c.id))
 
-        inserts = []
-        deletes = []
         changeset = {}
-        for obj in engine.execute(sql):
-            oid = obj['id']
-            # If the new set is empty, the way has been removed from the set.
-            if obj['new_rels'] is None:
-                deletes.append({'oid' : oid})
-                changeset[oid] = 'D'
-            # If the relation set differs, there was a relevant change.
-            # (Only update the way set here. geometry and tag changes have
-            #  already been done during the first pass.)
-            else:
-                rels = sorted(obj['new_rels'])
-                if rels != obj['rels']:
-                    inserts.append({'oid' : oid, 'rels' : rels})
-                    changeset[oid] = 'M'
-
-        if len(inserts):
-            engine.execute(self.data.update()
-                             .where(self.c.id == sa.bindparam('oid'))
-                             .values(rels=sa.bindparam('rels')), inserts)
-
-        if len(deletes):
-            engine.execute(self.data.delete()
-                            .where(self.c.id == sa.bindparam('oid')),
-                           deletes)
+        with engine.begin() as conn:
+            tmpname = '__temp_%s_rels' % self.data.name
+            conn.execute('DROP TABLE IF EXISTS %s' % tmpname)
+            conn.execute(CreateTableAs(tmpname, sql))
+            tmp = sa.Table(tmpname, sa.MetaData(),
+                           sa.Column('id', sa.BigInteger),
+                           sa.Column('rels', ARRAY(sa.BigInteger)))
+
+            # Only update the way set here. Geometry and tag changes have
+            # already been done during the first pass.
+            sql = w.update().values(rels=tmp.c.rels)\
+                   .where(w.c.id == tmp.c.id)\
+                   .where(tmp.c.rels.isnot(None))\
+                   .where(w.c.rels != tmp.c.rels)\
+                   .returning(w.c.id)
+            for row in conn.execute(sql):
+                changeset[row[0]] = 'M'
+
+            sql = w.delete().where(w.c.id == tmp.c.id)\
+                   .where(tmp.c.rels.is_(None))\
+                   .returning(w.c.id)
+            for row in conn.execute(sql):
+                changeset[row[0]] = 'D'
+
+            conn.execute('DROP TABLE %s' % tmpname)
 
         return changeset
 
@@ -301,10 +397,13 @@ class RelationWayTable(ThreadableDBObject, TableSource):
 
         changeset = {}
         inserts = []
-        for obj in engine.execute(sql):
-            cols = self._construct_row(obj, engine)
-            if cols is not None:
-                changeset[obj['way_id']] = 'A'
+        res = engine.execute(sql)
+        while True:
+            objs = res.fetchmany(self.chunksize)
+            if not objs:
+                break
+            for cols in self._construct_rows(objs, engine):
+                changeset[cols['id']] = 'A'
                 inserts.append(cols)
 
         if len(inserts):
@@ -313,31 +412,53 @@ class RelationWayTable(ThreadableDBObject, TableSource):
         return changeset
 
     def _process_construct_next(self, obj):
-        cols = self._construct_row(obj, self.thread.conn)
+        self._process_construct_batch([obj])
 
-        if cols is not None:
-            self.thread.conn.execute(self.data.insert().values(cols))
+    def _process_construct_batch(self, objs):
+        rows = self._construct_rows(objs, self.thread.conn)
+        if rows:
+            self.thread.conn.execute(self.data.insert().values(rows))
 
 
     def _construct_row(self, obj, conn):
-        if hasattr(self, 'transform_tags'):
-            cols = self.transform_tags(obj['way_id'], TagStore(obj['tags']))
-            if cols is None:
-                return None
+        rows = self._construct_rows([obj], conn)
+        return rows[0] if rows else None
+
+
+    def _construct_rows(self, objs, conn):
+        """ Create the table rows for a list of source ways. Ways that
+            are filtered out or have no valid geometry are skipped.
+        """
+        todo = []
+        for obj in objs:
+            if hasattr(self, 'transform_tags'):
+                cols = self.transform_tags(obj['way_id'], TagStore(obj['tags']))
+                if cols is None:
+                    continue
+            else:
+                cols = {}
+            todo.append((obj, cols))
+
+        if self.osmdata is not None and todo:
+            pointlists = self.osmdata.get_points_bulk(
+                            [o['nodes'] for o, _ in todo], conn)
         else:
-            cols = {}
-
-        if self.osmdata is not None:
-            points = self.osmdata.get_points(obj['nodes'], conn)
-            if len(points) <= 1:
-                return
-            if self.srid == 3857:
-                points = [p.to_mercator() for p in points]
-            cols['geom'] = from_shape(sgeom.LineString(points),
-                                      srid=self.srid)
-
-        cols['id'] = obj['way_id']
-        cols['rels'] = sorted(obj['rels'])
-        cols['nodes'] = obj['nodes']
-
-        return cols
+            pointlists = [None] * len(todo)
+
+        rows = []
+        for (obj, cols), points in zip(todo, pointlists):
+            if self.osmdata is not None:
+                if len(points) <= 1:
+                    continue
+                if self.srid == 3857:
+                    points = to_mercator_array(points)
+                cols['geom'] = from_shape(sgeom.LineString(points),
+                                          srid=self.srid)
+
+            cols['id'] = obj['way_id']
+            cols['rels'] = sorted(obj['rels'])
+            cols['nodes'] = obj['nodes']
+
+            rows.append(cols)
+
+        return rows
@@ -16,20 +16,23 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
 import logging
-from collections import Counter, defaultdict
+from array import array
+from collections import defaultdict
+
+import numpy
 
 import sqlalchemy as sa
 import sqlalchemy.sql.functions as saf
-import osgende.common.sqlalchemy as osa
-from sqlalchemy.dialects.postgresql import ARRAY
-from geoalchemy2.shape import from_shape, to_shape
+from sqlalchemy.dialects.postgresql import ARRAY, array
+from geoalchemy2.elements import WKBElement
 from sqlalchemy.dialects import postgresql
 
-from shapely.geometry import LineString
-
 from osgende.common.threads import ThreadableDBObject
 from osgende.common.table import TableSource
-from osgende.common.sqlalchemy import DropIndexIfExists, Truncate
+from osgende.common.copywriter import CopyWriter
+from osgende.common.unionfind import UnionFind
+from osgende.common.build_geometry import wkb_coords, linestring_wkb
+from osgende.common.sqlalchemy import DropIndexIfExists
 
 log = logging.getLogger(__name__)
 
@@ -56,6 +59,17 @@ class SegmentsTable(ThreadableDBObject, TableSource):
        This table creates its own new space of unique identifiers in the
        `id` column and a separate changeset table called <name>_changeset
        which refers to these ids.
+
+       Ways with identical properties are normally processed together as
+       a single task. When a set of ways has more than `partition_size`
+       ways (configurable through the 'partition_size' meta info), it is
+       split into parts that cannot be fused with each other, so that the
+       work can be spread over multiple workers.
+
+       Each worker writes its segments in batches using COPY. The size of
+       the batches can be set with the 'copy_batch_size' key in the info
+       dict of the MetaData object. Ids for new segments are taken from
+       the id sequence of the table in blocks of 'id_block_size' ids.
     """
 
     def __init__(self, meta, name, source, prop_cols):
@@ -80,10 +94,31 @@ class SegmentsTable(ThreadableDBObject, TableSource):
 
         self.src = source
         self.set_num_threads(meta.info.get('num_threads', 1))
+        self.set_worker_backend(meta.info.get('worker_backend', 'thread'))
+        self.set_partition_size(meta.info.get('partition_size', 10000))
+        self.set_batch_size(meta.info.get('copy_batch_size', 10000))
+        self.id_block_size = meta.info.get('id_block_size', 1000)
 
     def set_num_threads(self, num):
         self.numthreads = num
 
+    def set_batch_size(self, num):
+        """Set the number of segments that are collected by a worker before
+           they are written to the database.
+        """
+        self.batch_size = num
+
+    def set_partition_size(self, num):
+        """ Set the number of ways with identical properties above which
+            the ways are split into multiple tasks. Set to None to
+            disable splitting.
+        """
+        self.partition_size = num
+
+    @property
+    def sources(self):
+        return [self.src]
+
     @property
     def srid(self):
         return self.src.c.geom.type.srid
@@ -126,7 +161,9 @@ class SegmentsTable(ThreadableDBObject, TableSource):
                     wayproc.process_ways(prev_prop, wayset)
                     wayset = list()
 
-                wayset.append((w['id'], w['nodes'], list(to_shape(w['geom']).coords)))
+                coords = _way_coords(w['id'], w['nodes'], w['geom'])
+                if coords is not None:
+                    wayset.append((w['id'], w['nodes'], coords))
                 prev_prop = prop
 
             if prev_prop is not None:
@@ -157,76 +194,82 @@ class SegmentsTable(ThreadableDBObject, TableSource):
 
             log.info("Collecting points effected by update")
             # 1. nodes in added or changed ways
-            waychg = sa.select([saf.func.unnest(self.src.c.nodes)])\
+            waychg = sa.select([saf.func.unnest(self.src.c.nodes).label('tid')])\
                        .where(self.src.c.id.in_(self.src.select_add_modify()))
             # 2. nodes in segments where ways are changed
             waysel = sa.select([self.src.cc.id.label('tid')])
             segchg = sa.select([saf.func.unnest(self.c.nodes).label('tid')])\
                        .where(self.c.ways.op('&& ARRAY')(waysel))
-            conn.execute('DROP TABLE IF EXISTS __temp_updated_nodes')
-            conn.execute(osa.CreateTableAs('__temp_updated_nodes',
-                                           sa.union(segchg, waychg).alias('sub'),
-                                           temporary=False))
-            temp_nodes = sa.Table('__temp_updated_nodes', sa.MetaData(),
-                                  autoload_with=conn)
+            initial = sa.union(segchg, waychg).alias('initial_nodes')
+            nodes = sa.select([initial.c.tid]).cte('affected_nodes', recursive=True)
+            # 3. recursively, the inner nodes of all ways that are part of
+            #    segments containing any of these nodes
+            seg = self.data.alias('s')
+            way = self.src.data.alias('w')
+            inner = way.c.nodes[2:sa.func.array_length(way.c.nodes, 1) - 1]
+            nodes = nodes.union(sa.select([saf.func.unnest(inner)])
+                        .select_from(nodes.join(seg, seg.c.nodes.overlap(array([nodes.c.tid])))
+                                          .join(way, way.c.id == sa.func.any_(seg.c.ways))))
 
-            if log.isEnabledFor(logging.DEBUG):
-                log.debug("Nodes needing updating: ",
-                        [x for x in conn.execute(temp_nodes.select())])
-
-            deleted_ids = {}
             # throw out all segments that have one of these points
             log.info("Segments with bad intersections...")
-            # SQLAlchemy cannot produce DELETE FROM ... USING syntax
-            # Falling back to handwritten SQL instead.
-            q = """%s USING __temp_updated_nodes
-                    WHERE nodes && ARRAY[__temp_updated_nodes.tid]
-                    RETURNING id, ways""" \
-                 % (str(self.data.delete()))
-
-            while True:
-                additional_ways = set()
-                for c in conn.execute(q):
-                    for w in c['ways']:
-                        if w not in waysdone:
-                            additional_ways.add(w)
-                    deleted_ids[c['id']] = 'D'
-
-                if not additional_ways:
-                    break
-
-                todo_nodes = set()
+            deleted_ids = {}
+            additional_ways = set()
+            sql = self.data.delete()\
+                    .where(self.c.nodes.overlap(array([nodes.c.tid])))\
+                    .returning(self.c.id, self.c.ways)
+            for c in conn.execute(sql):
+                for w in c['ways']:
+                    if w not in waysdone:
+                        additional_ways.add(w)
+                deleted_ids[c['id']] = 'D'
+
+            # and collect the ways of these segments for recomputation
+            if additional_ways:
                 sql = self.src.data.select()\
                         .where(self.src.c.id.in_(list(additional_ways)))
                 for w in conn.execute(sql):
                     prop = tuple((w[x] for x in self.prop_columns))
                     wayproc.add_way(prop, w['id'], w['nodes'], w['geom'])
-                    waysdone.add(w['id'])
-                    todo_nodes.update(w['nodes'][1:-1])
-
-                if not todo_nodes:
-                    break
-
-                conn.execute(Truncate(temp_nodes))
-                conn.execute(temp_nodes.insert(),
-                             [ { "tid" : x } for x in todo_nodes ])
 
             # done, add the result back to the table
             log.info("Processing segments")
-            cur_id = conn.scalar(sa.select([saf.max(self.c.id)]))
-            first_new_id = 0 if cur_id is None else cur_id + 1
-
-            temp_nodes.drop(conn)
-
             wayproc.process_cached_ways()
             wayproc.finish()
 
             # add all newly created segments to the update table
             if self.change is not None:
-                self.write_change_table(conn, deleted_ids)
-                conn.execute(self.change.insert().from_select(self.cc,
-                  sa.select([self.c.id, sa.text("'A'")])
-                    .where(self.c.id >= first_new_id)))
+                changes = deleted_ids
+                changes.update([(i, 'A') for i in wayproc.new_ids])
+                self.write_change_table(conn, changes)
+
+
+class _NodeSet(object):
+    """ Read-only set of node ids. The ids are kept in a sorted array,
+        which needs a fraction of the memory of a Python set. With the
+        process backend, the array is shared with the workers.
+    """
+
+    def __init__(self, ids):
+        self.ids = numpy.unique(numpy.asarray(ids, dtype=numpy.int64))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, nid):
+        i = numpy.searchsorted(self.ids, nid)
+        return i < len(self.ids) and self.ids[i] == nid
+
+    def contains_many(self, nids):
+        """ Return a boolean array that tells for each node id in the
+            given list if it is in the set.
+        """
+        nids = numpy.asarray(nids, dtype=numpy.int64)
+        if len(self.ids) == 0:
+            return numpy.zeros(len(nids), dtype=bool)
+        idx = numpy.searchsorted(self.ids, nids)
+        idx[idx == len(self.ids)] = 0
+        return self.ids[idx] == nids
 
 
 class _WayCollector(ThreadableDBObject):
@@ -247,15 +290,22 @@ class _WayCollector(ThreadableDBObject):
             # cache of ways to process
             self.way_cache = []
             # When in update mode, the intersection points are collected on the
-            # fly from the ways to be updated
-            self.collected_nodes = Counter()
+            # fly from the ways to be updated: all node ids with their
+            # weight (1 for end points, 2 for points in the middle)
+            self.collected_nodes = array('q')
+            self.collected_weights = array('b')
         else:
             # precompute intersections
             self._get_intersections_from_db(engine)
 
-        # the worker threads
+        # The worker threads are only started when the first ways are
+        # processed, so that worker processes see the final intersections.
         self.set_num_threads(numthreads)
-        self.workers = self.create_worker_queue(engine, self._process_next)
+        self.set_worker_backend(parent.worker_backend)
+        self.engine = engine
+        self.workers = None
+        # ids of all segments written by the workers, available after finish()
+        self.new_ids = []
 
     @property
     def srid(self):
@@ -264,8 +314,6 @@ class _WayCollector(ThreadableDBObject):
     def _get_intersections_from_db(self, engine):
         """ Find all potetial mid-way intersections.
         """
-        self.intersections = set()
-
         # In creation mode, the potential intersections are precomputed
         # from the source table.
         s = self.src.src.data
@@ -286,17 +334,72 @@ class _WayCollector(ThreadableDBObject):
                   .group_by(wei.c.nid).alias('total')
 
         # anything with weight larger 2 must be a real intersection
-        c = engine.execute(sa.select([total.c.nid]).where(total.c.sum > 2))
+        c = engine.execution_options(stream_results=True)\
+                  .execute(sa.select([total.c.nid]).where(total.c.sum > 2))
 
-        for ele in c:
-            self.intersections.add(ele['nid'])
+        chunks = []
+        while True:
+            rows = c.fetchmany(100000)
+            if not rows:
+                break
+            chunks.append(numpy.fromiter((r[0] for r in rows),
+                                         dtype=numpy.int64, count=len(rows)))
+
+        self.intersections = _NodeSet(numpy.concatenate(chunks) if chunks else [])
 
     def process_ways(self, properties, ways):
-        self.workers.add_task((properties, ways))
+        if self.workers is None:
+            self.workers = self.create_worker_queue(self.engine, self._process_next)
+
+        if self.src.partition_size and len(ways) > self.src.partition_size:
+            for part in self._partition_ways(ways, self.src.partition_size):
+                self.workers.add_task((properties, part))
+        else:
+            self.workers.add_task((properties, ways))
+
+    def _partition_ways(self, ways, size):
+        """ Split the list of ways into parts that can be processed
+            independently and return lists of at least `size` ways
+            (except for the last one).
+
+            Ways are only fused at nodes that are not intersections, so
+            parts are formed from the ways that are connected through
+            such nodes. Such a node is always the end point of both ways,
+            nodes inside the ways are intersections when shared. The
+            original order of the ways is kept within each part.
+        """
+        ends = [n for w in ways for n in (w[1][0], w[1][-1])]
+        is_intersection = self.intersections.contains_many(ends)
+
+        parts = UnionFind()
+        node_to_way = {}
+        for pos in range(len(ways)):
+            i = parts.add()
+            for e in (2*pos, 2*pos + 1):
+                if not is_intersection[e]:
+                    other = node_to_way.setdefault(ends[e], i)
+                    if other != i:
+                        parts.union(i, other)
+
+        task = []
+        for part in parts.sets():
+            task.extend([ways[i] for i in part])
+            if len(task) >= size:
+                yield task
+                task = []
+
+        if task:
+            yield task
 
     def process_cached_ways(self):
-        # compute intersections from node counts
-        self.intersections = set((x for x, cnt in self.collected_nodes.items() if cnt > 2))
+        # compute intersections from node weights
+        nodes, idx = numpy.unique(numpy.frombuffer(self.collected_nodes, dtype=numpy.int64),
+                                  return_inverse=True)
+        weights = numpy.bincount(idx, weights=numpy.frombuffer(self.collected_weights,
+                                                               dtype=numpy.int8))
+        self.intersections = _NodeSet(nodes[weights > 2])
+        self.collected_nodes = array('q')
+        self.collected_weights = array('b')
 
         # sort ways by property in place
         self.way_cache.sort(key=lambda w: w[0])
@@ -323,40 +426,77 @@ class _WayCollector(ThreadableDBObject):
         """ Add another way to the current set of ways with similar properties.
         """
         assert(self.update_mode)
-        self.way_cache.append((str(props), props, (osmid, nodes, list(to_shape(geom).coords))))
+        coords = _way_coords(osmid, nodes, geom)
+        if coords is None:
+            return
+        self.way_cache.append((str(props), props, (osmid, nodes, coords)))
 
         # update intersections
-        self.collected_nodes[nodes[0]] += 1
+        self.collected_nodes.extend(nodes)
+        self.collected_weights.append(1)
         if len(nodes) > 1:
-            for n in nodes[1:-1]:
-                self.collected_nodes[n] += 2
-            self.collected_nodes[nodes[-1]] += 1
+            self.collected_weights.extend([2] * (len(nodes) - 2))
+            self.collected_weights.append(1)
 
     def finish(self):
-        self.workers.finish()
+        if self.workers is not None:
+            for ids in self.workers.finish():
+                if ids is not None:
+                    self.new_ids.extend(ids)
         del self.intersections
 
+    def _init_worker_thread(self):
+        super()._init_worker_thread()
+        self.thread.writer = CopyWriter(self.thread.conn, self.src.data,
+                                        batch_size=self.src.batch_size)
+        self.thread.id_sequence = self.thread.conn.scalar(
+            sa.select([sa.func.pg_get_serial_sequence(self.src.data.fullname, 'id')]))
+        self.thread.free_ids = []
+        # Only updates need to know about the new segments.
+        self.thread.new_ids = [] if self.update_mode else None
+
+    def _shutdown_worker_thread(self):
+        self.thread.writer.close()
+        super()._shutdown_worker_thread()
+        return self.thread.new_ids
+
+    def _next_id(self):
+        """ Return the next free id for a segment. Ids are reserved from
+            the sequence of the table in blocks.
+        """
+        if not self.thread.free_ids:
+            sql = sa.select([sa.func.nextval(self.thread.id_sequence)])\
+                    .select_from(sa.func.generate_series(1, self.src.id_block_size))
+            self.thread.free_ids = [r[0] for r in self.thread.conn.execute(sql)]
+            self.thread.free_ids.reverse()
+
+        return self.thread.free_ids.pop()
+
     def _process_next(self, item):
         properties, inways = item
 
+        # Put nodes and coordinates of all ways into one continuous buffer.
+        # The segments only refer to parts of it.
+        buf = _SegmentBuffer(inways)
+
         segments = set()
         fuse_pts = defaultdict(list)
 
         # add all ways to a temporary list and find potential fuse points
-        for osmid, nodes, geom in inways:
+        for (osmid, nodes, geom), offset in zip(inways, buf.offsets):
             nnodes = len(nodes)
+            is_intersection = self.intersections.contains_many(nodes)
             # find all nodes that are forced intersections inside the line
-            splitidx = [x for x in range(1, nnodes - 1)
-                         if nodes[x] in self.intersections]
+            splitidx = [int(x) + 1 for x in numpy.flatnonzero(is_intersection[1:-1])]
             splitidx = [0] + splitidx + [nnodes - 1]
 
             for i in range(len(splitidx) - 1):
                 f = splitidx[i]
-                t = splitidx[i+1] + 1
-                w = _Segment(osmid, nodes[f:t], geom[f:t])
-                if w.first not in self.intersections:
+                t = splitidx[i+1]
+                w = _Segment(buf, osmid, offset + f, offset + t)
+                if not is_intersection[f]:
                     fuse_pts[w.first].append(w)
-                if w.last not in self.intersections:
+                if not is_intersection[t]:
                     fuse_pts[w.last].append(w)
                 segments.add(w)
 
@@ -382,28 +522,97 @@ class _WayCollector(ThreadableDBObject):
             self._write_segment(properties, w)
 
     def _write_segment(self, props, segment):
-        fields = {'nodes' : segment.nodes,
-                  'ways' : segment.osmids,
-                  'geom' : from_shape(LineString(segment.geom), srid=self.srid)}
+        fields = {'id' : self._next_id(),
+                  'nodes' : segment.nodes,
+                  'ways' : list(segment.osmids),
+                  'geom' : WKBElement(linestring_wkb(segment.coords()), srid=self.srid)}
         fields.update(dict(zip(self.src.prop_columns, props)))
-        self.thread.conn.execute(self.src.data.insert(fields))
+        self.thread.writer.add(fields)
+        if self.thread.new_ids is not None:
+            self.thread.new_ids.append(fields['id'])
+
+
+def _way_coords(osmid, nodes, geom):
+    """ Return the coordinates of the geometry of a way. The segments need
+        exactly one coordinate for each node. The source tables drop
+        nodes without a location from the geometry, so such ways are
+        skipped and None is returned.
+    """
+    coords = wkb_coords(geom)
+    if len(coords) != len(nodes):
+        log.warning("Way %d has %d nodes but %d coordinates. Ignored.",
+                    osmid, len(nodes), len(coords))
+        return None
+
+    return coords
+
 
+class _SegmentBuffer(object):
+    """ Node ids and coordinates of a list of ways in continuous arrays.
+        `offsets` contains the position of the first node of each way.
+    """
+
+    def __init__(self, ways):
+        self.offsets = []
+        pos = 0
+        for w in ways:
+            self.offsets.append(pos)
+            pos += len(w[1])
+
+        self.nodes = numpy.fromiter((n for w in ways for n in w[1]),
+                                    dtype=numpy.int64, count=pos)
+        self.coords = numpy.empty((pos, 2), dtype=numpy.float64)
+        for w, offset in zip(ways, self.offsets):
+            self.coords[offset:offset + len(w[1])] = w[2]
 
 
 class _Segment(object):
+    """ A linear piece made up of one or more parts of ways.
 
-    def __init__(self, osmid, nodes, geom):
+        The parts are given as (start, end) index pairs into the node
+        and coordinate arrays of a _SegmentBuffer. Both indexes are
+        inclusive, a part with start > end is used in reverse direction.
+        Consecutive parts share the node where they are joined.
+    """
+
+    def __init__(self, buf, osmid, start, end):
+        self.buf = buf
         self.osmids = set((osmid,))
-        self.nodes = nodes
-        self.geom = geom
+        self.parts = [(start, end)]
 
     @property
     def first(self):
-        return self.nodes[0]
+        return int(self.buf.nodes[self.parts[0][0]])
 
     @property
     def last(self):
-        return self.nodes[-1]
+        return int(self.buf.nodes[self.parts[-1][1]])
+
+    def __len__(self):
+        """ Number of nodes in the segment.
+        """
+        return sum((abs(e - s) for s, e in self.parts)) + 1
+
+    @property
+    def nodes(self):
+        return self._collect(self.buf.nodes).tolist()
+
+    def coords(self):
+        """ Return the coordinates of the segment as an array of shape (N, 2).
+        """
+        return self._collect(self.buf.coords)
+
+    def _collect(self, data):
+        pieces = []
+        for i, (s, e) in enumerate(self.parts):
+            # the first node of a part is the last of the previous one
+            first = s if i == 0 else (s + 1 if s <= e else s - 1)
+            if s <= e:
+                pieces.append(data[first:e + 1])
+            else:
+                pieces.append(data[e:first + 1][::-1])
+
+        return numpy.concatenate(pieces)
 
     def fuse(self, other, node):
         """ Fuse this way with the given way at the given node returning
@@ -412,24 +621,24 @@ class _Segment(object):
             The direction of the fused way is arbitrary. The other way may
             be destroyed.
         """
-        if self.nodes[-1] != node:
-            assert(self.nodes[0] == node)
+        if self.last != node:
+            assert(self.first == node)
             self.reverse()
 
-        if other.nodes[0] != node:
-            assert(other.nodes[-1] == node)
+        if other.first != node:
+            assert(other.last == node)
             other.reverse()
 
-        if self.nodes == other.nodes:
+        if len(self) == len(other) \
+           and numpy.array_equal(self._collect(self.buf.nodes),
+                                 other._collect(other.buf.nodes)):
             # The way is reversing back on itself, throw away the other part.
             return None
 
         self.osmids.update(other.osmids)
-        self.nodes.extend(other.nodes[1:])
-        self.geom.extend(other.geom[1:])
+        self.parts.extend(other.parts)
 
-        return other.nodes[-1]
+        return other.last
 
     def reverse(self):
-        self.nodes.reverse()
-        self.geom.reverse()
+        self.parts = [(e, s) for s, e in reversed(self.parts)]
@@ -16,6 +16,7 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from sqlalchemy import MetaData, create_engine
 from sqlalchemy.engine.url import URL
 from sqlalchemy.schema import CreateSchema
@@ -23,6 +24,8 @@ from sqlalchemy_utils.functions import analyze
 
 from osgende.osmdata import OsmSourceTables
 from osgende.common.sqlalchemy import Analyse
+from osgende.common.stats import StatsCollector, LoggingSink, JsonLinesSink,\
+                                 PrometheusSink
 
 log = logging.getLogger(__name__)
 
@@ -36,18 +39,42 @@ class MapDB:
        currently makes use of the following:
 
            * '''nodestore''' - filename of the location for the the node store.
+           * '''nodestore_readonly''' - if set, open the node store in read-only
+             mode. The file is then accessed via a memory map that can be shared
+             by many processes.
+           * '''relation_members''' - if set, the members of relations
+             are taken from the table relation_members as created by
+             osgende-import with the -M option.
            * '''schema''' - schema associated with this DB. The only effect this
              currently has is that the create action will attempt to create the
              schema.
            * '''ro_user''' - read-only user to grant rights to for all tables. Only
              used for create action.
+           * '''parallel_tables''' - maximum number of tables to construct or
+             update at the same time. Tables are only processed in parallel
+             when they do not depend on each other. A table depends on the
+             tables listed in its `sources` property. Tables without the
+             property or where it is None keep their place in the order
+             given. Defaults to 1, i.e. tables are processed one after
+             another in the order given.
+             Cannot be used together with tables that use worker processes
+             (`worker_backend` 'process').
+           * '''stats''' - if set, log the processing time and number of
+             rows read and written for each table after construction or update.
+           * '''stats_file''' - append processing statistics for each table
+             as JSON lines to the given file.
+           * '''stats_prometheus''' - write processing statistics of the
+             last run to the given file in the text format understood by
+             the textfile collector of the Prometheus node exporter.
     """
 
     def __init__(self, options):
         self.options = options
         self.osmdata = OsmSourceTables(MetaData(),
                                        nodestore=self.get_option('nodestore'),
-                                       status_table=self.get_option('status', True))
+                                       status_table=self.get_option('status', True),
+                                       nodestore_readonly=self.get_option('nodestore_readonly', False),
+                                       relation_members=self.get_option('relation_members', False))
 
         if not self.get_option('no_engine'):
             dba = URL('postgresql', username=options.username,
@@ -55,6 +82,7 @@ class MapDB:
             self.engine = create_engine(dba, echo=self.get_option('echo_sql', False))
 
         self.metadata = MetaData(schema=self.get_option('schema'))
+        self.stats = StatsCollector(self.create_stats_sinks())
 
         self.tables = self.create_tables()
 
@@ -66,6 +94,19 @@ class MapDB:
     def has_option(self, option):
         return hasattr(self.options, option)
 
+    def create_stats_sinks(self):
+        """ Return the list of sinks that receive the processing statistics
+            of the tables. Overwrite this function to add custom sinks.
+        """
+        sinks = []
+        if self.get_option('stats'):
+            sinks.append(LoggingSink())
+        if self.get_option('stats_file'):
+            sinks.append(JsonLinesSink(self.get_option('stats_file')))
+        if self.get_option('stats_prometheus'):
+            sinks.append(PrometheusSink(self.get_option('stats_prometheus')))
+        return sinks
+
     def create(self):
         schema = self.get_option('schema')
         rouser = self.get_option('ro_user')
@@ -93,11 +134,17 @@ class MapDB:
         else:
             tname = '%s'
 
-        for tab in self.tables:
+        def construct_table(tab):
             log.info("Importing %s..." % str(tab.data.name))
-            tab.construct(self.engine)
+            with self.stats.measure(tab, 'construct', self.engine) as engine:
+                tab.construct(engine)
             self.osmdata.set_status_from(self.engine, tname % str(tab.data.name), 'base')
 
+        try:
+            self._process_tables(construct_table)
+        finally:
+            self.stats.close()
+
     def update(self):
         base_state = self.osmdata.get_status(self.engine)
         schema = self.get_option('schema')
@@ -107,23 +154,105 @@ class MapDB:
         else:
             tname = '%s'
 
-        for tab in self.tables:
+        def update_table(tab):
             status_name = tname % str(tab.data.name)
             if base_state is not None:
                 table_state = self.osmdata.get_status(self.engine, status_name)
                 if table_state is not None and table_state >= base_state:
                     log.info("Table %s already up-to-date." % tab)
-                    continue
+                    return
 
-            if hasattr(tab, 'before_update'):
-                tab.before_update(self.engine)
             log.info("Updating %s..." % str(tab.data.name))
-            tab.update(self.engine)
-            if hasattr(tab, 'after_update'):
-                tab.after_update(self.engine)
+            with self.stats.measure(tab, 'update', self.engine) as engine:
+                if hasattr(tab, 'before_update'):
+                    tab.before_update(engine)
+                tab.update(engine)
+                if hasattr(tab, 'after_update'):
+                    tab.after_update(engine)
 
             self.osmdata.set_status_from(self.engine, status_name, 'base')
 
+        try:
+            self._process_tables(update_table)
+        finally:
+            self.stats.close()
+
+    def _process_tables(self, func):
+        """ Call `func` for each table. If parallel processing is enabled,
+            tables that do not depend on each other are processed at the
+            same time, otherwise one after another.
+        """
+        numparallel = self.get_option('parallel_tables', 1)
+        if numparallel is None or numparallel <= 1:
+            for tab in self.tables:
+                func(tab)
+            return
+
+        # Forking from within the thread pool may leave locks held by
+        # other threads locked forever in the child process.
+        for tab in self.tables:
+            if getattr(tab, 'worker_backend', 'thread') == 'process' \
+               and getattr(tab, 'numthreads', None):
+                raise RuntimeError("Table %s uses worker processes, which cannot be "
+                                   "combined with parallel_tables." % tab.data.name)
+
+        deps = self._table_dependencies()
+        todo = list(self.tables)
+        done = set()
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=numparallel) as executor:
+            while todo or running:
+                for tab in list(todo):
+                    if len(running) >= numparallel:
+                        break
+                    if deps[id(tab)] <= done:
+                        todo.remove(tab)
+                        running[executor.submit(func, tab)] = tab
+
+                if not running:
+                    raise RuntimeError("Circular dependencies between tables.")
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    tab = running.pop(future)
+                    # Reraises any exception from the table processing.
+                    # The executor still waits for the running tables.
+                    future.result()
+                    done.add(id(tab))
+
+    def _table_dependencies(self):
+        """ Return a dict that maps the id() of each table to the set of
+            id()s of the tables that must be processed before it.
+
+            Tables declare the tables they are derived from in their
+            `sources` property, either as the table objects themselves
+            or as their SQLAlchemy tables. The dependencies of a table
+            without it (or where it is None) are unknown, so it is
+            processed only after all tables before it in the list and
+            before all tables after it.
+        """
+        tabids = {}
+        for t in self.tables:
+            tabids[id(t)] = id(t)
+            tabids[id(t.data)] = id(t)
+
+        deps = {}
+        previous = set()
+        barrier = set()
+        for tab in self.tables:
+            sources = getattr(tab, 'sources', None)
+            if sources is None:
+                deps[id(tab)] = set(previous)
+                barrier = set([id(tab)])
+            else:
+                refs = set([tabids[id(s)] for s in sources if id(s) in tabids])
+                refs.discard(id(tab))
+                deps[id(tab)] = refs | barrier
+            previous.add(id(tab))
+
+        return deps
+
     def finalize(self, dovacuum):
         conn = self.engine.connect()\
                  .execution_options(isolation_level="AUTOCOMMIT")
@@ -15,17 +15,38 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
-from sqlalchemy import Table, Column, Integer, BigInteger, String, DateTime, select, text
+import itertools
+
+import numpy
+from sqlalchemy import Table, Column, Integer, BigInteger, String, DateTime, select, text, any_, literal
+from sqlalchemy.types import Text
 from sqlalchemy.dialects.postgresql import JSONB, ARRAY, insert
 from geoalchemy2 import Geometry
 from osgende.common.table import TableSource
-from osgende.common.nodestore import NodeStore, NodeStorePoint
+from osgende.common.sqlalchemy import jsonb_array_elements_with_ordinality
+from osgende.common.nodestore import NodeStore, ReadOnlyNodeStore, NodeStorePoint
+
+# distance by which consecutive points with the same location are moved apart
+_NUDGE = 0.00000001
+
 
 class OsmSourceTables(object):
     """Collection of table sources that point to raw OSM data.
+
+       If `nodestore` is given, node locations are looked up in the node
+       location file of that name instead of the nodes table. With
+       `nodestore_readonly` the file is only memory-mapped for reading,
+       which allows it to be shared between processes.
+
+       With `relation_members` the members of the relations are also
+       expected in a separate table `relation_members` with one row per
+       member. The table is filled by osgende-import. Use
+       select_relation_members() to query the members in a way that is
+       independent of its presence.
     """
 
-    def __init__(self, meta, nodestore=None, status_table=False):
+    def __init__(self, meta, nodestore=None, status_table=False,
+                 nodestore_readonly=False, relation_members=False):
         # node table is special as we have a larger change table
         data = Table('nodes', meta,
                      Column('id', BigInteger),
@@ -51,14 +72,29 @@ class OsmSourceTables(object):
                                           Column('tags', JSONB),
                                           Column('members', JSONB),
                                     ), change_table='relation_changeset')
+        if relation_members:
+            self.relation_members = Table('relation_members', meta,
+                                          Column('relation_id', BigInteger),
+                                          Column('member_type', String(1)),
+                                          Column('member_id', BigInteger),
+                                          Column('role', Text),
+                                          Column('seq', Integer))
+            self.relation.member_table = self.relation_members
 
         if nodestore is None:
             self.get_points = self.__table_get_points
+            self.get_points_bulk = self.__table_get_points_bulk
+            self.get_locations = self.__table_get_locations
             self.nodestore = None
         else:
             self.get_points = self.__nodestore_get_points
+            self.get_points_bulk = self.__nodestore_get_points_bulk
+            self.get_locations = self.__nodestore_get_locations
             if isinstance(nodestore, str):
-                self.nodestore = NodeStore(nodestore)
+                if nodestore_readonly:
+                    self.nodestore = ReadOnlyNodeStore(nodestore)
+                else:
+                    self.nodestore = NodeStore(nodestore)
             else:
                 self.nodestore = nodestore
 
@@ -93,9 +129,115 @@ class OsmSourceTables(object):
     def __getitem__(self, key):
         return getattr(self, key)
 
+    # get_points(nodes, conn) and get_points_bulk(nodelists, conn) are set
+    # in the constructor depending on where the node locations come from.
+    #
+    # get_points() returns the list of points for the given list of node ids
+    # skipping nodes without a location. get_points_bulk() does the same for
+    # a list of node lists and returns for each of them the points as an
+    # array of shape (N, 2). It should be preferred when geometries for many
+    # ways are needed because the locations are then resolved in a single
+    # pass and no Python objects are created for the single points.
+    #
+    # get_locations(nodes, conn) returns the raw locations for a sequence
+    # of node ids as an array of shape (N, 2) with NaN for nodes without
+    # a location.
+
+    def patch_points_bulk(self, ways, conn, transform=None):
+        """ Compute the new point arrays for ways whose geometry has been
+            built before. This is an incremental version of
+            get_points_bulk() for updates: `ways` is a list of triples
+            (old nodes, old coordinates, new nodes), where the old
+            coordinates are those of the existing geometry as an array of
+            shape (N, 2) or None if there is no geometry yet. `transform`
+            is the function that was applied to the points when the
+            geometry was built.
+
+            The coordinates of the old geometry are reused for all nodes
+            that are still part of the way and not in the node change table.
+            Only the locations of moved and newly added nodes are looked
+            up. If the old coordinates cannot be matched to the old node
+            list (because nodes were missing or points had to be moved
+            apart), all locations of the way are looked up anew.
+
+            Returns the new points for each way in the same format as
+            get_points_bulk() with `transform` applied.
+        """
+        patchable = {}
+        candidates = set()
+        for i, (old_nodes, old_coords, new_nodes) in enumerate(ways):
+            if old_coords is None or None in old_nodes \
+               or len(old_nodes) != len(old_coords) \
+               or _has_moved_apart_points(old_coords, transform):
+                continue
+            patchable[i] = dict(zip(old_nodes, old_coords))
+            candidates.update(new_nodes)
+
+        moved = set()
+        if candidates:
+            nc = self.node.change
+            sql = select([nc.c.id])\
+                    .where(nc.c.id == any_(literal(list(candidates),
+                                                   ARRAY(BigInteger))))
+            moved.update((r[0] for r in conn.execute(sql)))
+
+        # nodes whose locations need to be looked up per patchable way
+        lookups = {}
+        for i, old in patchable.items():
+            lookups[i] = [n for n in ways[i][2]
+                          if n is not None and (n in moved or n not in old)]
+        allnodes = list(itertools.chain.from_iterable(lookups.values()))
+        locations = self.get_locations(allnodes, conn)
+        if transform is not None and len(locations):
+            locations = transform(locations)
+
+        ret = [None] * len(ways)
+        start = 0
+        for i, old in patchable.items():
+            end = start + len(lookups[i])
+            found = dict(zip(lookups[i], locations[start:end]))
+            start = end
+
+            coords = numpy.array([found[n] if n in found else old[n]
+                                  for n in ways[i][2] if n is not None],
+                                 dtype=numpy.float64).reshape((-1, 2))
+            coords = coords[~numpy.isnan(coords[:, 0])]
+            # Points equal to their predecessor are moved apart before
+            # the transformation, so they need a complete rebuild.
+            if not numpy.any(numpy.all(coords[1:] == coords[:-1], axis=1)):
+                ret[i] = coords
+
+        rebuild = [i for i, r in enumerate(ret) if r is None]
+        if rebuild:
+            points = self.get_points_bulk([ways[i][2] for i in rebuild], conn)
+            for i, pts in zip(rebuild, points):
+                if transform is not None and len(pts):
+                    pts = transform(pts)
+                ret[i] = pts
+
+        return ret
+
     def __nodestore_get_points(self, nodes, engine=None):
         return self.__mkpointlist_points(nodes, self.nodestore)
 
+    def __nodestore_get_points_bulk(self, nodelists, engine=None):
+        return self.__split_points(nodelists, self.__nodestore_get_locations)
+
+    def __nodestore_get_locations(self, nodes, engine=None):
+        nodes = numpy.fromiter(nodes, dtype=numpy.int64)
+
+        if hasattr(self.nodestore, 'get_many'):
+            return self.nodestore.get_many(nodes)
+
+        coords = numpy.full((len(nodes), 2), numpy.nan)
+        for i, n in enumerate(nodes):
+            try:
+                coords[i] = self.nodestore[int(n)]
+            except KeyError:
+                pass
+
+        return coords
+
     def __table_get_points(self, nodes, conn):
         t = self.node.data
         sql = select([t.c.id, t.c.geom.ST_X().label('x'),
@@ -107,6 +249,44 @@ class OsmSourceTables(object):
 
         return self.__mkpointlist_points(nodes, geoms)
 
+    def __table_get_points_bulk(self, nodelists, conn):
+        return self.__split_points(nodelists, self.__table_get_locations, conn)
+
+    def __table_get_locations(self, nodes, conn):
+        nodes = list(nodes)
+        allnodes = set(nodes)
+
+        geoms = {}
+        if allnodes:
+            t = self.node.data
+            sql = select([t.c.id, t.c.geom.ST_X().label('x'),
+                          t.c.geom.ST_Y().label('y')])\
+                    .where(t.c.id == any_(literal(list(allnodes),
+                                                  ARRAY(BigInteger))))
+
+            for res in conn.execute(sql):
+                geoms[res['id']] = (res['x'], res['y'])
+
+        nan = (numpy.nan, numpy.nan)
+        return numpy.array([geoms.get(n, nan) for n in nodes],
+                           dtype=numpy.float64).reshape((-1, 2))
+
+    def __split_points(self, nodelists, lookup, conn=None):
+        """ Look up the locations of all nodes in `nodelists` at once and
+            return the point arrays for each list.
+        """
+        nodelists = [[n for n in nodes if n is not None] for nodes in nodelists]
+        coords = lookup(itertools.chain.from_iterable(nodelists), conn)
+
+        ret = []
+        start = 0
+        for nodes in nodelists:
+            end = start + len(nodes)
+            ret.append(self.__mkpointlist_array(coords[start:end]))
+            start = end
+
+        return ret
+
     def __mkpointlist_points(self, nodes, store):
         ret = []
         prev = None
@@ -114,10 +294,96 @@ class OsmSourceTables(object):
             try:
                 coord = store[n]
                 if coord == prev:
-                    coord = NodeStorePoint(coord.x + 0.00000001, coord.y)
+                    coord = NodeStorePoint(coord.x + _NUDGE, coord.y)
                 prev = coord
                 ret.append(coord)
             except KeyError:
                 pass
 
         return ret
+
+    def __mkpointlist_array(self, coords):
+        """ Array version of __mkpointlist_points(): removes points
+            without a location and moves each second point of a run of
+            identical points slightly, so that no consecutive points in the
+            result are equal.
+        """
+        coords = coords[~numpy.isnan(coords[:, 0])]
+        if len(coords) < 2:
+            return coords
+
+        same = numpy.zeros(len(coords), dtype=bool)
+        same[1:] = numpy.all(coords[1:] == coords[:-1], axis=1)
+        if same.any():
+            # position of each point within its run of equal points
+            idx = numpy.arange(len(coords))
+            runstart = numpy.maximum.accumulate(numpy.where(same, 0, idx))
+            nudge = same & ((idx - runstart) % 2 == 1)
+            coords[nudge, 0] += _NUDGE
+
+        return coords
+
+
+def _has_moved_apart_points(coords, transform=None):
+    """ Check if the point array may contain points that were moved apart
+        by __mkpointlist_array(), i.e. two consecutive points with the
+        same y coordinate whose x coordinates differ by exactly the nudge.
+        `transform` is the function that was applied to the points
+        afterwards. It must leave y independent of x and scale x linearly.
+
+        OSM coordinates have a precision of 1e-7, so real segments never
+        have the length of the nudge.
+    """
+    if len(coords) < 2:
+        return False
+
+    if transform is None:
+        nudge = _NUDGE
+    else:
+        ref = transform(numpy.array([[0.0, 0.0], [_NUDGE, 0.0]]))
+        nudge = ref[1, 0] - ref[0, 0]
+
+    horizontal = coords[1:, 1] == coords[:-1, 1]
+    dx = numpy.abs(coords[1:, 0] - coords[:-1, 0])
+
+    return bool(numpy.any(horizontal & numpy.isclose(dx, nudge, rtol=1e-3, atol=0)))
+
+
+def select_relation_members(source, member_type=None, relations=None):
+    """ Return a query for the members of the relations in `source`.
+        The query has the columns relation_id, member_type, member_id,
+        role and seq, the position of the member in the relation
+        starting with 1.
+
+        `member_type` restricts the result to members of the given type
+        ('N', 'W' or 'R'). `relations` may be a query or list of
+        relation ids whose members should be returned.
+
+        If the source has a member table (see OsmSourceTables), the
+        members are taken from there. Otherwise the member list of each
+        relation is expanded.
+    """
+    members = getattr(source, 'member_table', None)
+    if members is not None:
+        sql = select([members.c.relation_id, members.c.member_type,
+                      members.c.member_id, members.c.role, members.c.seq])
+        relation_id = members.c.relation_id
+        mtype = members.c.member_type
+    else:
+        rels = source.data.alias('r')
+        elems = jsonb_array_elements_with_ordinality(rels.c.members).lateral()
+        mtype = elems.c.value['type'].astext
+        sql = select([rels.c.id.label('relation_id'),
+                      mtype.label('member_type'),
+                      elems.c.value['id'].astext.cast(BigInteger).label('member_id'),
+                      elems.c.value['role'].astext.label('role'),
+                      elems.c.ordinality.label('seq')])\
+                .select_from(rels.join(elems, onclause=text("True")))
+        relation_id = rels.c.id
+
+    if member_type is not None:
+        sql = sql.where(mtype == member_type)
+    if relations is not None:
+        sql = sql.where(relation_id.in_(relations))
+
+    return sql
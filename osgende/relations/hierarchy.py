@@ -16,8 +16,8 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
 import sqlalchemy as sa
-from sqlalchemy.dialects.postgresql import array
-from osgende.common.sqlalchemy import Truncate, jsonb_array_elements
+from osgende.common.sqlalchemy import Truncate, CreateTableAs
+from osgende.osmdata import select_relation_members
 
 class RelationHierarchy(object):
     """Table describing the relation hierarchies of the OSM relations table.
@@ -30,9 +30,16 @@ class RelationHierarchy(object):
 
        If `self_ref` is True, then each relation is added as its own child
        with depth = 1.
+
+       `max_depth` is the maximum depth of a relation below its parent
+       that is still recorded. Direct children have a depth of 2.
+
+       If the relation source has a change table, then updates only
+       recompute the hierarchies of the changed relations and of all
+       relations that contain them.
     """
 
-    def __init__(self, meta, name, source, self_ref=False):
+    def __init__(self, meta, name, source, self_ref=False, max_depth=5):
         self.data = sa.Table(name, meta,
                           sa.Column('parent', sa.BigInteger, index=True),
                           sa.Column('child', sa.BigInteger, index=True),
@@ -41,6 +48,7 @@ class RelationHierarchy(object):
 
         self.src = source
         self.self_reference = self_ref
+        self.max_depth = max_depth
 
     @property
     def c(self):
@@ -48,6 +56,12 @@ class RelationHierarchy(object):
         """
         return self.data.c
 
+    @property
+    def sources(self):
+        """ Return the list of tables this table is derived from.
+        """
+        return [self.src]
+
 
     def truncate(self, conn):
         conn.execute(Truncate(self.data))
@@ -60,31 +74,7 @@ class RelationHierarchy(object):
         """
         with engine.begin() as conn:
             self.truncate(conn)
-            # Insert all direct children
-            rels = self.src.data.alias('r')
-            members = jsonb_array_elements(rels.c.members).lateral()
-
-            sql = sa.select([rels.c.id.label('parent'),
-                             members.c.value['id'].astext.cast(sa.BigInteger).label('child'), 2]
-                       ).select_from(rels.join(members, onclause=sa.text("True")))\
-                    .where(members.c.value['type'].astext == 'R')\
-                    .where(members.c.value['id'].astext.cast(sa.BigInteger) != rels.c.id.label('parent'))
-            res = conn.execute(self.data.insert().from_select(self.data.c, sql))
-
-            level = 3
-            while res.rowcount > 0 and level < 6:
-                pd = self.data.alias()
-                prev = sa.select([pd.c.parent, pd.c.child]).where(pd.c.depth == (level - 1)).alias()
-                nd = self.data.alias()
-                newly = sa.select([nd.c.parent, nd.c.child]).where(nd.c.depth == 2).alias()
-                old = self.data.alias()
-                subs = sa.select([prev.c.parent, newly.c.child, level])\
-                        .where(prev.c.child == newly.c.parent)\
-                        .where(prev.c.parent != newly.c.child)\
-                        .except_(sa.select([old.c.parent, old.c.child, level]))
-
-                res = conn.execute(self.data.insert().from_select(self.data.c, subs))
-                level = level + 1
+            conn.execute(self._insert_hierarchy())
 
             # Finally add all relations themselves.
             if self.self_reference:
@@ -95,6 +85,78 @@ class RelationHierarchy(object):
     def update(self, engine):
         """Update the table.
 
-           The table is actually simply reconstructed because that is faster.
+           Without a change table on the source, the table is simply
+           reconstructed.
         """
-        self.construct(engine)
+        if self.src.change is None:
+            self.construct(engine)
+            return
+
+        with engine.begin() as conn:
+            # All relations whose hierarchy may have changed: the changed
+            # relations themselves and all their (old) parents. Any
+            # new path to a changed relation must go through one of them.
+            # The list needs to be saved before the old hierarchy is deleted.
+            changed = sa.select([self.src.cc.id])
+            parents = sa.select([self.c.parent])\
+                        .where(self.c.child.in_(changed))
+            tmpname = '__temp_%s_affected' % self.data.name
+            conn.execute('DROP TABLE IF EXISTS %s' % tmpname)
+            conn.execute(CreateTableAs(tmpname, sa.union(changed, parents)))
+            tmp = sa.Table(tmpname, sa.MetaData(), sa.Column('id', sa.BigInteger))
+            affected = sa.select([tmp.c.id])
+
+            conn.execute(self.data.delete().where(self.c.parent.in_(affected)))
+            conn.execute(self._insert_hierarchy(affected))
+
+            if self.self_reference:
+                s = self.src.data
+                conn.execute(self.data.insert().from_select(self.data.c,
+                    sa.select([s.c.id.label('parent'), s.c.id.label('child'), 1])
+                      .where(s.c.id.in_(affected))))
+
+            conn.execute('DROP TABLE %s' % tmpname)
+
+    def _insert_hierarchy(self, parents=None):
+        """ Return an SQL statement that inserts the hierarchy for all
+            relations that have sub-relations. If `parents` is given, then
+            only the hierarchies below these relations are computed.
+
+            The recursion only keeps (parent, child, depth) and uses UNION,
+            so that each pair is expanded at most once per level. The
+            size of the intermediate result is therefore bounded by the
+            number of pairs times `max_depth` and does not grow with the
+            number of different paths between two relations, as it would
+            when the full paths were kept. Cycles are no problem either:
+            walks through a cycle are cut off at `max_depth` and never
+            give a shorter depth than the direct path. Walks back to
+            the parent itself are not followed.
+        """
+        members = select_relation_members(self.src, 'R', parents)\
+                    .alias('members')
+
+        base = sa.select([members.c.relation_id.label('parent'),
+                          members.c.member_id.label('child'),
+                          sa.literal(2).label('depth')])\
+                 .where(members.c.member_id != members.c.relation_id)
+
+        paths = base.cte('paths', recursive=True)
+
+        submembers = select_relation_members(self.src, 'R').alias('submembers')
+        submember_id = submembers.c.member_id
+
+        step = sa.select([paths.c.parent, submember_id, paths.c.depth + 1])\
+                 .select_from(paths.join(submembers,
+                                         submembers.c.relation_id == paths.c.child))\
+                 .where(submember_id != paths.c.parent)\
+                 .where(paths.c.depth < self.max_depth)
+
+        paths = paths.union(step)
+
+        # A relation may be reachable via different paths. Only the
+        # shortest one counts.
+        sql = sa.select([paths.c.parent, paths.c.child,
+                         sa.func.min(paths.c.depth)])\
+                .group_by(paths.c.parent, paths.c.child)
+
+        return self.data.insert().from_select(self.data.c, sql)
@@ -0,0 +1,86 @@
+# This file is part of Osgende
+# Copyright (C) 2018 Sarah Hoffmann
+#
+# This is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+Benchmark for the assembly of route geometries from their members.
+
+Creates synthetic routes with many members and measures the time needed
+to put them together. Run with:
+
+    python3 test/benchmark_route_geometry.py [--members N] [--routes N]
+
+The routes consist of connected ways of which a part is reversed and
+a few are disconnected, so that all cases of the assembly are exercised.
+No database is needed.
+"""
+
+import argparse
+import random
+import time
+
+import numpy
+
+from osgende.common.build_geometry import _assemble_route
+
+def make_route(num_members, seed):
+    """ Return the member list and geometries for a synthetic route.
+    """
+    rnd = random.Random(seed)
+    members = []
+    geoms = {}
+    pos = numpy.zeros(2)
+    for i in range(num_members):
+        npoints = rnd.randint(2, 20)
+        steps = numpy.array([[rnd.uniform(-10, 10), rnd.uniform(-10, 10)]
+                             for _ in range(npoints - 1)])
+        if rnd.random() < 0.02:
+            # gap in the route
+            pos = pos + rnd.uniform(50, 100)
+        coords = numpy.vstack((pos, pos + numpy.cumsum(steps, axis=0)))
+        pos = coords[-1]
+        if rnd.random() < 0.3:
+            coords = coords[::-1].copy()
+        members.append({'type' : 'W', 'id' : i, 'role' : ''})
+        geoms[('W', i)] = [coords]
+
+    return members, geoms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--members', type=int, default=10000,
+                        help='number of members per route')
+    parser.add_argument('--routes', type=int, default=10,
+                        help='number of routes to assemble')
+    args = parser.parse_args()
+
+    routes = [make_route(args.members, i) for i in range(args.routes)]
+
+    t0 = time.perf_counter()
+    npoints = 0
+    for members, geoms in routes:
+        geom = _assemble_route(members, geoms)
+        npoints += sum((len(g.coords) for g in getattr(geom, 'geoms', [geom])))
+    duration = time.perf_counter() - t0
+
+    print("%d routes with %d members (%d points): %.3fs, %.2fms per route"
+          % (args.routes, args.members, npoints, duration,
+             1000 * duration / args.routes))
+
+
+if __name__ == '__main__':
+    main()
@@ -36,12 +36,14 @@ class TableTestFixture(unittest.TestCase):
         username = None
         password = None
         status = False
+        relation_members = False
+        batch_changes = False
 
     class TestDB(MapDB):
 
-        def __init__(self, tables):
+        def __init__(self, tables, options):
             self.test_tables = tables
-            MapDB.__init__(self, TableTestFixture.Options())
+            MapDB.__init__(self, options)
 
         def create_tables(self):
             tables = OrderedDict()
@@ -87,11 +89,13 @@ class TableTestFixture(unittest.TestCase):
             fd.write(osm_data.encode('utf-8'))
             fd.write(b'\n')
             fd.flush()
-            cmd = ['../tools/osgende-import', '-c', '-d', self.Options.database, fd.name]
-            subprocess.run(cmd, check=True)
+            cmd = ['../tools/osgende-import', '-c', '-d', self.Options.database]
+            if self.Options.relation_members:
+                cmd.append('-M')
+            subprocess.run(cmd + [fd.name], check=True)
 
 
-        self.db = self.TestDB(self.create_tables)
+        self.db = self.TestDB(self.create_tables, self.Options())
         self.db.create()
         self.db.construct()
 
@@ -100,8 +104,12 @@ class TableTestFixture(unittest.TestCase):
             fd.write(dedent(data).encode('utf-8'))
             fd.write(b'\n')
             fd.flush()
-            cmd = ['../tools/osgende-import', '-C', '-d', self.Options.database, fd.name]
-            subprocess.run(cmd)
+            cmd = ['../tools/osgende-import', '-C', '-d', self.Options.database]
+            if self.Options.relation_members:
+                cmd.append('-M')
+            if self.Options.batch_changes:
+                cmd.append('-B')
+            subprocess.run(cmd + [fd.name])
 
         self.db.update()
 
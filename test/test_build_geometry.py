@@ -0,0 +1,264 @@
+# This file is part of Osgende
+# Copyright (C) 2018 Sarah Hoffmann
+#
+# This is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""
+Tests for the assembly of route geometries. No database is needed,
+member geometries are taken from a dictionary.
+"""
+
+import unittest
+from nose.tools import *
+
+import numpy
+import sqlalchemy as sa
+
+from osgende.common.table import TableSource
+from osgende.common.build_geometry import RouteGeometryBuilder, _assemble_route
+
+def make_source(name, with_change=True):
+    table = sa.Table(name, sa.MetaData(),
+                     sa.Column('id', sa.BigInteger),
+                     sa.Column('geom', sa.LargeBinary))
+    return TableSource(table, name + '_changeset' if with_change else None)
+
+
+def line(*coords):
+    return [numpy.array(coords, dtype=numpy.float64)]
+
+
+def multiline(*lines):
+    return [numpy.array(l, dtype=numpy.float64) for l in lines]
+
+
+def members(*keys):
+    return [{'type' : t, 'id' : i, 'role' : ''} for t, i in keys]
+
+
+class FakeConn(object):
+    """ Returns the content of change tables as given in `changes`.
+    """
+
+    def __init__(self, changes):
+        self.changes = changes
+
+    def execute(self, sql):
+        table = list(sql.froms)[0]
+        return [(oid, ) for oid in self.changes[table.name]]
+
+
+class CountingBuilder(RouteGeometryBuilder):
+    """ Builder that takes the member geometries from a dictionary
+        and records which members were requested.
+    """
+
+    def __init__(self, geoms, **kwargs):
+        self.ways = make_source('ways')
+        self.rels = make_source('rels')
+        super().__init__(self.ways, self.rels, **kwargs)
+        self.geoms = geoms
+        self.fetched = []
+
+    def _fetch(self, conn, missing):
+        out = {}
+        for kind, ids in missing.items():
+            for oid in ids:
+                self.fetched.append((kind, oid))
+                out[(kind, oid)] = self.geoms.get((kind, oid))
+        return out
+
+
+class TestRouteGeometryBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.geoms = {('W', 1) : line((0, 0), (1, 0)),
+                      ('W', 2) : line((1, 0), (2, 0)),
+                      ('W', 3) : line((2, 0), (3, 0)),
+                      ('R', 10) : line((2, 0), (4, 0))}
+
+    def test_build(self):
+        builder = CountingBuilder(self.geoms)
+        geom = builder.build(None, members(('W', 1), ('W', 2), ('N', 5), ('W', 99)))
+
+        assert_equal('LineString', geom.geom_type)
+        assert_equal([(0, 0), (1, 0), (2, 0)], list(geom.coords))
+        assert_equal(set([('W', 1), ('W', 2), ('W', 99)]), set(builder.fetched))
+
+    def test_no_members(self):
+        builder = CountingBuilder(self.geoms)
+        assert_is_none(builder.build(None, members(('W', 99), ('N', 1))))
+
+    def test_cache_hit(self):
+        builder = CountingBuilder(self.geoms)
+        builder.build(None, members(('W', 1), ('W', 2)))
+        builder.fetched = []
+
+        geoms = builder.build_many(None, [members(('W', 1), ('W', 2)),
+                                          members(('W', 1), ('R', 10))])
+
+        assert_equal([('R', 10)], builder.fetched)
+        assert_equal([(0, 0), (1, 0), (2, 0)], list(geoms[0].coords))
+        assert_equal('MultiLineString', geoms[1].geom_type)
+
+    def test_shared_members_fetched_once(self):
+        builder = CountingBuilder(self.geoms)
+        builder.build_many(None, [members(('W', 1), ('R', 10)),
+                                  members(('R', 10), ('W', 2)),
+                                  members(('R', 10))])
+
+        assert_equal(3, len(builder.fetched))
+        assert_equal(set([('W', 1), ('W', 2), ('R', 10)]), set(builder.fetched))
+
+    def test_lru_eviction(self):
+        builder = CountingBuilder(self.geoms, cache_size=2)
+        builder.build(None, members(('W', 1)))
+        builder.build(None, members(('W', 2)))
+        # W1 is used again and W2 becomes the oldest entry
+        builder.build(None, members(('W', 1)))
+        builder.build(None, members(('W', 3)))
+
+        assert_equal([('W', 1), ('W', 3)], list(builder.cache.keys()))
+
+        builder.fetched = []
+        builder.build(None, members(('W', 1), ('W', 2)))
+        assert_equal([('W', 2)], builder.fetched)
+        assert_equal(2, len(builder.cache))
+
+    def test_no_cache(self):
+        builder = CountingBuilder(self.geoms, cache_size=0)
+        builder.build(None, members(('W', 1)))
+        builder.build(None, members(('W', 1)))
+
+        assert_equal([('W', 1), ('W', 1)], builder.fetched)
+        assert_equal(0, len(builder.cache))
+
+    def test_invalidate(self):
+        builder = CountingBuilder(self.geoms)
+        builder.build(None, members(('W', 1), ('W', 2), ('R', 10)))
+
+        self.geoms[('W', 1)] = line((0, 1), (1, 0))
+        builder.invalidate(FakeConn({'ways_changeset' : [1, 5],
+                                     'rels_changeset' : []}))
+
+        builder.fetched = []
+        geom = builder.build(None, members(('W', 1), ('W', 2), ('R', 10)))
+        assert_equal([('W', 1)], builder.fetched)
+        assert_equal([(0, 1), (1, 0), (2, 0), (4, 0)], list(geom.coords))
+
+    def test_invalidate_without_change_table(self):
+        builder = CountingBuilder(self.geoms)
+        builder.rels.change = None
+        builder.build(None, members(('W', 1), ('R', 10)))
+
+        builder.invalidate(FakeConn({'ways_changeset' : []}))
+
+        assert_equal([('W', 1)], list(builder.cache.keys()))
+
+    def test_discard(self):
+        builder = CountingBuilder(self.geoms)
+        builder.build(None, members(('W', 1), ('R', 10)))
+
+        builder.discard('R', [10, 11])
+
+        assert_equal([('W', 1)], list(builder.cache.keys()))
+
+
+class TestAssembleRoute(unittest.TestCase):
+    """ The expected results were created with the assembly from before
+        the geometries were handled as coordinate arrays. They must not
+        change.
+    """
+
+    def assert_route(self, expected, memberlist, geoms):
+        geom = _assemble_route(members(*memberlist), geoms)
+
+        if expected is None:
+            assert_is_none(geom)
+            return
+
+        gtype, lines = expected
+        assert_equal(gtype, geom.geom_type)
+        parts = getattr(geom, 'geoms', [geom])
+        assert_equal(lines, [[tuple(c) for c in p.coords] for p in parts])
+
+    def test_connected(self):
+        self.assert_route(('LineString', [[(0, 0), (1, 0), (1, 1), (2, 1), (2, 2)]]),
+                          [('W', 1), ('W', 2), ('W', 3)],
+                          {('W', 1) : line((0, 0), (1, 0)),
+                           ('W', 2) : line((1, 0), (1, 1)),
+                           ('W', 3) : line((1, 1), (2, 1), (2, 2))})
+
+    def test_reversed_member(self):
+        self.assert_route(('LineString', [[(0, 0), (1, 0), (1.5, 0.5), (2, 0)]]),
+                          [('W', 1), ('W', 2)],
+                          {('W', 1) : line((0, 0), (1, 0)),
+                           ('W', 2) : line((2, 0), (1.5, 0.5), (1, 0))})
+
+    def test_turn_first_member(self):
+        self.assert_route(('LineString', [[(0, 0), (1, 0), (2, 0), (3, 0)]]),
+                          [('W', 1), ('W', 2), ('W', 3)],
+                          {('W', 1) : line((1, 0), (0, 0)),
+                           ('W', 2) : line((1, 0), (2, 0)),
+                           ('W', 3) : line((3, 0), (2, 0))})
+
+    def test_gap(self):
+        self.assert_route(('MultiLineString',
+                           [[(0, 0), (1, 0)], [(2, 0), (5, 0), (6, 1)]]),
+                          [('W', 1), ('W', 2), ('W', 3)],
+                          {('W', 1) : line((0, 0), (1, 0)),
+                           ('W', 2) : line((5, 0), (2, 0)),
+                           ('W', 3) : line((5, 0), (6, 1))})
+
+    def test_gap_after_first_member(self):
+        self.assert_route(('MultiLineString',
+                           [[(1, 0), (0, 0)], [(-1, 0), (-2, 0)]]),
+                          [('W', 1), ('W', 2)],
+                          {('W', 1) : line((1, 0), (0, 0)),
+                           ('W', 2) : line((-1, 0), (-2, 0))})
+
+    def test_multilinestring_member(self):
+        self.assert_route(('MultiLineString',
+                           [[(0, 0), (1, 0), (2, 0)],
+                            [(3, 0), (4, 0), (4, 1), (5, 1)]]),
+                          [('W', 1), ('R', 10), ('W', 2)],
+                          {('W', 1) : line((0, 0), (1, 0)),
+                           ('R', 10) : multiline([(1, 0), (2, 0)],
+                                                 [(3, 0), (4, 0), (4, 1)]),
+                           ('W', 2) : line((4, 1), (5, 1))})
+
+    def test_reversed_multilinestring_member(self):
+        # Only the line that connects is reversed, the others
+        # keep their direction.
+        self.assert_route(('MultiLineString',
+                           [[(0, 0), (1, 0), (2, 0)], [(4, 1), (4, 0), (3, 0)]]),
+                          [('W', 1), ('R', 10)],
+                          {('W', 1) : line((0, 0), (1, 0)),
+                           ('R', 10) : multiline([(4, 1), (4, 0), (3, 0)],
+                                                 [(2, 0), (1, 0)])})
+
+    def test_nodes_and_missing_members(self):
+        self.assert_route(('LineString', [[(0, 0), (1, 0), (1, 2)]]),
+                          [('N', 1), ('W', 1), ('W', 99), ('R', 5), ('W', 2)],
+                          {('W', 1) : line((0, 0), (1, 0)),
+                           ('W', 2) : line((1, 0), (1, 2))})
+
+    def test_repeated_members(self):
+        self.assert_route(('LineString', [[(0, 0), (1, 0), (2, 0), (1, 0), (0, 0)]]),
+                          [('W', 1), ('W', 2), ('W', 2), ('W', 1)],
+                          {('W', 1) : line((0, 0), (1, 0)),
+                           ('W', 2) : line((1, 0), (2, 0))})
+
+    def test_no_usable_members(self):
+        self.assert_route(None, [('N', 1), ('W', 99)], {})
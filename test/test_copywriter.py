@@ -0,0 +1,262 @@
+# This file is part of Osgende
+# Copyright (C) 2018 Sarah Hoffmann
+#
+# This is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""
+Tests for the encoding of rows for COPY. The data is checked before
+it is sent to the database, so no database is needed.
+"""
+
+import datetime
+import decimal
+import unittest
+from nose.tools import *
+
+import numpy
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from geoalchemy2 import Geometry
+from geoalchemy2.elements import WKBElement, WKTElement
+from shapely.geometry import Point
+
+from osgende.common.copywriter import CopyWriter, text_encoder, binary_encoder,\
+                                     BinaryRowEncoder, COPY_BINARY_HEADER,\
+                                     COPY_BINARY_TRAILER
+
+class FakeConn(object):
+    dialect = postgresql.dialect()
+
+
+def column(ctype):
+    return sa.Column('c', ctype)
+
+
+def hexbytes(s):
+    return bytes.fromhex(s.replace(' ', ''))
+
+
+class TestTextEncoder(unittest.TestCase):
+
+    def test_scalars(self):
+        enc = text_encoder(column(sa.String))
+        assert_equal('foo', enc('foo'))
+        assert_equal('12', enc(12))
+        assert_equal('1.5', enc(1.5))
+        assert_equal('1.50', enc(decimal.Decimal('1.50')))
+        assert_equal('t', enc(True))
+        assert_equal('2018-03-01', enc(datetime.date(2018, 3, 1)))
+        assert_equal('2018-03-01T10:11:12', enc(datetime.datetime(2018, 3, 1, 10, 11, 12)))
+
+    def test_unsupported_scalars(self):
+        enc = text_encoder(column(sa.Integer))
+        for value in ({'a' : 1}, [1, 2], b'\x00', object()):
+            assert_raises(TypeError, enc, value)
+
+    def test_bool(self):
+        enc = text_encoder(column(sa.Boolean))
+        assert_equal('t', enc(True))
+        assert_equal('f', enc(False))
+        assert_equal('f', enc(0))
+        assert_raises(TypeError, enc, 'false')
+
+    def test_json(self):
+        enc = text_encoder(column(JSONB))
+        assert_equal('{"name": "A\\\\tB", "n": [1, 2]}',
+                     enc({'name' : 'A\\tB', 'n' : [1, 2]}))
+        assert_raises(TypeError, enc, {'a' : object()})
+
+    def test_int_array(self):
+        enc = text_encoder(column(ARRAY(sa.BigInteger)))
+        assert_equal('{}', enc([]))
+        assert_equal('{1,-2,3}', enc([1, -2, 3]))
+        assert_equal('{1,NULL}', enc((1, None)))
+        assert_equal('{4,5}', enc(numpy.array([4, 5], dtype=numpy.int64)))
+        assert_raises(TypeError, enc, 5)
+        assert_raises(TypeError, enc, '{1,2}')
+
+    def test_text_array(self):
+        enc = text_encoder(column(ARRAY(sa.String)))
+        assert_equal('{"a","b c","q\\"x","back\\\\slash"}',
+                     enc(['a', 'b c', 'q"x', 'back\\slash']))
+        assert_equal('{{"a","b"},{"c","d"}}', enc([['a', 'b'], ['c', 'd']]))
+        assert_equal('{t,f}', enc([True, False]))
+        assert_raises(TypeError, enc, [{'a' : 1}])
+
+    def test_geometry(self):
+        enc = text_encoder(column(Geometry('POINT', srid=4326)))
+        assert_equal('SRID=4326;0101000000000000000000F03F0000000000000040',
+                     enc(Point(1, 2)).upper())
+        assert_equal('SRID=3857;POINT(1 2)', enc(WKTElement('POINT(1 2)', srid=3857)))
+        assert_equal('SRID=4326;POINT(1 2)', enc('SRID=4326;POINT(1 2)'))
+        assert_equal('0101', enc(b'\x01\x01'))
+        assert_raises(TypeError, enc, 5)
+        assert_raises(TypeError, enc, (1, 2))
+
+
+class TestBinaryEncoder(unittest.TestCase):
+    """ The expected values follow the output of the send functions of
+        PostgreSQL and PostGIS as written by COPY ... TO STDOUT (FORMAT binary).
+    """
+
+    def assert_encoded(self, ctype, expected, value):
+        assert_equal(hexbytes(expected), binary_encoder(column(ctype))(value))
+
+    def test_int8(self):
+        self.assert_encoded(sa.BigInteger, '00 00 00 00 00 00 00 05', 5)
+        self.assert_encoded(sa.BigInteger, 'ff ff ff ff ff ff ff fe', -2)
+        self.assert_encoded(sa.BigInteger, '00 00 00 02 54 0b e3 ff', 9999999999)
+
+    def test_int4(self):
+        self.assert_encoded(sa.Integer, '00 00 01 00', 256)
+        self.assert_encoded(sa.Integer, 'ff ff ff ff', -1)
+
+    def test_text(self):
+        self.assert_encoded(sa.String, '61 62', 'ab')
+        self.assert_encoded(sa.String, 'c3 a4 09 0a', '\u00e4\t\n')
+        self.assert_encoded(sa.String, '', '')
+
+    def test_bool(self):
+        self.assert_encoded(sa.Boolean, '01', True)
+        self.assert_encoded(sa.Boolean, '00', False)
+
+    def test_jsonb(self):
+        # version 1 followed by the text representation
+        self.assert_encoded(JSONB, '01 7b 22 61 22 3a 20 22 62 22 7d', {'a' : 'b'})
+        self.assert_encoded(JSONB, '01 7b 7d', {})
+
+    def test_json(self):
+        self.assert_encoded(postgresql.JSON, '5b 31 5d', [1])
+
+    def test_int8_array(self):
+        # dimensions, has nulls, element oid (int8), size and lower bound,
+        # then length and value of each element
+        self.assert_encoded(ARRAY(sa.BigInteger),
+                            '00 00 00 01 00 00 00 00 00 00 00 14'
+                            ' 00 00 00 02 00 00 00 01'
+                            ' 00 00 00 08 00 00 00 00 00 00 00 01'
+                            ' 00 00 00 08 ff ff ff ff ff ff ff ff',
+                            [1, -1])
+
+    def test_int4_array(self):
+        self.assert_encoded(ARRAY(sa.Integer),
+                            '00 00 00 01 00 00 00 00 00 00 00 17'
+                            ' 00 00 00 01 00 00 00 01'
+                            ' 00 00 00 04 00 00 00 07',
+                            [7])
+
+    def test_empty_array(self):
+        self.assert_encoded(ARRAY(sa.BigInteger),
+                            '00 00 00 00 00 00 00 00 00 00 00 14', [])
+
+    def test_geometry(self):
+        # EWKB with SRID 4326 of POINT(1 2)
+        ewkb = '01 01 00 00 20 e6 10 00 00' \
+               ' 00 00 00 00 00 00 f0 3f 00 00 00 00 00 00 00 40'
+        wkb = '01 01 00 00 00 00 00 00 00 00 00 f0 3f 00 00 00 00 00 00 00 40'
+        gtype = Geometry('POINT', srid=4326)
+
+        self.assert_encoded(gtype, ewkb, Point(1, 2))
+        self.assert_encoded(gtype, ewkb, hexbytes(ewkb))
+        self.assert_encoded(gtype, ewkb, ewkb.replace(' ', ''))
+        self.assert_encoded(gtype, ewkb, WKBElement(hexbytes(wkb), srid=4326))
+        self.assert_encoded(gtype, ewkb, WKBElement(hexbytes(ewkb), extended=True))
+
+    def test_geometry_big_endian(self):
+        wkb = '00 00 00 00 01 3f f0 00 00 00 00 00 00 40 00 00 00 00 00 00 00'
+        ewkb = '00 20 00 00 01 00 00 0f 34' \
+               ' 3f f0 00 00 00 00 00 00 40 00 00 00 00 00 00 00'
+        self.assert_encoded(Geometry('POINT', srid=3892), ewkb,
+                            WKBElement(hexbytes(wkb), srid=3892))
+
+    def test_unsupported_values(self):
+        for ctype, value in ((Geometry('POINT', srid=4326), 5),
+                             (Geometry('POINT', srid=4326), (1, 2)),
+                             (sa.BigInteger, '5'),
+                             (sa.Integer, 1.5),
+                             (sa.Boolean, 'false'),
+                             (sa.String, [1])):
+            assert_raises(TypeError, binary_encoder(column(ctype)), value)
+
+    def test_unsupported_type(self):
+        assert_raises(RuntimeError, binary_encoder, column(sa.Float))
+        assert_raises(RuntimeError, binary_encoder, column(ARRAY(sa.String)))
+
+
+class TestBinaryRowEncoder(unittest.TestCase):
+
+    def setUp(self):
+        self.table = sa.Table('test', sa.MetaData(),
+                              sa.Column('id', sa.BigInteger),
+                              sa.Column('tags', JSONB),
+                              sa.Column('nodes', ARRAY(sa.BigInteger)))
+
+    def test_header_and_trailer(self):
+        assert_equal(hexbytes('50 47 43 4f 50 59 0a ff 0d 0a 00'
+                              ' 00 00 00 00 00 00 00 00'),
+                     COPY_BINARY_HEADER)
+        assert_equal(hexbytes('ff ff'), COPY_BINARY_TRAILER)
+
+    def test_row(self):
+        enc = BinaryRowEncoder(self.table)
+        assert_equal(hexbytes('00 03'
+                              ' 00 00 00 08 00 00 00 00 00 00 00 0a'
+                              ' 00 00 00 03 01 7b 7d'
+                              ' 00 00 00 0c 00 00 00 00 00 00 00 00 00 00 00 14'),
+                     enc.encode({'id' : 10, 'tags' : {}, 'nodes' : []}))
+
+    def test_null(self):
+        enc = BinaryRowEncoder(self.table)
+        assert_equal(hexbytes('00 03 00 00 00 08 00 00 00 00 00 00 00 01'
+                              ' ff ff ff ff ff ff ff ff'),
+                     enc.encode({'id' : 1, 'tags' : None}))
+
+    def test_columns(self):
+        enc = BinaryRowEncoder(self.table, columns=['nodes', 'id'])
+        assert_equal(hexbytes('00 02'
+                              ' 00 00 00 20 00 00 00 01 00 00 00 00 00 00 00 14'
+                              ' 00 00 00 01 00 00 00 01'
+                              ' 00 00 00 08 00 00 00 00 00 00 00 05'
+                              ' 00 00 00 08 00 00 00 00 00 00 00 02'),
+                     enc.encode({'id' : 2, 'nodes' : [5]}))
+
+
+class TestCopyWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.table = sa.Table('test', sa.MetaData(),
+                              sa.Column('id', sa.BigInteger),
+                              sa.Column('name', sa.String),
+                              sa.Column('tags', JSONB),
+                              sa.Column('nodes', ARRAY(sa.BigInteger)))
+
+    def test_sql(self):
+        writer = CopyWriter(FakeConn(), self.table, columns=['id', 'nodes'])
+        assert_equal('COPY test (id,nodes) FROM STDIN', writer.sql)
+
+    def test_rows(self):
+        writer = CopyWriter(FakeConn(), self.table)
+        writer.add({'id' : 1, 'name' : 'a\tb\nc\\d', 'tags' : {'x' : 'y'},
+                    'nodes' : [1, 2]})
+        writer.add({'id' : 2})
+
+        assert_equal(2, writer.numrows)
+        assert_equal('1\ta\\tb\\nc\\\\d\t{"x": "y"}\t{1,2}\n'
+                     '2\t\\N\t\\N\t\\N\n',
+                     writer.buffer.getvalue())
+
+    def test_unsupported_value(self):
+        writer = CopyWriter(FakeConn(), self.table)
+        assert_raises(TypeError, writer.add, {'id' : 1, 'name' : ['a', 'b']})
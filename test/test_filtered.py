@@ -96,6 +96,26 @@ class TestFilteredTable(TableTestFixture):
             self.has_changes("test_changeset", ['D1'])
         self.table_equals("test", [])
 
+    def test_update_last_change_wins(self):
+        self.import_data(self.basedata1)
+        self.update_data("""\
+            r1 v2 Tfoo=a Mn23@
+            r1 v3 Tfoo=bar,name=house Mn23@,w4@forward
+            r2 v2 dD
+            r2 v3 Tfoo=x,building=yes Mw2@,w3@,w5@
+            r11 v1 Tfoo=foo,source=gogo Mr11@
+            r11 v2 dD
+            """)
+        if self.with_change:
+            self.has_changes("test_changeset", ['M1', 'M2'])
+        self.table_equals("test", [self.r1_expect, self.r2_expect])
+
+
+class TestFilteredTableBatched(TestFilteredTable):
+
+    class Options(TableTestFixture.Options):
+        batch_changes = True
+
 
 class TestFilteredTableView(TestFilteredTable):
     with_change = False
@@ -1,7 +1,10 @@
+import random
 import unittest
 import sqlalchemy as sa
+from nose.tools import *
 
 from osgende.lines import GroupedWayTable
+from osgende.lines.grouped import _connected_ways
 
 from table_test_fixture import TableTestFixture
 
@@ -13,6 +16,49 @@ def H(d):
     return res
 
 
+class TestConnectedWays(unittest.TestCase):
+
+    def test_no_ways(self):
+        assert_equal([], _connected_ways([]))
+
+    def test_groups(self):
+        ways = [(10, [1, 2]), (11, [7, 8]), (12, [2, 3]),
+                (13, [9]), (14, [3, 8]), (15, [20, 21, 20])]
+        assert_equal([[10, 11, 12, 14]], _connected_ways(ways))
+
+    def test_first_way_first(self):
+        ways = [(5, [1, 2]), (3, [6, 7]), (4, [2, 6])]
+        assert_equal([[5, 3, 4]], _connected_ways(ways))
+
+    def test_missing_nodes(self):
+        ways = [(1, None), (2, []), (3, [4, 5]), (4, [5])]
+        assert_equal([[3, 4]], _connected_ways(ways))
+
+    def test_random_ways(self):
+        rnd = random.Random(11)
+        ways = [(100 + i, [rnd.randrange(300) for _ in range(rnd.randint(1, 4))])
+                for i in range(200)]
+
+        # naive reference: merge groups until nothing changes
+        groups = [(set([w[0]]), set(w[1])) for w in ways]
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(groups)):
+                for j in range(i + 1, len(groups)):
+                    if groups[i][1] & groups[j][1]:
+                        groups[i][0].update(groups[j][0])
+                        groups[i][1].update(groups[j][1])
+                        del groups[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        expected = sorted([sorted(g[0]) for g in groups if len(g[0]) > 1])
+
+        assert_equal(expected, _connected_ways(ways))
+
+
 class TestFilteredTableImport(TableTestFixture):
 
     nodegrid = """\
@@ -61,6 +61,40 @@ class TestHierarchyTale(TableTestFixture):
                   { 'parent' : 2, 'child' : 1, 'depth' : 2 },
                 ])
 
+    def test_diamond(self):
+        self.import_data("""
+            r1 Mr2@,r3@
+            r2 Mr4@
+            r3 Mr4@,r5@
+            r4 Mr5@
+            """)
+        self.table_equals("test",
+                [ { 'parent' : 1, 'child' : 2, 'depth' : 2 },
+                  { 'parent' : 1, 'child' : 3, 'depth' : 2 },
+                  { 'parent' : 1, 'child' : 4, 'depth' : 3 },
+                  { 'parent' : 1, 'child' : 5, 'depth' : 3 },
+                  { 'parent' : 2, 'child' : 4, 'depth' : 2 },
+                  { 'parent' : 2, 'child' : 5, 'depth' : 3 },
+                  { 'parent' : 3, 'child' : 4, 'depth' : 2 },
+                  { 'parent' : 3, 'child' : 5, 'depth' : 2 },
+                  { 'parent' : 4, 'child' : 5, 'depth' : 2 },
+                ])
+
+    def test_longer_cycle(self):
+        self.import_data("""
+            r1 Mr2@
+            r2 Mr3@
+            r3 Mr1@
+            """)
+        self.table_equals("test",
+                [ { 'parent' : 1, 'child' : 2, 'depth' : 2 },
+                  { 'parent' : 1, 'child' : 3, 'depth' : 3 },
+                  { 'parent' : 2, 'child' : 3, 'depth' : 2 },
+                  { 'parent' : 2, 'child' : 1, 'depth' : 3 },
+                  { 'parent' : 3, 'child' : 1, 'depth' : 2 },
+                  { 'parent' : 3, 'child' : 2, 'depth' : 3 },
+                ])
+
     def test_self_contained(self):
         self.import_data("""
             r1 Mr2@,r1@
@@ -70,3 +104,33 @@ class TestHierarchyTale(TableTestFixture):
                 [ { 'parent' : 1, 'child' : 2, 'depth' : 2 },
                 ])
 
+
+    def test_update_add_subrelation(self):
+        self.import_data("""
+            r1 Mr2@
+            r2 Mw1@
+            r3 Mw1@
+            """)
+        self.update_data("r2 v2 Mr3@")
+        self.table_equals("test",
+                [ { 'parent' : 1, 'child' : 2, 'depth' : 2 },
+                  { 'parent' : 1, 'child' : 3, 'depth' : 3 },
+                  { 'parent' : 2, 'child' : 3, 'depth' : 2 },
+                ])
+
+    def test_update_delete_intermediate(self):
+        self.import_data("""
+            r1 Mr2@
+            r2 Mr3@
+            r3 Mw3@
+            """)
+        self.update_data("r2 v2 dD")
+        self.table_equals("test",
+                [ { 'parent' : 1, 'child' : 2, 'depth' : 2 },
+                ])
+
+
+class TestHierarchyRelationMembers(TestHierarchyTale):
+
+    class Options(TableTestFixture.Options):
+        relation_members = True
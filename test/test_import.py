@@ -0,0 +1,82 @@
+# This file is part of Osgende
+# Copyright (C) 2018 Sarah Hoffmann
+#
+# This is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+Tests for the different import modes of osgende-import.
+"""
+
+import os
+import subprocess
+import tempfile
+import unittest
+from textwrap import dedent
+from nose.tools import *
+
+import sqlalchemy as sa
+from sqlalchemy.engine.url import URL
+
+class TestParallelImport(unittest.TestCase):
+
+    databases = ('osgende_test', 'osgende_test_parallel')
+
+    data = """\
+        n1 Tamenity=bench x1.0 y2.0
+        n2 x1.001 y2.001
+        n3 x1.002 y2.0
+        n4 Tname=X,highway=bus_stop x1.005 y2.005
+        w1 Thighway=residential Nn1,n2,n3
+        w2 Thighway=service Nn3,n4
+        w3 Nn4,n99
+        r1 Ttype=route,route=bus Mw1@forward,w2@,n4@stop
+        r2 Ttype=superroute Mr1@,w3@
+        """
+
+    def _import(self, database, *args):
+        assert_equal(0, os.system('dropdb --if-exists ' + database))
+        with tempfile.NamedTemporaryFile(suffix='.opl') as fd:
+            fd.write(dedent(self.data).encode('utf-8'))
+            fd.flush()
+            cmd = ['../tools/osgende-import', '-c', '-d', database]
+            subprocess.run(cmd + list(args) + [fd.name], check=True)
+
+    def _content(self, database):
+        engine = sa.create_engine(URL('postgresql', database=database))
+        content = {}
+        with engine.begin() as conn:
+            content['nodes'] = list(conn.execute("""SELECT id, tags, ST_AsText(geom)
+                                                    FROM nodes ORDER BY id"""))
+            content['ways'] = list(conn.execute("""SELECT id, tags, nodes
+                                                   FROM ways ORDER BY id"""))
+            content['relations'] = list(conn.execute("""SELECT id, tags, members
+                                                        FROM relations ORDER BY id"""))
+        engine.dispose()
+        return content
+
+    def tearDown(self):
+        for db in self.databases:
+            os.system('dropdb --if-exists ' + db)
+
+    def test_parallel_equals_sequential(self):
+        self._import(self.databases[0])
+        self._import(self.databases[1], '-P')
+
+        sequential = self._content(self.databases[0])
+        parallel = self._content(self.databases[1])
+
+        for table in ('nodes', 'ways', 'relations'):
+            assert_greater(len(sequential[table]), 0)
+            assert_equal(sequential[table], parallel[table])
@@ -0,0 +1,252 @@
+# This file is part of Osgende
+# Copyright (C) 2018 Sarah Hoffmann
+#
+# This is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""
+Tests for the scheduling of table processing in MapDB. No database
+is needed, the tables only record when they are processed.
+"""
+
+import threading
+import time
+import unittest
+from nose.tools import *
+
+import sqlalchemy as sa
+
+from osgende import MapDB
+from osgende.common.table import TableSource
+from osgende.common.threads import ThreadableDBObject
+from osgende.osmdata import OsmSourceTables
+from osgende.generic import FilteredTable
+from osgende.lines import PlainWayTable, SegmentsTable, GroupedWayTable
+
+class Options(object):
+    no_engine = True
+    status = False
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+
+class FakeTable(ThreadableDBObject):
+
+    def __init__(self, name, sources=None):
+        self.data = sa.Table(name, sa.MetaData())
+        if sources is not None:
+            self.sources = sources
+
+
+class UndeclaredTable(TableSource):
+    """ Table source that does not tell which tables it reads.
+    """
+
+    def __init__(self, name, source):
+        super().__init__(sa.Table(name, sa.MetaData(), sa.Column('id', sa.BigInteger)))
+        self.src = source
+
+
+class Recorder(object):
+    """ Processing function for the tables that records the start and
+        end of processing. Tables named in `fail` raise an exception,
+        tables given in `wait` only finish once all of them have started.
+    """
+
+    def __init__(self, fail=(), wait=()):
+        self.events = []
+        self.lock = threading.Lock()
+        self.fail = fail
+        self.wait = wait
+        if wait:
+            self.barrier = threading.Barrier(len(wait), timeout=5)
+
+    def __call__(self, tab):
+        name = str(tab.data.name)
+        with self.lock:
+            self.events.append(('start', name))
+        if name in self.wait:
+            self.barrier.wait()
+        else:
+            time.sleep(0.01)
+        if name in self.fail:
+            raise ValueError(name)
+        with self.lock:
+            self.events.append(('end', name))
+
+    def processed(self):
+        return set([e[1] for e in self.events if e[0] == 'end'])
+
+    def assert_before(self, first, second):
+        assert_less(self.events.index(('end', first)),
+                    self.events.index(('start', second)))
+
+
+class FakeDB(MapDB):
+
+    def __init__(self, tables, **options):
+        self.fake_tables = tables
+        super().__init__(Options(**options))
+
+    def create_tables(self):
+        return self.fake_tables
+
+
+class TestProcessTables(unittest.TestCase):
+
+    def test_process_workers_with_parallel_tables(self):
+        tables = [FakeTable('t1'), FakeTable('t2')]
+        tables[1].set_num_threads(2)
+        tables[1].set_worker_backend('process')
+        db = FakeDB(tables, parallel_tables=2)
+
+        processed = []
+        assert_raises(RuntimeError, db._process_tables, processed.append)
+        assert_equal([], processed)
+
+    def test_process_workers_sequential(self):
+        tables = [FakeTable('t1'), FakeTable('t2')]
+        tables[1].set_num_threads(2)
+        tables[1].set_worker_backend('process')
+        db = FakeDB(tables, parallel_tables=1)
+
+        processed = []
+        db._process_tables(processed.append)
+        assert_equal(tables, processed)
+
+    def test_independent_tables_in_parallel(self):
+        tables = [FakeTable('t1', []), FakeTable('t2', [])]
+        db = FakeDB(tables, parallel_tables=2)
+
+        rec = Recorder(wait=('t1', 't2'))
+        db._process_tables(rec)
+        assert_equal(set(['t1', 't2']), rec.processed())
+
+    def test_sources_are_processed_first(self):
+        t1 = FakeTable('t1', [])
+        t2 = FakeTable('t2', [t1])
+        t3 = FakeTable('t3', [])
+        t4 = FakeTable('t4', [t2, t3])
+        db = FakeDB([t1, t2, t3, t4], parallel_tables=3)
+
+        rec = Recorder()
+        db._process_tables(rec)
+        assert_equal(set(['t1', 't2', 't3', 't4']), rec.processed())
+        rec.assert_before('t1', 't2')
+        rec.assert_before('t2', 't4')
+        rec.assert_before('t3', 't4')
+
+    def test_unknown_sources_keep_order(self):
+        t1 = FakeTable('t1', [])
+        t2 = FakeTable('t2', [])
+        t3 = FakeTable('t3')
+        t4 = FakeTable('t4', [])
+        db = FakeDB([t1, t2, t3, t4], parallel_tables=4)
+
+        rec = Recorder()
+        db._process_tables(rec)
+        assert_equal(set(['t1', 't2', 't3', 't4']), rec.processed())
+        rec.assert_before('t1', 't3')
+        rec.assert_before('t2', 't3')
+        rec.assert_before('t3', 't4')
+
+    def test_sources_as_sqlalchemy_tables(self):
+        t1 = FakeTable('t1', [])
+        t2 = FakeTable('t2', [t1.data])
+        db = FakeDB([t1, t2], parallel_tables=2)
+
+        rec = Recorder()
+        db._process_tables(rec)
+        rec.assert_before('t1', 't2')
+
+    def test_undeclared_table_source_keeps_order(self):
+        t1 = FakeTable('t1', [])
+        t2 = UndeclaredTable('t2', t1)
+        t3 = FakeTable('t3', [])
+        db = FakeDB([t1, t2, t3], parallel_tables=3)
+
+        rec = Recorder()
+        db._process_tables(rec)
+        rec.assert_before('t1', 't2')
+        rec.assert_before('t2', 't3')
+
+    def test_sources_outside_database(self):
+        other = FakeTable('other', [])
+        t1 = FakeTable('t1', [other])
+        db = FakeDB([t1], parallel_tables=2)
+
+        rec = Recorder()
+        db._process_tables(rec)
+        assert_equal(set(['t1']), rec.processed())
+
+    def test_circular_dependencies(self):
+        t1 = FakeTable('t1')
+        t2 = FakeTable('t2', [t1])
+        t1.sources = [t2]
+        db = FakeDB([t1, t2], parallel_tables=2)
+
+        assert_raises(RuntimeError, db._process_tables, Recorder())
+
+    def test_failing_table(self):
+        t1 = FakeTable('t1', [])
+        t2 = FakeTable('t2', [t1])
+        t3 = FakeTable('t3', [])
+        db = FakeDB([t1, t2, t3], parallel_tables=2)
+
+        rec = Recorder(fail=('t1',))
+        assert_raises(ValueError, db._process_tables, rec)
+
+        # Running tables are finished, dependent ones not started.
+        assert_not_in(('start', 't2'), rec.events)
+        assert_in(('end', 't3'), rec.events)
+
+    def test_failing_table_sequential(self):
+        tables = [FakeTable('t1', []), FakeTable('t2', [])]
+        db = FakeDB(tables, parallel_tables=1)
+
+        rec = Recorder(fail=('t1',))
+        assert_raises(ValueError, db._process_tables, rec)
+        assert_equal([('start', 't1')], rec.events)
+
+
+class TestTableSources(unittest.TestCase):
+
+    def setUp(self):
+        self.meta = sa.MetaData()
+        self.osmdata = OsmSourceTables(self.meta)
+
+    def test_plain_ways(self):
+        table = PlainWayTable(self.meta, 'plain', self.osmdata.way, self.osmdata)
+        assert_equal([self.osmdata.way, self.osmdata.node], table.sources)
+
+    def test_derived_ways(self):
+        plain = PlainWayTable(self.meta, 'plain', self.osmdata.way, self.osmdata)
+        segments = SegmentsTable(self.meta, 'segments', plain, [plain.c.tags])
+        grouped = GroupedWayTable(self.meta, 'grouped', plain, ('tags', ))
+
+        assert_equal([plain], segments.sources)
+        assert_equal([plain], grouped.sources)
+
+    def test_filtered_subset_tables(self):
+        other = sa.Table('other', self.meta, sa.Column('id', sa.BigInteger))
+        way = self.osmdata.way
+        table = FilteredTable(self.meta, 'filtered', way,
+                              way.c.id.in_(sa.select([other.c.id])))
+
+        assert_equal(way, table.sources[0])
+        assert_in(other, table.sources)
+
+    def test_unknown_sources(self):
+        assert_is_none(UndeclaredTable('t1', self.osmdata.way).sources)
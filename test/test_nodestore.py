@@ -0,0 +1,263 @@
+# This file is part of Osgende
+# Copyright (C) 2018 Sarah Hoffmann
+#
+# This is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""
+Tests for the bulk lookup of node locations. The results are compared
+with those of the lookup of single nodes.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from nose.tools import *
+
+import numpy
+from sqlalchemy import MetaData
+
+from osgende.osmdata import OsmSourceTables
+from osgende.common.nodestore import NodeStore, NodeStorePoint, \
+                                     ReadOnlyNodeStore, to_mercator_array
+
+class TestNodeStore(unittest.TestCase):
+
+    nodes = { 1 : (1.0, 2.0), 2 : (1.0000001, -2.5), 3 : (-179.9999999, 89.0),
+              4 : (1.0, 2.0), 5 : (1.0, 2.0), 6 : (1.0, 2.0),
+              10 : (0.0, 0.0), 1000 : (13.4567891, 52.1234567) }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'nodes.store')
+        self.store = NodeStore(self.filename)
+        for nid, (x, y) in self.nodes.items():
+            self.store[nid] = NodeStorePoint(x, y)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def single_lookup(self, store, ids):
+        """ Lookup of the nodes one by one.
+        """
+        ret = []
+        for nid in ids:
+            try:
+                pt = store[nid]
+                ret.append((pt.x, pt.y))
+            except KeyError:
+                ret.append((numpy.nan, numpy.nan))
+        return numpy.array(ret, dtype=numpy.float64).reshape((-1, 2))
+
+    def assert_same_coords(self, expected, coords):
+        assert_equal(expected.shape, coords.shape)
+        numpy.testing.assert_array_equal(expected, coords)
+
+    def check_get_many(self, store):
+        for ids in ([1], [1000, 1, 2], [3, 3, 1, 3],
+                    [7, 1, 999], [2, 5000, 1, 1000000], []):
+            self.assert_same_coords(self.single_lookup(store, ids),
+                                    store.get_many(ids))
+
+    def test_get_many(self):
+        self.check_get_many(self.store)
+
+    def test_get_many_readonly(self):
+        self.check_get_many(ReadOnlyNodeStore(self.filename))
+
+    def test_get_many_values(self):
+        coords = self.store.get_many([1000, 7, 3])
+        assert_equal((13.4567891, 52.1234567), tuple(coords[0]))
+        assert_true(numpy.all(numpy.isnan(coords[1])))
+        assert_equal((-179.9999999, 89.0), tuple(coords[2]))
+
+    def test_get_many_after_growth(self):
+        ro = ReadOnlyNodeStore(self.filename)
+        ro.get_many([1, 2])
+
+        self.store[2000000] = NodeStorePoint(4.0, 5.0)
+        del self.store[1]
+
+        self.assert_same_coords(self.single_lookup(self.store, [1, 2000000]),
+                                ro.get_many([1, 2000000]))
+
+    def test_to_mercator_array(self):
+        ids = sorted(self.nodes)
+        coords = self.store.get_many(ids)
+        merc = to_mercator_array(coords)
+
+        expected = numpy.array([tuple(self.store[n].to_mercator()) for n in ids])
+        numpy.testing.assert_allclose(expected, merc, rtol=1e-9, atol=1e-6)
+
+    def test_points_bulk(self):
+        osmdata = OsmSourceTables(MetaData(), nodestore=self.store)
+
+        for nodes in ([1, 2, 3], [1, 4], [1, 4, 5, 6, 2], [4, 4, 4],
+                      [1, 7, 4], [None, 1, None, 2], [7, 8], [1], [],
+                      [1, 2, 1], [1000, 1, 4, 7, 5, 1000]):
+            expected = osmdata.get_points(nodes, None)
+            points = osmdata.get_points_bulk([nodes], None)[0]
+
+            assert_equal(len(expected), len(points), nodes)
+            for exp, pt in zip(expected, points):
+                assert_equal((exp.x, exp.y), tuple(pt), nodes)
+
+    def test_points_bulk_many_ways(self):
+        osmdata = OsmSourceTables(MetaData(), nodestore=self.store)
+        ways = [[1, 2], [], [4, 5, 7], [3, 3, 1]]
+
+        points = osmdata.get_points_bulk(ways, None)
+
+        assert_equal(len(ways), len(points))
+        for nodes, pts in zip(ways, points):
+            expected = osmdata.get_points(nodes, None)
+            assert_equal([(p.x, p.y) for p in expected],
+                         [tuple(p) for p in pts])
+
+
+class FakeConn(object):
+    """ Returns the ids of the moved nodes for the query of the
+        node change table.
+    """
+
+    def __init__(self, moved):
+        self.moved = moved
+
+    def execute(self, sql):
+        return [(n, ) for n in self.moved]
+
+
+class TestPatchPoints(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = NodeStore(os.path.join(self.tmpdir, 'nodes.store'))
+        for i in range(1, 10):
+            self.store[i] = NodeStorePoint(float(i), 0.5 * i)
+        self.osmdata = OsmSourceTables(MetaData(), nodestore=self.store)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def build(self, nodes, transform=None):
+        """ Build the points of the way from scratch.
+        """
+        coords = self.osmdata.get_points_bulk([nodes], None)[0]
+        if transform is not None:
+            coords = transform(coords)
+        return coords
+
+    def patch(self, ways, moved=(), transform=None):
+        return self.osmdata.patch_points_bulk(ways, FakeConn(moved), transform)
+
+    def assert_coords(self, expected, coords):
+        numpy.testing.assert_array_equal(numpy.asarray(expected), coords)
+
+    def test_patch_equals_rebuild(self):
+        ways = [([1, 2, 3], [1, 2, 3]),
+                ([1, 2, 3], [1, 2, 3, 4]),
+                ([1, 2, 3], [4, 1, 3]),
+                ([1, 2], [7, 8, 9]),
+                ([4, 5], [4, 99, 5])]
+        old = [(o, self.build(o), n) for o, n in ways]
+
+        self.store[2] = NodeStorePoint(2.5, 3.0)
+        self.store[5] = NodeStorePoint(5.5, 3.0)
+        patched = self.patch(old, moved=[2, 5])
+
+        assert_equal(len(ways), len(patched))
+        for (_, nodes), coords in zip(ways, patched):
+            self.assert_coords(self.build(nodes), coords)
+
+    def test_patch_with_transform(self):
+        old = [([1, 2], self.build([1, 2], to_mercator_array), [1, 2, 3])]
+
+        self.store[1] = NodeStorePoint(1.5, 0.1)
+        patched = self.patch(old, moved=[1], transform=to_mercator_array)
+
+        numpy.testing.assert_allclose(self.build([1, 2, 3], to_mercator_array),
+                                      patched[0])
+
+    def test_reuse_old_coordinates(self):
+        # Locations of nodes that are not in the change table
+        # are taken from the old geometry.
+        old = [([1, 2], numpy.array([[10.0, 11.0], [12.0, 13.0]]), [2, 1, 3])]
+
+        patched = self.patch(old)
+
+        self.assert_coords([[12.0, 13.0], [10.0, 11.0], [3.0, 1.5]], patched[0])
+
+    def test_moved_nodes_are_looked_up(self):
+        old = [([1, 2], numpy.array([[10.0, 11.0], [12.0, 13.0]]), [1, 2])]
+
+        patched = self.patch(old, moved=[2])
+
+        self.assert_coords([[10.0, 11.0], [2.0, 1.0]], patched[0])
+
+    def test_fallback_without_old_geometry(self):
+        patched = self.patch([([1, 2], None, [1, 2, 3])])
+        self.assert_coords(self.build([1, 2, 3]), patched[0])
+
+    def test_fallback_missing_old_nodes(self):
+        # The old geometry does not match the old node list.
+        old = numpy.array([[10.0, 11.0], [12.0, 13.0]])
+        patched = self.patch([([1, 2, 99], old, [1, 2]),
+                              ([1, None, 2], old, [1, 2])])
+
+        for coords in patched:
+            self.assert_coords(self.build([1, 2]), coords)
+
+    def test_fallback_moved_apart_points(self):
+        # Old points with the same coordinate may have been moved apart.
+        old = numpy.array([[10.0, 11.0], [10.00000001, 11.0], [12.0, 13.0]])
+        patched = self.patch([([1, 2, 3], old, [1, 2, 3])])
+
+        self.assert_coords(self.build([1, 2, 3]), patched[0])
+
+    def test_fallback_moved_apart_points_transformed(self):
+        self.store[2] = NodeStorePoint(1.0, 0.5)
+        old = [([1, 2, 3], self.build([1, 2, 3], to_mercator_array), [1, 2, 3])]
+
+        # not in the change table, so only a rebuild notices the change
+        self.store[2] = NodeStorePoint(1.5, 0.5)
+        patched = self.patch(old, transform=to_mercator_array)
+
+        numpy.testing.assert_allclose(self.build([1, 2, 3], to_mercator_array),
+                                      patched[0])
+
+    def test_horizontal_segments_are_patched(self):
+        # Consecutive points with the same y are not necessarily
+        # moved apart points.
+        old = numpy.array([[10.0, 11.0], [12.0, 11.0], [12.0000001, 11.0]])
+        patched = self.patch([([1, 2, 3], old, [1, 2, 3, 4])])
+
+        self.assert_coords([[10.0, 11.0], [12.0, 11.0], [12.0000001, 11.0],
+                            [4.0, 2.0]], patched[0])
+
+    def test_horizontal_segments_are_patched_transformed(self):
+        old = to_mercator_array(numpy.array([[10.0, 11.0], [12.0, 11.0]]))
+        patched = self.patch([([1, 2], old, [1, 2])], transform=to_mercator_array)
+
+        self.assert_coords(old, patched[0])
+
+    def test_fallback_new_identical_points(self):
+        self.store[2] = NodeStorePoint(1.0, 0.5)
+        old = [([1, 3], self.build([1, 3]), [1, 2, 3])]
+
+        patched = self.patch(old, moved=[2])
+
+        self.assert_coords(self.build([1, 2, 3]), patched[0])
+        assert_not_equal(patched[0][0, 0], patched[0][1, 0])
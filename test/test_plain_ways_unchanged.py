@@ -90,3 +90,22 @@ class TestPlainWayTableUnchanged(TableTestFixture):
         self.table_equals("test", [self.expect_w103,
             { 'id' : 101, 'tags' : { 'name' : 'first' },
                     'nodes' : [1, 2], 'geom' : Line(1, (0.9, 2.1)) }])
+
+    def test_move_node_twice(self):
+        self.import_data(self.baseimport, self.nodes)
+        self.update_data("""\
+            n2 v2 x0.9 y2.1
+            n2 v3 x0.8 y2.0
+            w103 v2 Tname=third Nn34,n1
+            w103 v3 Tname=second Nn34,n1,n36
+            """)
+        self.has_changes("test_changeset", ['M101', 'M103'])
+        self.table_equals("test", [self.expect_w103,
+            { 'id' : 101, 'tags' : { 'name' : 'first' },
+                    'nodes' : [1, 2], 'geom' : Line(1, (0.8, 2.0)) }])
+
+
+class TestPlainWayTableUnchangedBatched(TestPlainWayTableUnchanged):
+
+    class Options(TableTestFixture.Options):
+        batch_changes = True
@@ -216,3 +216,26 @@ class TestSimpleRelationWaysUpdateSimpleRelationChanges(TableTestFixture):
         self.has_changes("test_changeset", ['M1'])
         self.update_data("r2 v2 Mw1@\nr1 v2 Mw1@")
         self.has_changes("test_changeset", ['D2'])
+
+
+class TestMaterializedRelationWaysUpdateRelationChanges(
+        TestSimpleRelationWaysUpdateSimpleRelationChanges):
+
+    def create_tables(self, db):
+        return [ RelationWayTable(db.metadata, "test", db.osmdata.way,
+                                  db.osmdata.relation, materialize_view=True) ]
+
+
+class TestRelationMembersRelationWaysUpdateRelationChanges(
+        TestSimpleRelationWaysUpdateSimpleRelationChanges):
+
+    class Options(TableTestFixture.Options):
+        relation_members = True
+
+
+class TestBatchedRelationWaysUpdateRelationChanges(
+        TestSimpleRelationWaysUpdateSimpleRelationChanges):
+
+    class Options(TableTestFixture.Options):
+        relation_members = True
+        batch_changes = True
@@ -19,7 +19,12 @@
 Tests for SegmentsTable
 """
 
+import random
+import unittest
+from nose.tools import *
+
 from osgende.lines import PlainWayTable, SegmentsTable
+from osgende.lines.segments import _NodeSet, _WayCollector
 
 from table_test_fixture import TableTestFixture
 from db_compare import Line, Any, Set
@@ -268,6 +273,16 @@ class TestSimpleSegmentsImport(TableTestFixture):
             R([2, 3], Set(2), tags={'ref': '1'}),
         )
 
+    def test_missing_node_location(self):
+        self.nodegrid = "1 2 3 4 5"
+
+        self._test("""\
+            w1 Tref=1 Nn1,n2,n99
+            w2 Tref=1 Nn4,n5
+            """,
+            R([4, 5], Set(2), tags={'ref': '1'}),
+        )
+
 class TestSimpleSegmentsUpdate(TableTestFixture):
 
     nodegrid = """\
@@ -623,3 +638,108 @@ class TestSimpleSegmentsUpdate(TableTestFixture):
             # result
             R([1, 2], Set(1), tags={'rel' : '1'}),
         )
+
+    def test_add_way_with_missing_node_location(self):
+        self.nodegrid = "1 2 3 4 5"
+
+        self._test(
+            "w1 Trel=1 Nn1,n2",
+            # update
+            "w2 Trel=1 Nn4,n5,n99",
+            # result
+            R([1, 2], Set(1), tags={'rel' : '1'}),
+        )
+
+
+class TestNodeSet(unittest.TestCase):
+
+    def test_empty(self):
+        nodes = _NodeSet([])
+        assert_equal(0, len(nodes))
+        assert_not_in(1, nodes)
+        assert_equal([False, False], list(nodes.contains_many([0, 1])))
+
+    def test_contains(self):
+        nodes = _NodeSet([5, 3, 5, -2, 1 << 40])
+        assert_equal(4, len(nodes))
+        for nid in (5, 3, -2, 1 << 40):
+            assert_in(nid, nodes)
+        for nid in (0, 4, 6, -3, (1 << 40) + 1, 1 << 41):
+            assert_not_in(nid, nodes)
+
+    def test_contains_many(self):
+        rnd = random.Random(7)
+        ids = [rnd.randrange(1000) for _ in range(300)]
+        nodes = _NodeSet(ids)
+        test = list(range(-5, 1010)) + [3, 3, 3]
+
+        expected = [n in set(ids) for n in test]
+        assert_equal(expected, list(nodes.contains_many(test)))
+        assert_equal(expected, [n in nodes for n in test])
+        assert_equal(0, len(nodes.contains_many([])))
+
+
+class TestPartitionWays(unittest.TestCase):
+
+    def partition(self, ways, intersections, size):
+        collector = _WayCollector.__new__(_WayCollector)
+        collector.intersections = _NodeSet(intersections)
+        ways = [(i, nodes) for i, nodes in enumerate(ways)]
+        return [[w[0] for w in part]
+                for part in collector._partition_ways(ways, size)]
+
+    def test_connected_ways(self):
+        # 0 and 2 meet at node 3, 1 is connected at an intersection
+        parts = self.partition([[1, 2, 3], [3, 7], [4, 3]], [], 1)
+        assert_equal([[0, 1, 2]], parts)
+
+        parts = self.partition([[1, 2, 3], [5, 7], [4, 3]], [], 1)
+        assert_equal([[0, 2], [1]], parts)
+
+    def test_intersections_separate(self):
+        parts = self.partition([[1, 2, 3], [3, 7], [4, 3]], [3], 1)
+        assert_equal([[0], [1], [2]], parts)
+
+    def test_inner_nodes_do_not_connect(self):
+        # only end points are used for fusing
+        parts = self.partition([[1, 2, 3], [5, 2, 6]], [], 1)
+        assert_equal([[0], [1]], parts)
+
+    def test_chain_through_other_ways(self):
+        parts = self.partition([[1, 2], [8, 9], [3, 4], [2, 3], [9, 10]], [], 1)
+        assert_equal([[0, 2, 3], [1, 4]], parts)
+
+    def test_closed_ways(self):
+        parts = self.partition([[1, 2, 1], [1, 5], [6, 7, 6]], [], 1)
+        assert_equal([[0, 1], [2]], parts)
+
+    def test_size(self):
+        ways = [[10 * i, 10 * i + 1] for i in range(10)]
+        parts = self.partition(ways, [], 3)
+        assert_equal([[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]], parts)
+
+        parts = self.partition(ways, [], 100)
+        assert_equal([list(range(10))], parts)
+
+    def test_random_ways(self):
+        rnd = random.Random(3)
+        ways = [[rnd.randrange(50) for _ in range(rnd.randint(2, 4))]
+                for _ in range(200)]
+        intersections = rnd.sample(range(50), 10)
+
+        for size in (1, 7, 1000):
+            parts = self.partition(ways, intersections, size)
+            assert_equal(list(range(len(ways))), sorted(sum(parts, [])))
+            for part in parts[:-1]:
+                assert_greater_equal(len(part), size)
+
+            # ways that may be fused must be in the same part
+            part_of = {}
+            for i, part in enumerate(parts):
+                for w in part:
+                    part_of[w] = i
+            for i, wi in enumerate(ways):
+                for j, wj in enumerate(ways):
+                    shared = set((wi[0], wi[-1])) & set((wj[0], wj[-1]))
+                    if shared - set(intersections):
+                        assert_equal(part_of[i], part_of[j])
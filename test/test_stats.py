@@ -0,0 +1,142 @@
+# This file is part of Osgende
+# Copyright (C) 2018 Sarah Hoffmann
+#
+# This is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""
+Tests for the collection of table statistics. Uses an in-memory
+SQLite database, the bookkeeping does not depend on PostgreSQL.
+"""
+
+import unittest
+from nose.tools import *
+
+import sqlalchemy as sa
+
+from osgende.common.stats import StatsCollector, get_stats
+
+class ListSink(object):
+
+    def __init__(self):
+        self.results = []
+        self.closed = False
+
+    def write(self, stats):
+        self.results.append(stats)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTable(object):
+
+    def __init__(self, name, change=None):
+        meta = sa.MetaData()
+        self.data = sa.Table(name, meta)
+        if change is not None:
+            self.change = sa.Table(change, meta, sa.Column('id', sa.BigInteger))
+
+
+class TestStatsCollector(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://')
+        self.sink = ListSink()
+        self.collector = StatsCollector([self.sink])
+
+    def tearDown(self):
+        self.collector.close()
+
+    def test_failing_statement(self):
+        with self.collector.measure(FakeTable('t1'), 'construct', self.engine) as engine:
+            with engine.connect() as conn:
+                conn.execute("CREATE TABLE foo (a int)")
+                assert_raises(sa.exc.OperationalError,
+                              conn.execute, "INSERT INTO bar VALUES (1)")
+                conn.execute("INSERT INTO foo VALUES (1), (2), (3)")
+                assert_raises(sa.exc.OperationalError,
+                              conn.execute, "SELECT * FROM bar")
+                conn.execute("DELETE FROM foo WHERE a < 3")
+
+        assert_equal(1, len(self.sink.results))
+        stats = self.sink.results[0]
+        assert_equal('t1', stats.table)
+        assert_false(stats.failed)
+        assert_equal(5, stats.rows_written)
+        assert_greater(stats.sql_time, 0.0)
+        assert_less_equal(stats.sql_time, stats.wall_time)
+        assert_is_not_none(stats.python_time)
+
+    def test_failing_table(self):
+        def process():
+            with self.collector.measure(FakeTable('t1'), 'update', self.engine) as engine:
+                engine.execute("SELECT * FROM bar")
+
+        assert_raises(sa.exc.OperationalError, process)
+
+        assert_equal(1, len(self.sink.results))
+        stats = self.sink.results[0]
+        assert_true(stats.failed)
+        assert_equal('update', stats.phase)
+        assert_greater(stats.wall_time, 0.0)
+        assert_equal(0, len(self.collector.active))
+
+        with self.collector.measure(FakeTable('t2'), 'update', self.engine) as engine:
+            engine.execute("SELECT 1")
+
+        assert_equal(2, len(self.sink.results))
+        assert_false(self.sink.results[1].failed)
+        assert_false(self.sink.results[1].concurrent)
+
+    def test_change_size(self):
+        self.engine.execute("CREATE TABLE t1_changeset (id int)")
+        self.engine.execute("INSERT INTO t1_changeset VALUES (1), (2)")
+
+        with self.collector.measure(FakeTable('t1', 't1_changeset'), 'update',
+                                    self.engine):
+            pass
+
+        assert_equal(2, self.sink.results[0].change_size)
+
+    def test_change_size_failing(self):
+        # The change table does not exist.
+        with self.collector.measure(FakeTable('t1', 't1_changeset'), 'update',
+                                    self.engine):
+            pass
+
+        assert_equal(1, len(self.sink.results))
+        stats = self.sink.results[0]
+        assert_false(stats.failed)
+        assert_is_none(stats.change_size)
+
+    def test_concurrent_tables(self):
+        with self.collector.measure(FakeTable('t1'), 'construct', self.engine):
+            with self.collector.measure(FakeTable('t2'), 'construct', self.engine):
+                pass
+
+        assert_equal(2, len(self.sink.results))
+        for stats in self.sink.results:
+            assert_true(stats.concurrent)
+            assert_is_none(stats.python_time)
+
+    def test_close_detaches(self):
+        with self.collector.measure(FakeTable('t1'), 'construct', self.engine) as engine:
+            pass
+
+        self.collector.close()
+        assert_true(self.sink.closed)
+
+        stats = get_stats(engine)
+        engine.execute("SELECT 1")
+        assert_equal(0.0, stats.sql_time)
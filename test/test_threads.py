@@ -0,0 +1,195 @@
+# This file is part of Osgende
+# Copyright (C) 2018 Sarah Hoffmann
+#
+# This is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""
+Tests for the thread and process based worker queues.
+"""
+
+import threading
+import unittest
+from multiprocessing.reduction import ForkingPickler
+from nose.tools import *
+
+from osgende.common.threads import WorkerQueue, ProcessWorkerQueue, WorkerError
+
+class Collector(object):
+    """ Collects the processed items. In worker processes each process
+        works on its own copy and sends the items back on shutdown.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.chunks = []
+        self.lock = threading.Lock()
+
+    def process(self, item):
+        if item == 'fail':
+            raise RuntimeError("Processing failed.")
+        with self.lock:
+            self.items.append(item)
+
+    def process_chunk(self, items):
+        with self.lock:
+            self.chunks.append(len(items))
+        for item in items:
+            self.process(item)
+
+    def init(self):
+        pass
+
+    def shutdown(self):
+        return self.items, self.chunks
+
+
+class TestWorkerQueue(unittest.TestCase):
+
+    queue_class = WorkerQueue
+
+    def make_queue(self, collector, numthreads, **kwargs):
+        return self.queue_class(collector.process, numthreads,
+                                collector.init, collector.shutdown, **kwargs)
+
+    def collect(self, results):
+        # Worker threads share the collector, worker processes not.
+        items = []
+        chunks = []
+        seen = set()
+        for i, c in results:
+            if id(i) not in seen:
+                seen.add(id(i))
+                items.extend(i)
+                chunks.extend(c)
+        return sorted(items), chunks
+
+    def test_no_threads(self):
+        c = Collector()
+        q = self.make_queue(c, 0)
+        for i in range(10):
+            q.add_task(i)
+        assert_equal(list(range(10)), c.items)
+        results = q.finish()
+        assert_equal(1, len(results))
+
+    def test_workers(self):
+        c = Collector()
+        q = self.make_queue(c, 3)
+        for i in range(100):
+            q.add_task(i)
+        results = q.finish()
+
+        assert_equal(3, len(results))
+        items, _ = self.collect(results)
+        assert_equal(list(range(100)), items)
+
+    def test_chunks(self):
+        c = Collector()
+        q = self.make_queue(c, 2, chunksize=7, batch_func=c.process_chunk)
+        for i in range(100):
+            q.add_task(i)
+        results = q.finish()
+
+        items, chunks = self.collect(results)
+        assert_equal(list(range(100)), items)
+        assert_equal(100, sum(chunks))
+        assert_equal([2] + [7] * 14, sorted(chunks))
+
+    def test_chunks_without_batch_func(self):
+        c = Collector()
+        q = self.make_queue(c, 2, chunksize=10)
+        for i in range(25):
+            q.add_task(i)
+        results = q.finish()
+
+        items, chunks = self.collect(results)
+        assert_equal(list(range(25)), items)
+        assert_equal([], chunks)
+
+    def test_chunks_no_threads(self):
+        c = Collector()
+        q = self.make_queue(c, 0, chunksize=4, batch_func=c.process_chunk)
+        for i in range(10):
+            q.add_task(i)
+        assert_equal([4, 4], c.chunks)
+        q.finish()
+        assert_equal([4, 4, 2], c.chunks)
+        assert_equal(list(range(10)), c.items)
+
+    def test_flush(self):
+        c = Collector()
+        q = self.make_queue(c, 0, chunksize=4, batch_func=c.process_chunk)
+        for i in range(10):
+            q.add_task(i)
+        q.finish(flush=True)
+        assert_equal(list(range(8)), c.items)
+
+
+class TestProcessWorkerQueue(TestWorkerQueue):
+
+    queue_class = ProcessWorkerQueue
+
+    def test_items_are_processed_in_other_processes(self):
+        c = Collector()
+        q = self.make_queue(c, 2)
+        for i in range(10):
+            q.add_task(i)
+        q.finish()
+
+        assert_equal([], c.items)
+
+    def test_memoryview_items(self):
+        c = Collector()
+        q = self.make_queue(c, 2)
+        q.add_task(memoryview(b'ab'))
+        q.add_task(memoryview(b'cd'))
+        items = [bytes(m) for r in q.finish() for m in r[0]]
+
+        assert_equal([b'ab', b'cd'], sorted(items))
+
+    def test_memoryview_pickling_registered_lazily(self):
+        # Pickling of memoryviews is only changed for the whole process
+        # once a process backend is set up.
+        old = ForkingPickler._extra_reducers.pop(memoryview, None)
+        try:
+            c = Collector()
+            q = WorkerQueue(c.process, 2, c.init, c.shutdown)
+            q.add_task(1)
+            q.finish()
+            assert_not_in(memoryview, ForkingPickler._extra_reducers)
+
+            q = self.make_queue(c, 1)
+            assert_in(memoryview, ForkingPickler._extra_reducers)
+            q.finish()
+        finally:
+            if old is not None:
+                ForkingPickler._extra_reducers[memoryview] = old
+
+    def test_worker_error(self):
+        c = Collector()
+        q = self.make_queue(c, 2)
+        q.add_task(1)
+        q.add_task('fail')
+        assert_raises(WorkerError, q.finish)
+
+    def test_worker_error_on_add(self):
+        c = Collector()
+        q = self.make_queue(c, 1)
+        q.add_task('fail')
+
+        def fill():
+            for i in range(1000):
+                q.add_task(i)
+
+        assert_raises(WorkerError, fill)
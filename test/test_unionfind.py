@@ -0,0 +1,91 @@
+# This file is part of Osgende
+# Copyright (C) 2018 Sarah Hoffmann
+#
+# This is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""
+Tests for the disjoint set data structure.
+"""
+
+import random
+import unittest
+from nose.tools import *
+
+from osgende.common.unionfind import UnionFind
+
+class TestUnionFind(unittest.TestCase):
+
+    def make(self, num):
+        uf = UnionFind()
+        for i in range(num):
+            assert_equal(i, uf.add())
+        return uf
+
+    def test_empty(self):
+        assert_equal([], UnionFind().sets())
+
+    def test_singletons(self):
+        uf = self.make(3)
+        assert_equal([[0], [1], [2]], uf.sets())
+        for i in range(3):
+            assert_equal(i, uf.find(i))
+
+    def test_union(self):
+        uf = self.make(6)
+        uf.union(4, 1)
+        uf.union(5, 3)
+        uf.union(3, 4)
+
+        assert_equal([[0], [1, 3, 4, 5], [2]], uf.sets())
+        for i in (1, 3, 4, 5):
+            assert_equal(1, uf.find(i))
+
+    def test_union_same_set(self):
+        uf = self.make(3)
+        uf.union(0, 2)
+        uf.union(2, 0)
+        uf.union(1, 1)
+
+        assert_equal([[0, 2], [1]], uf.sets())
+
+    def test_long_chain(self):
+        uf = self.make(10000)
+        for i in range(9999, 0, -1):
+            uf.union(i, i - 1)
+
+        assert_equal(0, uf.find(9999))
+        # path is compressed after the lookup
+        assert_equal(0, uf.parents[9999])
+        assert_equal([list(range(10000))], uf.sets())
+
+    def test_random_unions(self):
+        rnd = random.Random(42)
+        num = 500
+        uf = self.make(num)
+        # naive reference: set id for each element
+        ref = list(range(num))
+        for _ in range(300):
+            i, j = rnd.randrange(num), rnd.randrange(num)
+            uf.union(i, j)
+            old, new = ref[i], ref[j]
+            ref = [new if r == old else r for r in ref]
+
+        expected = {}
+        for i, r in enumerate(ref):
+            expected.setdefault(r, []).append(i)
+
+        assert_equal(sorted(expected.values()), uf.sets())
+        for part in uf.sets():
+            for i in part:
+                assert_equal(part[0], uf.find(i))